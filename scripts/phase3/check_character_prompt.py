@@ -1,54 +1,274 @@
 #!/usr/bin/env python3
-"""キャラクター用プロンプトがタグ辞書に準拠しているか検証するスクリプト。"""
+"""キャラクター用プロンプトがタグ辞書に準拠しているか検証するスクリプト。
+
+タグ辞書の全キャラクターの ID・``prompt_prefix``・``attributes``・``negatives`` を
+1つの Aho-Corasick オートマトンにまとめ、プロンプトを1回走査するだけで全タグの
+出現を求める。照合は大文字小文字を区別しない。prefix と attributes は部分一致、
+negatives はカンマ区切りのタグ全体 (強調の括弧や ``:1.2`` の重みは区切りとみなす) と
+一致したときだけ禁止タグとして扱うので、"silver armor" は negatives の "armor" に
+当たらない。不足タグと禁止タグが両方あるときは禁止タグ (終了コード3) を優先する。
+
+``character_id prompt`` を渡すと従来どおり1件を検証する。``--input`` (ファイル、
+``-`` で標準入力) を渡すとバッチモードになり、テキストは1行1プロンプト、``.jsonl``
+(または ``--input-format jsonl``) は1行1オブジェクト (``prompt`` と任意の
+``character_id`` / ``id``) として読み、プロンプトごとのレポートを JSON Lines で出力する。
+``character_id`` が無いプロンプトは、ID か prompt_prefix が含まれるキャラクターで検証する。
+読めない JSONL 行は ``status: "invalid"`` として報告し、終了コードを失敗にする。
+"""
 
 import argparse
 import json
 import sys
+from collections import deque
 from pathlib import Path
+from typing import Iterator, TextIO
 
 ROOT = Path(__file__).resolve().parents[2]
 TAGS_PATH = ROOT / "config" / "phase3" / "character_tags.json"
 
+EXIT_OK = 0
+EXIT_UNKNOWN = 1
+EXIT_MISSING = 2
+EXIT_NEGATIVE = 3
+# 複数キャラクターを含むプロンプトは最も重い状態をプロンプトの状態にする
+STATUS_RANK = {"ok": 0, "missing": 1, "negative": 2, "unknown": 3}
+# タグの境界とみなす文字 (カンマ区切りと、強調・重み・交互指定の記法)
+TAG_BOUNDARIES = set(",()[]{}:|\n")
 
-def load_tags() -> dict:
-    if not TAGS_PATH.exists():
-        raise FileNotFoundError(f"タグ辞書が存在しません: {TAGS_PATH}")
-    return json.loads(TAGS_PATH.read_text(encoding="utf-8"))
 
+def load_tags(path: Path = TAGS_PATH) -> dict:
+    if not path.exists():
+        raise FileNotFoundError(f"タグ辞書が存在しません: {path}")
+    return json.loads(path.read_text(encoding="utf-8"))
 
-def validate_prompt(character_id: str, prompt: str) -> int:
-    tags = load_tags()["characters"]
-    if character_id not in tags:
-        print(f"✖ 未登録キャラクター: {character_id}", file=sys.stderr)
-        return 1
 
-    record = tags[character_id]
-    prefix = record["prompt_prefix"]
-    missing: list[str] = []
-    if prefix not in prompt:
-        missing.append(f"prompt_prefix '{prefix}'")
+class AhoCorasick:
+    """複数パターンの部分一致を1回の走査で求めるオートマトン。"""
+
+    def __init__(self, patterns: list[str]) -> None:
+        self.goto: list[dict[str, int]] = [{}]
+        self.outputs: list[list[int]] = [[]]
+        for number, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.outputs.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.outputs[state].append(number)
+
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def search(self, text: str) -> set[int]:
+        """text に含まれるパターンの番号。"""
+        return {number for number, _ in self.matches(text)}
+
+    def matches(self, text: str) -> Iterator[tuple[int, int]]:
+        """(パターンの番号, 一致の終端位置 (含まない)) をすべて返す。"""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for number in outputs[state]:
+                yield number, position + 1
+
+
+def is_whole_tag(text: str, start: int, end: int) -> bool:
+    """text[start:end] の前後が (空白を除いて) 文字列の端かタグの境界か。"""
+    before = text[:start].rstrip()
+    after = text[end:].lstrip()
+    return (not before or before[-1] in TAG_BOUNDARIES) and (not after or after[0] in TAG_BOUNDARIES)
+
+
+class PromptMatcher:
+    """タグ辞書をコンパイルした照合器。パターンは (キャラクター, 種類, キー) を持つ。"""
+
+    def __init__(self, characters: dict) -> None:
+        self.characters = characters
+        texts: dict[str, int] = {}
+        self.entries: list[list[tuple[str, str, str]]] = []
+        self.texts: list[str] = []
+
+        def register(text: str, character_id: str, kind: str, key: str) -> None:
+            normalized = text.strip().casefold()
+            if not normalized:
+                return
+            if normalized not in texts:
+                texts[normalized] = len(self.texts)
+                self.texts.append(text.strip())
+                self.entries.append([])
+            self.entries[texts[normalized]].append((character_id, kind, key))
+
+        for character_id, record in characters.items():
+            register(character_id, character_id, "id", "")
+            register(record["prompt_prefix"], character_id, "prompt_prefix", "")
+            for key, value in record.get("attributes", {}).items():
+                register(value, character_id, "attribute", key)
+            for value in record.get("negatives", []):
+                register(value, character_id, "negative", value)
+        self.lengths = [len(text) for text in texts]
+        self.automaton = AhoCorasick(list(texts))
 
-    attributes = record.get("attributes", {})
-    for key, value in attributes.items():
-        if value not in prompt:
-            missing.append(f"{key}:{value}")
+    def check(self, prompt: str, character_id: str | None = None) -> dict:
+        """プロンプト1件のレポート。status は ok / missing / negative / unknown。"""
+        hits: dict[str, set[tuple[str, str]]] = {}
+        text = prompt.casefold()
+        for number, end in self.automaton.matches(text):
+            whole = None
+            for owner, kind, key in self.entries[number]:
+                if kind == "negative":
+                    if whole is None:
+                        whole = is_whole_tag(text, end - self.lengths[number], end)
+                    if not whole:
+                        continue
+                hits.setdefault(owner, set()).add((kind, key))
 
-    if missing:
-        print("✖ プロンプトに不足タグ: " + ", ".join(missing), file=sys.stderr)
-        return 2
+        if character_id is not None:
+            targets = [character_id]
+        else:
+            targets = sorted(owner for owner, found in hits.items() if {"id", "prompt_prefix"} & {kind for kind, _ in found})
+        report = {"characters": [], "status": "ok" if targets else "unknown"}
+        for target in targets:
+            if target not in self.characters:
+                report["characters"].append({"character_id": target, "status": "unknown"})
+                report["status"] = "unknown"
+                continue
+            record = self.characters[target]
+            found = hits.get(target, set())
+            missing = [] if ("prompt_prefix", "") in found else [f"prompt_prefix '{record['prompt_prefix']}'"]
+            missing += [f"{key}:{value}" for key, value in record.get("attributes", {}).items() if ("attribute", key) not in found]
+            negatives = [value for value in record.get("negatives", []) if ("negative", value) in found]
+            status = "negative" if negatives else "missing" if missing else "ok"
+            report["characters"].append({"character_id": target, "status": status, "missing": missing, "negatives": negatives})
+            report["status"] = max(report["status"], status, key=STATUS_RANK.get)
+        return report
+
+
+def compile_tags(path: Path = TAGS_PATH) -> PromptMatcher:
+    return PromptMatcher(load_tags(path)["characters"])
+
+
+def validate_prompt(character_id: str, prompt: str, matcher: PromptMatcher | None = None) -> int:
+    matcher = matcher or compile_tags()
+    result = matcher.check(prompt, character_id)["characters"][0]
+    if result["status"] == "unknown":
+        print(f"✖ 未登録キャラクター: {character_id}", file=sys.stderr)
+        return EXIT_UNKNOWN
+    if result["missing"]:
+        print("✖ プロンプトに不足タグ: " + ", ".join(result["missing"]), file=sys.stderr)
+    if result["negatives"]:
+        print("✖ プロンプトに禁止タグ: " + ", ".join(result["negatives"]), file=sys.stderr)
+    # バッチの status と同じく、禁止タグを不足タグより優先する
+    if result["status"] == "negative":
+        return EXIT_NEGATIVE
+    if result["status"] == "missing":
+        return EXIT_MISSING
 
     print("✓ プロンプトはキャラクター辞書と整合しています")
-    return 0
+    return EXIT_OK
+
+
+def parse_jsonl_record(text: str, default_id: str) -> dict:
+    """JSONL の1行を {id, prompt, character_id} にする。形式が違えば ValueError。"""
+    record = json.loads(text)
+    if not isinstance(record, dict):
+        raise ValueError(f"JSON オブジェクトではありません ({type(record).__name__})")
+    prompt = record.get("prompt", "")
+    if not isinstance(prompt, str):
+        raise ValueError(f"prompt が文字列ではありません ({type(prompt).__name__})")
+    character_id = record.get("character_id")
+    if character_id is not None and not isinstance(character_id, str):
+        raise ValueError(f"character_id が文字列ではありません ({type(character_id).__name__})")
+    return {"id": record.get("id", default_id), "prompt": prompt, "character_id": character_id}
+
+
+def iter_prompts(stream: TextIO, source: str, input_format: str) -> Iterator[dict]:
+    """{id, prompt, character_id} を1行ずつ返す。空行と # で始まるテキスト行は飛ばす。
+
+    生成ログには壊れた行が混じりうるので、読めない JSONL 行は止まらずに
+    {id, error} として返す。
+    """
+    for line_no, line in enumerate(stream, start=1):
+        text = line.strip()
+        if not text or (input_format == "text" and text.startswith("#")):
+            continue
+        default_id = f"{source}:{line_no}"
+        if input_format == "jsonl":
+            try:
+                yield parse_jsonl_record(text, default_id)
+            except ValueError as exc:  # json.JSONDecodeError も ValueError
+                yield {"id": default_id, "error": str(exc)}
+        else:
+            yield {"id": default_id, "prompt": text, "character_id": None}
+
+
+def check_batch(matcher: PromptMatcher, inputs: list[str], input_format: str, output: TextIO) -> dict:
+    """各入力を1回ずつ読み、プロンプトごとのレポートを output に JSON Lines で書く。
+
+    読めなかった行は status "invalid" とエラーを出力し、残りの検証を続ける。
+    """
+    counts = {"prompts": 0, "ok": 0, "missing": 0, "negative": 0, "unknown": 0, "invalid": 0}
+    for name in inputs:
+        fmt = input_format
+        if fmt == "auto":
+            fmt = "jsonl" if name.endswith(".jsonl") else "text"
+        stream = sys.stdin if name == "-" else open(name, encoding="utf-8")
+        try:
+            for item in iter_prompts(stream, "stdin" if name == "-" else name, fmt):
+                if "error" in item:
+                    report = {"id": item["id"], "characters": [], "status": "invalid", "error": item["error"]}
+                else:
+                    report = {"id": item["id"], **matcher.check(item["prompt"], item["character_id"])}
+                counts["prompts"] += 1
+                counts[report["status"]] += 1
+                output.write(json.dumps(report, ensure_ascii=False) + "\n")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+    return counts
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="キャラクタープロンプト検証")
-    parser.add_argument("character_id", help="例: char:Shirayuki_Aoi")
-    parser.add_argument("prompt", help="検証するプロンプト全文")
+    parser.add_argument("character_id", nargs="?", help="例: char:Shirayuki_Aoi")
+    parser.add_argument("prompt", nargs="?", help="検証するプロンプト全文")
+    parser.add_argument("--tags", default=str(TAGS_PATH), help="タグ辞書 (character_tags.json)")
+    parser.add_argument("--input", action="append", default=[], help="バッチ検証するプロンプトファイル (- で標準入力、複数可)")
+    parser.add_argument("--input-format", choices=["auto", "text", "jsonl"], default="auto", help="入力形式 (auto は拡張子で判定)")
+    parser.add_argument("--output", default=None, help="バッチレポート (JSON Lines) の出力先 (既定: 標準出力)")
     args = parser.parse_args()
 
-    exit_code = validate_prompt(args.character_id, args.prompt)
-    sys.exit(exit_code)
+    matcher = compile_tags(Path(args.tags))
+    if not args.input:
+        if not args.character_id or args.prompt is None:
+            parser.error("character_id と prompt、または --input を指定してください")
+        sys.exit(validate_prompt(args.character_id, args.prompt, matcher))
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        counts = check_batch(matcher, args.input, args.input_format, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(
+        f"{counts['prompts']} prompts: ok={counts['ok']}, missing={counts['missing']}, "
+        f"negative={counts['negative']}, unknown={counts['unknown']}, invalid={counts['invalid']}",
+        file=sys.stderr,
+    )
+    sys.exit(0 if counts["ok"] == counts["prompts"] else 1)
 
 
 if __name__ == "__main__":
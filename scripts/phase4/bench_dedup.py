@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""重複検出の近傍探索ベンチマーク。
+
+近い複製を混ぜたランダムな 64bit ハッシュを作り、dedup_images.py のネイティブ実装
+(多重インデックスハッシュ) と imagededup の ``find_duplicates`` の所要時間を比べ、
+結果が一致することを確かめる。imagededup が無い環境では Python の総当たりと比べる。
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from dedup_images import find_duplicates
+
+
+def synthetic_encodings(count: int, max_distance: int, duplicate_ratio: float, seed: int) -> dict[str, str]:
+    """count 件のうち duplicate_ratio を、既存ハッシュから max_distance bit 以内を反転した複製にする。"""
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, 2**64, size=count, dtype=np.uint64)
+    copies = rng.choice(count, size=int(count * duplicate_ratio), replace=False)
+    for index in copies:
+        source = hashes[rng.integers(count)]
+        flips = rng.choice(64, size=rng.integers(0, max_distance + 1), replace=False)
+        hashes[index] = source ^ np.uint64(sum(1 << int(bit) for bit in flips))
+    return {f"img_{index:07d}.png": f"{int(value):016x}" for index, value in enumerate(hashes)}
+
+
+def reference_duplicates(encodings: dict[str, str], max_distance: int) -> dict:
+    """imagededup の総当たり探索と同じ規則 (距離昇順、同距離は登録順) の Python 実装。"""
+    items = [(name, int(value, 16)) for name, value in encodings.items()]
+    duplicates = {}
+    for name, value in items:
+        matches = [(other, (value ^ other_value).bit_count()) for other, other_value in items if other != name]
+        matches = sorted((match for match in matches if match[1] <= max_distance), key=lambda match: match[1])
+        duplicates[name] = [other for other, _ in matches]
+    return duplicates
+
+
+def baseline(encodings: dict[str, str], max_distance: int) -> tuple[str, dict]:
+    try:
+        from imagededup.methods import PHash
+    except ImportError:
+        return "python brute force", reference_duplicates(encodings, max_distance)
+    return "imagededup", PHash(verbose=False).find_duplicates(encoding_map=encodings, max_distance_threshold=max_distance)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="重複検出の近傍探索ベンチマーク")
+    parser.add_argument("--count", type=int, default=20000, help="ハッシュ件数")
+    parser.add_argument("--max-distance", type=int, default=6)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05, help="近い複製の割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--native-only", action="store_true", help="比較対象を実行しない")
+    args = parser.parse_args()
+
+    encodings = synthetic_encodings(args.count, args.max_distance, args.duplicate_ratio, args.seed)
+    started = time.perf_counter()
+    native = find_duplicates(encodings, args.max_distance)
+    result = {
+        "count": args.count,
+        "max_distance": args.max_distance,
+        "native_seconds": round(time.perf_counter() - started, 3),
+        "duplicate_images": sum(1 for matches in native.values() if matches),
+    }
+    if not args.native_only:
+        started = time.perf_counter()
+        result["baseline"], expected = baseline(encodings, args.max_distance)
+        result["baseline_seconds"] = round(time.perf_counter() - started, 3)
+        result["speedup"] = round(result["baseline_seconds"] / max(result["native_seconds"], 1e-9), 1)
+        result["identical"] = native == expected
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
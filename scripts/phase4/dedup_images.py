@@ -1,21 +1,78 @@
 #!/usr/bin/env python3
-"""imagededupを利用した重複画像検出テンプレート。"""
+"""imagededupを利用した重複画像検出テンプレート。
+
+既定 (``engine: native``) ではハッシュ化と近傍探索を NumPy で行う。ハッシュ化は
+プロセスプールで画像を1回だけ縮小デコードし、phash/ahash/dhash をまとめて計算する
+(imagededup と同じアルゴリズム)。近傍探索は多重インデックスハッシュを使う。
+``engine: imagededup`` で従来どおり imagededup の ``encode_images`` /
+``find_duplicates`` に切り替えられる。
+
+``method: embedding`` では知覚ハッシュの代わりにローカルの ONNX 画像埋め込み
+モデル (CLIP など) を onnxruntime でバッチ推論し、正規化した埋め込みを float16 の
+memmap に書き出す。コサイン類似度が閾値以上のペアをブロック単位の行列積で探すため、
+50万枚以上でもメモリは block_size の2乗程度に収まる。トリミングや色替えなど
+ハッシュでは拾えない近い複製を検出できる。
+
+native では duplicates.json の隣に SQLite のハッシュ索引を置き、パス・サイズ・
+mtime・phash/ahash/dhash と検出済みの重複ペアを記録する。2回目以降は追加・変更
+された画像だけをハッシュし、その新しいハッシュだけを索引に問い合わせる。
+"""
 
 import argparse
 import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Iterator
 
-from imagededup.methods import PHash, AHash, DHash
+import numpy as np
+from PIL import Image
 
 ROOT = Path(__file__).resolve().parents[2]
 CONFIG_PATH = ROOT / "config" / "phase4" / "dedup_config.json"
 
+HASH_BITS = 64
+# 部分列がこれより多くなる (1部分列が4bit未満になる) と候補が全件に近づくため、総当たりにする
+MAX_CHUNKS = 16
+# 1回に展開して検証する候補ペア数の上限 (メモリを一定に保つ)
+CANDIDATE_BLOCK = 1 << 22
+HASH_METHODS = ("phash", "ahash", "dhash")
+# ハッシュの計算方法が変わったら上げる (索引の全件を再計算させる)
+HASHER_VERSION = "native-1"
+# imagededup と同じ縮小サイズ (幅, 高さ)
+PHASH_SIZE = (32, 32)
+AHASH_SIZE = (8, 8)
+DHASH_SIZE = (9, 8)
+# 縮小デコードでも最終的な縮小の前にこの倍率の解像度は残す (LANCZOS の品質を保つ)
+REDUCED_DECODE_MARGIN = 4
+DEFAULT_HASH_CHUNK = 64
+# 読めない画像を除いた埋め込みを .npy に写すときの1回あたりの行数
+EMBEDDING_COPY_ROWS = 8192
+# method: embedding の既定値 (CLIP ViT の前処理)
+EMBEDDING_DEFAULTS = {
+    "input_size": 224,
+    "layout": "NCHW",
+    "mean": [0.48145466, 0.4578275, 0.40821073],
+    "std": [0.26862954, 0.26130258, 0.27577711],
+    "threshold": 0.92,
+    "batch_size": 32,
+    "block_size": 4096,
+    "intra_op_threads": 0,
+    # 埋め込みとして使うモデル出力 (null はモデルの出力が1つのときだけ可)
+    "output_name": None,
+}
+_BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
 
-def load_config() -> dict:
-    return json.loads(CONFIG_PATH.read_text(encoding="utf-8"))
+def load_config(path: Path = CONFIG_PATH) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
 
 
 def get_method(name: str):
+    from imagededup.methods import AHash, DHash, PHash
+
     return {
         "phash": PHash,
         "ahash": AHash,
@@ -23,24 +80,644 @@ def get_method(name: str):
     }[name.lower()]
 
 
+def hashes_to_array(hex_hashes) -> np.ndarray:
+    """16進ハッシュ文字列を uint64 配列にする。"""
+    return np.array([int(value, 16) for value in hex_hashes], dtype=np.uint64)
+
+
+def popcount64(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def hash_chunks(max_distance: int, bits: int = HASH_BITS) -> list[tuple[int, int]]:
+    """ハッシュを max_distance+1 個の部分列 (シフト, ビット幅) に分ける。"""
+    count = max_distance + 1
+    if count > MAX_CHUNKS:
+        return [(0, 0)]
+    chunks = []
+    shift = 0
+    for index in range(count):
+        width = bits // count + (1 if index < bits % count else 0)
+        chunks.append((shift, width))
+        shift += width
+    return chunks
+
+
+class MultiIndexHash:
+    """64bit 知覚ハッシュの多重インデックスハッシュ (MIH) による近傍検索。
+
+    ハッシュを max_distance+1 個の部分列に分けると、ハミング距離が max_distance 以下の
+    ペアは少なくとも1つの部分列が完全一致する (鳩の巣原理)。部分列ごとにソート済みの
+    キー表を持ち、一致した候補だけを popcount で検証する。同じペアを複数の部分列で
+    数えないよう、それより前の部分列がすべて不一致の候補だけを採用する。
+    """
+
+    def __init__(self, hashes: np.ndarray, max_distance: int) -> None:
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        self.max_distance = max_distance
+        self.tables = []
+        for shift, width in hash_chunks(max_distance):
+            mask = np.uint64((1 << width) - 1)
+            keys = (self.hashes >> np.uint64(shift)) & mask
+            order = np.argsort(keys, kind="stable")
+            self.tables.append((np.uint64(shift), mask, keys[order], order))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def search(self, queries: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """距離 max_distance 以下の (クエリ番号, 索引番号, 距離) を重複なしで返す。"""
+        queries = np.ascontiguousarray(queries, dtype=np.uint64)
+        found = []
+        for chunk, (shift, mask, sorted_keys, order) in enumerate(self.tables):
+            query_keys = (queries >> shift) & mask
+            left = np.searchsorted(sorted_keys, query_keys, side="left")
+            counts = np.searchsorted(sorted_keys, query_keys, side="right") - left
+            found.extend(self._verify(chunk, queries, np.arange(len(queries)), left, counts))
+        return self._concatenate(found)
+
+    def pairs(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """索引内の距離 max_distance 以下のペア (i < j)。
+
+        各部分列のソート済み表で、同じキーの区間内の後ろの要素だけを候補にするため、
+        同じペアを2回検証しない。
+        """
+        found = []
+        for chunk, (_, _, sorted_keys, order) in enumerate(self.tables):
+            positions = np.arange(len(order))
+            counts = np.searchsorted(sorted_keys, sorted_keys, side="right") - positions - 1
+            found.extend(self._verify(chunk, self.hashes[order], order, positions + 1, counts))
+        first, second, distances = self._concatenate(found)
+        return np.minimum(first, second), np.maximum(first, second), distances
+
+    def _verify(
+        self, chunk: int, queries: np.ndarray, query_ids: np.ndarray, left: np.ndarray, counts: np.ndarray
+    ) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """queries[i] と表の left[i] から counts[i] 件の候補を、CANDIDATE_BLOCK 件ずつ検証する。"""
+        order = self.tables[chunk][3]
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(queries):
+            done = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, done + CANDIDATE_BLOCK, side="right")), start + 1)
+            block_counts = counts[start:stop]
+            total = int(block_counts.sum())
+            if total:
+                query_index = np.repeat(np.arange(start, stop), block_counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+                item_index = order[np.repeat(left[start:stop], block_counts) + offsets]
+                difference = queries[query_index] ^ self.hashes[item_index]
+                distances = popcount64(difference)
+                keep = distances <= self.max_distance
+                for earlier_shift, earlier_mask, _, _ in self.tables[:chunk]:
+                    keep &= ((difference >> earlier_shift) & earlier_mask) != 0
+                yield query_ids[query_index[keep]], item_index[keep], distances[keep]
+            start = stop
+
+    @staticmethod
+    def _concatenate(found: list) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if not found:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        first, second, distances = zip(*found)
+        return np.concatenate(first), np.concatenate(second), np.concatenate(distances).astype(np.int64)
+
+
+def duplicates_from_pairs(
+    names: list[str], first: np.ndarray, second: np.ndarray, distances: np.ndarray, scores: bool = False
+) -> dict:
+    """ペアを imagededup の ``find_duplicates`` と同じ形式の辞書にする。
+
+    各画像のリストは距離の昇順、同距離ならエンコーディングの順に並ぶ。
+    """
+    queries = np.concatenate([first, second])
+    matches = np.concatenate([second, first])
+    both = np.concatenate([distances, distances])
+    order = np.lexsort((matches, both, queries))
+    duplicates: dict = {name: [] for name in names}
+    for query, match, distance in zip(queries[order].tolist(), matches[order].tolist(), both[order].tolist()):
+        duplicates[names[query]].append((names[match], distance) if scores else names[match])
+    return duplicates
+
+
+def find_duplicates(encodings: dict[str, str], max_distance: int, scores: bool = False) -> dict:
+    """{ファイル名: 16進ハッシュ} から重複候補を探す (imagededup の find_duplicates 互換)。"""
+    names = list(encodings)
+    index = MultiIndexHash(hashes_to_array(encodings.values()), max_distance)
+    return duplicates_from_pairs(names, *index.pairs(), scores=scores)
+
+
+def to_signed64(value: int) -> int:
+    """SQLite の INTEGER (符号付き64bit) に収まるよう uint64 を読み替える。"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def list_images(image_dir: Path) -> list[Path]:
+    """imagededup の encode_images と同じく、直下の隠しファイル以外を対象にする。"""
+    return sorted(path for path in Path(image_dir).iterdir() if path.is_file() and not path.name.startswith("."))
+
+
+def _dct_matrix(size: int, coefficients: int) -> np.ndarray:
+    """scipy.fftpack.dct (type II, 正規化なし) の先頭 coefficients 行。"""
+    k = np.arange(coefficients)[:, None]
+    n = np.arange(size)[None, :]
+    return 2 * np.cos(np.pi * k * (2 * n + 1) / (2 * size))
+
+
+_PHASH_DCT = _dct_matrix(PHASH_SIZE[0], 8)
+
+
+def _bits_to_hex(bits: np.ndarray) -> list[str]:
+    """(N, 8, 8) の真偽値を imagededup と同じ16進文字列にする。"""
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return [row.tobytes().hex() for row in packed]
+
+
+def load_thumbnails(path: Path, reduced: bool = True) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """1回のデコードから phash/ahash/dhash 用のグレースケール縮小画像を作る。
+
+    imagededup と同じく RGB のまま LANCZOS で縮小してからグレースケールにする。
+    reduced では JPEG を draft() で DCT 段階から縮小し、それ以外は reduce() で
+    PHASH_SIZE の REDUCED_DECODE_MARGIN 倍程度まで間引いてから縮小する。
+    """
+    with Image.open(path) as image:
+        target = PHASH_SIZE[0] * REDUCED_DECODE_MARGIN
+        if reduced and image.format == "JPEG":
+            image.draft("RGB", (target, target))
+        image = image.convert("RGBA").convert("RGB") if image.mode != "RGB" else image.convert("RGB")
+    if reduced:
+        factor = min(image.width, image.height) // target
+        if factor >= 2:
+            image = image.reduce(factor)
+    return tuple(
+        np.asarray(image.resize(size, Image.LANCZOS).convert("L"), dtype=np.float64)
+        for size in (PHASH_SIZE, AHASH_SIZE, DHASH_SIZE)
+    )
+
+
+def hash_thumbnails(phash: np.ndarray, ahash: np.ndarray, dhash: np.ndarray) -> dict[str, list[str]]:
+    """(N, 32, 32) / (N, 8, 8) / (N, 8, 9) の縮小画像からまとめてハッシュを計算する。"""
+    coefficients = np.einsum("ki,nij,lj->nkl", _PHASH_DCT, phash, _PHASH_DCT)
+    median = np.median(coefficients.reshape(len(coefficients), -1)[:, 1:], axis=1)
+    return {
+        "phash": _bits_to_hex(coefficients >= median[:, None, None]),
+        "ahash": _bits_to_hex(ahash >= ahash.mean(axis=(1, 2), keepdims=True)),
+        "dhash": _bits_to_hex(dhash[:, :, 1:] > dhash[:, :, :-1]),
+    }
+
+
+def _hash_chunk(paths: list[Path], reduced: bool) -> list[dict[str, str | None]]:
+    """プロセスプールの1単位。読めない画像はハッシュの代わりに error を返す。"""
+    results: list[dict[str, str | None]] = [{} for _ in paths]
+    loaded = []
+    for position, path in enumerate(paths):
+        try:
+            loaded.append((position, load_thumbnails(path, reduced)))
+        except Exception as exc:  # noqa: BLE001 - 破損画像は報告して続ける
+            results[position] = {**dict.fromkeys(HASH_METHODS), "error": f"{type(exc).__name__}: {exc}"}
+    if loaded:
+        positions, thumbnails = zip(*loaded)
+        hashes = hash_thumbnails(*(np.stack(group) for group in zip(*thumbnails)))
+        for row, position in enumerate(positions):
+            results[position] = {method: hashes[method][row] for method in HASH_METHODS}
+    return results
+
+
+def hash_images(
+    paths: list[Path], workers: int | None = None, chunk_size: int = DEFAULT_HASH_CHUNK, reduced: bool = True
+) -> list[dict[str, str | None]]:
+    """各画像の phash/ahash/dhash (16進) を入力順に返す。読めない画像は None と error。
+
+    chunk_size 枚ずつプロセスプールに渡し、各ワーカーは1枚を1回だけデコードする。
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = [paths[start : start + chunk_size] for start in range(0, len(paths), chunk_size)]
+    if workers == 1 or len(chunks) <= 1:
+        return [result for chunk in chunks for result in _hash_chunk(chunk, reduced)]
+    with ProcessPoolExecutor(min(workers, len(chunks))) as pool:
+        return [result for results in pool.map(_hash_chunk, chunks, [reduced] * len(chunks)) for result in results]
+
+
+def encode_images(
+    image_dir: Path, method: str, workers: int | None = None, chunk_size: int = DEFAULT_HASH_CHUNK, reduced: bool = True
+) -> tuple[dict[str, str], dict[str, str]]:
+    """imagededup の encode_images と同じ {ファイル名: 16進ハッシュ} と、読めなかった画像のエラー。"""
+    paths = list_images(image_dir)
+    encodings, errors = {}, {}
+    for path, hashes in zip(paths, hash_images(paths, workers, chunk_size, reduced)):
+        if hashes.get(method):
+            encodings[path.name] = hashes[method]
+        else:
+            errors[path.name] = hashes.get("error", "unreadable")
+    return encodings, errors
+
+
+class HashIndex:
+    """画像ごとのサイズ・mtime・知覚ハッシュと、重複ペアを保持する SQLite 索引。
+
+    ペアは (method, max_distance, ハッシュ方式) が前回と同じ間だけ再利用し、
+    画像が削除・変更されたらそれに関わるペアも消す。追加した画像には ``pending`` を
+    立て、そのペアを保存するのと同じトランザクションで下ろす。途中で止まっても
+    次回は pending の画像を問い合わせ直すので、ペアが失われない。
+    """
+
+    def __init__(self, path: Path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS images (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    phash INTEGER,
+                    ahash INTEGER,
+                    dhash INTEGER,
+                    error TEXT,
+                    pending INTEGER NOT NULL DEFAULT 1
+                )"""
+            )
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(images)")}
+            if "error" not in columns:
+                self.db.execute("ALTER TABLE images ADD COLUMN error TEXT")
+            if "pending" not in columns:
+                self.db.execute("ALTER TABLE images ADD COLUMN pending INTEGER NOT NULL DEFAULT 1")
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS pairs (
+                    first TEXT NOT NULL,
+                    second TEXT NOT NULL,
+                    distance INTEGER NOT NULL,
+                    PRIMARY KEY (first, second)
+                )"""
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS pairs_second ON pairs (second)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get_meta(self, key: str) -> str | None:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def stats(self) -> dict[str, tuple[int, int]]:
+        return {path: (size, mtime_ns) for path, size, mtime_ns in self.db.execute("SELECT path, size, mtime_ns FROM images")}
+
+    def remove(self, names: list[str]) -> None:
+        with self.db:
+            self.db.executemany("DELETE FROM images WHERE path = ?", [(name,) for name in names])
+            self.db.executemany("DELETE FROM pairs WHERE first = ?", [(name,) for name in names])
+            self.db.executemany("DELETE FROM pairs WHERE second = ?", [(name,) for name in names])
+
+    def clear(self) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM images")
+            self.db.execute("DELETE FROM pairs")
+
+    def add(self, rows: list[tuple[str, int, int, dict[str, str | None]]]) -> None:
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO images (path, size, mtime_ns, phash, ahash, dhash, error, pending) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+                [
+                    (
+                        name,
+                        size,
+                        mtime_ns,
+                        *(to_signed64(int(hashes[m], 16)) if hashes.get(m) else None for m in HASH_METHODS),
+                        hashes.get("error"),
+                    )
+                    for name, size, mtime_ns, hashes in rows
+                ],
+            )
+
+    def hashes(self, method: str) -> tuple[list[str], np.ndarray]:
+        """method のハッシュがある画像名 (パス順) と uint64 配列。"""
+        if method not in HASH_METHODS:
+            raise ValueError(f"unknown hash method: {method}")
+        rows = self.db.execute(f"SELECT path, {method} FROM images WHERE {method} IS NOT NULL ORDER BY path").fetchall()
+        values = np.array([value for _, value in rows], dtype=np.int64).view(np.uint64)
+        return [name for name, _ in rows], values
+
+    def failed(self) -> dict[str, str]:
+        """ハッシュできなかった画像とその理由。"""
+        rows = self.db.execute("SELECT path, error FROM images WHERE phash IS NULL ORDER BY path")
+        return {path: error or "unreadable" for path, error in rows}
+
+    def pairs(self) -> list[tuple[str, str, int]]:
+        return self.db.execute("SELECT first, second, distance FROM pairs").fetchall()
+
+    def pending(self) -> list[str]:
+        """ペアをまだ問い合わせていない (または保存前に中断した) 画像。"""
+        return [path for (path,) in self.db.execute("SELECT path FROM images WHERE pending = 1 ORDER BY path")]
+
+    def add_pairs(
+        self, rows: list[tuple[str, str, int]], queried: list[str] | None = None, pair_key: str | None = None
+    ) -> None:
+        """ペアを保存し、同じトランザクションで queried の pending を下ろす。
+
+        queried が None なら全ペアの置き換えとして既存のペアを消し、全画像の pending を
+        下ろして pair_key をペアの条件として記録する。
+        """
+        with self.db:
+            if queried is None:
+                self.db.execute("DELETE FROM pairs")
+                self.db.execute("UPDATE images SET pending = 0")
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pairs', ?)", (pair_key or "",))
+            else:
+                self.db.executemany("UPDATE images SET pending = 0 WHERE path = ?", [(name,) for name in queried])
+            self.db.executemany("INSERT OR REPLACE INTO pairs (first, second, distance) VALUES (?, ?, ?)", rows)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def update_index(
+    index: HashIndex, image_dir: Path, hasher=hash_images, version: str = HASHER_VERSION
+) -> tuple[list[str], list[str]]:
+    """ディレクトリと索引を突き合わせ、(追加・変更された画像, 消えた画像) を返す。"""
+    return sync_index(index, {path.name: path for path in list_images(image_dir)}, hasher, version)
+
+
+def sync_index(
+    index: HashIndex, files: dict[str, Path], hasher=hash_images, version: str = HASHER_VERSION
+) -> tuple[list[str], list[str]]:
+    """{索引上の名前: パス} と索引を突き合わせ、(追加・変更された画像, 消えた画像) を返す。
+
+    ハッシュ方式 (version) が変わっていれば全画像をハッシュし直す。
+    """
+    if index.get_meta("hasher") != version:
+        index.clear()
+        index.set_meta("hasher", version)
+    known = index.stats()
+    current = {}
+    for name, path in files.items():
+        stat = path.stat()
+        current[name] = (path, stat.st_size, stat.st_mtime_ns)
+    removed = [name for name in known if name not in current]
+    changed = [name for name, (_, size, mtime_ns) in current.items() if known.get(name) not in (None, (size, mtime_ns))]
+    added = sorted(name for name in current if known.get(name) != current[name][1:])
+    index.remove(removed + changed)
+    paths = [current[name][0] for name in added]
+    index.add([(name, *current[name][1:], hashes) for name, hashes in zip(added, hasher(paths))])
+    return added, removed
+
+
+def indexed_duplicates(index: HashIndex, method: str, max_distance: int, new_names: list[str]) -> dict:
+    """索引のハッシュから重複を求める。ペアの条件が前回と同じなら new_names だけを問い合わせる。"""
+    return duplicates_from_pairs(*indexed_pairs(index, method, max_distance, new_names))
+
+
+def indexed_pairs(
+    index: HashIndex, method: str, max_distance: int, new_names: list[str]
+) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray]:
+    """(画像名, ペアの一方, もう一方, 距離)。ペアは索引に保存し、次回以降は差分だけ探す。
+
+    差分として問い合わせるのは new_names と、前回ペアを保存する前に中断した
+    (pending のままの) 画像。
+    """
+    names, hashes = index.hashes(method)
+    search_index = MultiIndexHash(hashes, max_distance)
+    pair_key = json.dumps({"method": method, "max_distance": max_distance, "hasher": index.get_meta("hasher")})
+    positions = {name: position for position, name in enumerate(names)}
+    if index.get_meta("pairs") == pair_key:
+        queried = sorted(set(new_names) | set(index.pending()))
+        queries = np.array([positions[name] for name in queried if name in positions], dtype=np.int64)
+        found, items, distances = search_index.search(hashes[queries])
+        found = queries[found]
+        # 新しい画像同士のペアは両方向から見つかるので片方だけ残す
+        is_new = np.zeros(len(names), dtype=bool)
+        is_new[queries] = True
+        keep = (found != items) & (~is_new[items] | (found < items))
+        # 全件探索と同じく (小さい位置, 大きい位置) の向きで保存し、問い合わせ直しても重複させない
+        first, second = np.minimum(found[keep], items[keep]), np.maximum(found[keep], items[keep])
+        index.add_pairs(
+            [(names[a], names[b], d) for a, b, d in zip(first.tolist(), second.tolist(), distances[keep].tolist())],
+            queried=queried,
+        )
+    else:
+        first, second, distances = search_index.pairs()
+        index.add_pairs(
+            [(names[a], names[b], d) for a, b, d in zip(first.tolist(), second.tolist(), distances.tolist())], pair_key=pair_key
+        )
+
+    rows = np.array(
+        [(positions[a], positions[b], d) for a, b, d in index.pairs() if a in positions and b in positions], dtype=np.int64
+    ).reshape(-1, 3)
+    return names, rows[:, 0], rows[:, 1], rows[:, 2]
+
+
+def load_embedding_input(path: Path, size: int) -> np.ndarray:
+    """短辺を size に縮小して中央を切り出した RGB float32 (0〜1, HWC)。"""
+    with Image.open(path) as image:
+        if image.format == "JPEG":
+            image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+    scale = size / min(image.size)
+    width, height = max(size, round(image.width * scale)), max(size, round(image.height * scale))
+    image = image.resize((width, height), Image.BICUBIC, reducing_gap=3.0)
+    left, top = (width - size) // 2, (height - size) // 2
+    image = image.crop((left, top, left + size, top + size))
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def embedding_output_name(session, output_name: str | None) -> str:
+    """埋め込みとして読むモデル出力の名前。
+
+    CLIP/ViT のエクスポートは先頭に last_hidden_state (batch, tokens, hidden) を置くことが
+    多いので、出力が複数あるモデルでは embedding.output_name (image_embeds や
+    pooler_output) の指定を必須にし、2次元でない出力は受け付けない。
+    """
+    outputs = {output.name: output.shape for output in session.get_outputs()}
+    if output_name is None:
+        if len(outputs) != 1:
+            raise ValueError(f"埋め込みモデルの出力が複数あります。embedding.output_name を指定してください: {list(outputs)}")
+        output_name = next(iter(outputs))
+    if output_name not in outputs:
+        raise ValueError(f"埋め込みモデルに出力 {output_name} がありません: {list(outputs)}")
+    if outputs[output_name] and len(outputs[output_name]) != 2:
+        raise ValueError(f"埋め込み出力 {output_name} が (batch, dim) ではありません: shape={outputs[output_name]}")
+    return output_name
+
+
+def compute_embeddings(
+    paths: list[Path], model_path: Path, matrix_path: Path, settings: dict, workers: int | None = None
+) -> tuple[np.memmap, list[Path], dict[str, str]]:
+    """paths の埋め込みを L2 正規化して matrix_path の float16 memmap に書き込む。
+
+    デコードはスレッドで並列化し、推論は batch_size 枚ずつ行う。保持するのは1バッチ分
+    だけなので、メモリは画像枚数に依存しない。読めない画像があった場合は、書き込み中の
+    一時ファイルから読めた行だけを matrix_path に写すので、.npy の行数は返すパスの数と
+    一致する。返り値は (埋め込み, 行に対応するパス, 読めなかった画像のエラー)。
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = settings["intra_op_threads"]
+    session = ort.InferenceSession(str(model_path), sess_options=options, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+    output_name = embedding_output_name(session, settings["output_name"])
+    size, batch_size = settings["input_size"], settings["batch_size"]
+    mean = np.asarray(settings["mean"], dtype=np.float32)
+    std = np.asarray(settings["std"], dtype=np.float32)
+
+    def decode(path: Path) -> np.ndarray | str:
+        try:
+            return load_embedding_input(path, size)
+        except Exception as exc:  # noqa: BLE001 - 破損画像は報告して続ける
+            return f"{type(exc).__name__}: {exc}"
+
+    matrix = None
+    rows: list[Path] = []
+    errors: dict[str, str] = {}
+    partial_path = matrix_path.with_name(f".{matrix_path.stem}.partial.npy")
+    with ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start : start + batch_size]
+            decoded = list(pool.map(decode, batch_paths))
+            errors.update({path.name: item for path, item in zip(batch_paths, decoded) if isinstance(item, str)})
+            loaded = [(path, item) for path, item in zip(batch_paths, decoded) if not isinstance(item, str)]
+            if not loaded:
+                continue
+            batch = (np.stack([item for _, item in loaded]) - mean) / std
+            if settings["layout"].upper() == "NCHW":
+                batch = batch.transpose(0, 3, 1, 2)
+            output = session.run([output_name], {input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+            if output.ndim != 2:
+                raise ValueError(f"埋め込み出力 {output_name} が (batch, dim) ではありません: shape={output.shape}")
+            output = output.astype(np.float32)
+            output /= np.maximum(np.linalg.norm(output, axis=1, keepdims=True), 1e-12)
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(partial_path, mode="w+", dtype=np.float16, shape=(len(paths), output.shape[1]))
+            matrix[len(rows) : len(rows) + len(loaded)] = output
+            rows.extend(path for path, _ in loaded)
+    if matrix is None:
+        return np.zeros((0, 0), dtype=np.float16), rows, errors
+    matrix.flush()
+    if len(rows) < len(paths):
+        trimmed = np.lib.format.open_memmap(matrix_path, mode="w+", dtype=np.float16, shape=(len(rows), matrix.shape[1]))
+        for start in range(0, len(rows), EMBEDDING_COPY_ROWS):
+            stop = min(start + EMBEDDING_COPY_ROWS, len(rows))
+            trimmed[start:stop] = matrix[start:stop]
+        trimmed.flush()
+        del matrix, trimmed
+        partial_path.unlink()
+    else:
+        del matrix
+        os.replace(partial_path, matrix_path)
+    return np.load(matrix_path, mmap_mode="r"), rows, errors
+
+
+def similar_pairs(matrix: np.ndarray, threshold: float, block_size: int = 4096) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """正規化済み埋め込みで、コサイン類似度が threshold 以上のペア (i < j, 類似度)。
+
+    block_size 行ずつ float32 に戻して上三角のブロックだけ行列積を取るので、
+    作業メモリは block_size の2乗に比例し、行数には依存しない。
+    """
+    found = []
+    count = len(matrix)
+    for row_start in range(0, count, block_size):
+        rows = np.asarray(matrix[row_start : row_start + block_size], dtype=np.float32)
+        for column_start in range(row_start, count, block_size):
+            columns = np.asarray(matrix[column_start : column_start + block_size], dtype=np.float32)
+            similarity = rows @ columns.T
+            if column_start == row_start:
+                similarity[np.tril_indices_from(similarity)] = -np.inf
+            first, second = np.nonzero(similarity >= threshold)
+            found.append((first + row_start, second + column_start, similarity[first, second]))
+    if not found:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    first, second, similarity = (np.concatenate(column) for column in zip(*found))
+    return first, second, similarity
+
+
+def embedding_duplicates(image_dir: Path, output_path: Path, config: dict, workers: int | None = None) -> dict:
+    """method: embedding の重複レポート。リストは類似度の高い順に並ぶ。"""
+    settings = {**EMBEDDING_DEFAULTS, **config.get("embedding", {})}
+    if not settings.get("model"):
+        raise SystemExit("method: embedding には embedding.model (ONNXモデルのパス) が必要です")
+    model_path = Path(settings["model"])
+    if not model_path.is_absolute():
+        model_path = ROOT / model_path
+    matrix, rows, errors = compute_embeddings(
+        list_images(image_dir), model_path, output_path.with_name("embeddings.npy"), settings, workers
+    )
+    report_unreadable(errors)
+    names = [path.name for path in rows]
+    output_path.with_name("embeddings.json").write_text(
+        json.dumps({"model": str(model_path), "rows": len(names), "names": names}, ensure_ascii=False), encoding="utf-8"
+    )
+    first, second, similarity = similar_pairs(matrix, settings["threshold"], settings["block_size"])
+    # duplicates_from_pairs は距離の昇順に並べるので、コサイン距離を渡す
+    return duplicates_from_pairs(names, first, second, 1.0 - similarity.astype(np.float64))
+
+
+def report_unreadable(errors: dict[str, str]) -> None:
+    if errors:
+        print(f"警告: {len(errors)} 件の画像を読み込めませんでした")
+        for name, error in list(errors.items())[:20]:
+            print(f"  {name}: {error}")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="画像重複検出")
     parser.add_argument("--config", default=str(CONFIG_PATH))
+    parser.add_argument("--engine", choices=["native", "imagededup"], default=None, help="近傍探索の実装 (既定: 設定の engine)")
+    parser.add_argument("--image-dir", default=None, help="画像ディレクトリ (既定: 設定の image_dir)")
+    parser.add_argument("--output", default=None, help="重複レポートの出力先 (既定: 設定の output)")
+    parser.add_argument("--no-index", action="store_true", help="ハッシュ索引を使わず全画像をハッシュし直す")
+    parser.add_argument("--workers", type=int, default=None, help="ハッシュ計算のプロセス数 (既定: CPU数)")
     args = parser.parse_args()
 
-    config = load_config()
-    image_dir = ROOT / "datasets" / "lora_template" / config["image_dir"]
-    output_path = ROOT / "datasets" / "lora_template" / config["output"]
+    config = load_config(Path(args.config))
+    image_dir = Path(args.image_dir) if args.image_dir else ROOT / "datasets" / "lora_template" / config["image_dir"]
+    output_path = Path(args.output) if args.output else ROOT / "datasets" / "lora_template" / config["output"]
     output_path.parent.mkdir(parents=True, exist_ok=True)
+    native = (args.engine or config.get("engine", "native")) == "native"
+    hashing = config.get("hashing", {})
+    workers = args.workers or hashing.get("workers") or None
+    chunk_size = hashing.get("chunk_size", DEFAULT_HASH_CHUNK)
+    reduced = hashing.get("reduced_decode", True)
 
-    method_cls = get_method(config["method"])
-    engine = method_cls()
+    if config["method"] == "embedding":
+        if not native:
+            parser.error("method: embedding はネイティブ実装専用です (--engine imagededup とは併用できません)")
+        duplicates = embedding_duplicates(image_dir, output_path, config, workers)
+        output_path.write_text(json.dumps(duplicates, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Duplicate report saved to {output_path}")
+        return
 
-    encodings = engine.encode_images(image_dir=image_dir)
-    duplicates = engine.find_duplicates(
-        encoding_map=encodings,
-        max_distance_threshold=config["max_distance"]
-    )
+    if native and not args.no_index:
+        index = HashIndex(output_path.with_name(Path(config.get("index", "hash_index.sqlite")).name))
+        try:
+            version = f"{HASHER_VERSION}-reduced" if reduced else HASHER_VERSION
+            hasher = partial(hash_images, workers=workers, chunk_size=chunk_size, reduced=reduced)
+            added, removed = update_index(index, image_dir, hasher, version)
+            print(f"ハッシュ索引: {len(added)} 件をハッシュ、{len(removed)} 件を削除")
+            report_unreadable(index.failed())
+            duplicates = indexed_duplicates(index, config["method"], config["max_distance"], added)
+        finally:
+            index.close()
+        output_path.write_text(json.dumps(duplicates, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Duplicate report saved to {output_path}")
+        return
+
+    if native:
+        encodings, errors = encode_images(image_dir, config["method"], workers, chunk_size, reduced)
+        report_unreadable(errors)
+        duplicates = find_duplicates(encodings, config["max_distance"])
+    else:
+        engine = get_method(config["method"])()
+        encodings = engine.encode_images(image_dir=image_dir)
+        duplicates = engine.find_duplicates(
+            encoding_map=encodings,
+            max_distance_threshold=config["max_distance"]
+        )
 
     output_path.write_text(
         json.dumps(duplicates, ensure_ascii=False, indent=2),
@@ -1,55 +1,481 @@
 #!/usr/bin/env python3
-"""WD14/DeepDanbooruを用いたキャプション生成テンプレート。"""
+"""WD14 (ONNX) タガーによるキャプション生成スクリプト。
+
+画像を固定サイズのバッチにまとめて前処理し、バッチごとに1回だけ
+``InferenceSession.run`` を呼び出してタグを推定する。デコード (スレッドプール)、
+推論、キャプション書き込み (別スレッド) はキューでつないだパイプラインとして
+並行に動き、段ごとのスループットを最後に表示する。
+
+インクリメンタルモードでは出力先のマニフェストに画像ごとのサイズ・mtime・
+内容ハッシュと、モデル・閾値などの設定を記録し、追加・変更された画像だけを
+推論する (設定が変わった場合は全件)。画像のないキャプションは報告または削除する。
+"""
 
 import argparse
+import csv
+import hashlib
 import json
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterator
 
+import numpy as np
 import onnxruntime as ort
 from PIL import Image
 
 ROOT = Path(__file__).resolve().parents[2]
 CONFIG_PATH = ROOT / "config" / "phase4" / "caption_config.json"
+DATASET_ROOT = ROOT / "datasets" / "lora_template"
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+DEFAULT_INPUT_SIZE = 448
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_PREFETCH_BATCHES = 2
+DEFAULT_MANIFEST_NAME = ".caption_manifest.json"
+MANIFEST_VERSION = 1
+# selected_tags.csv のカテゴリ: 0=general, 4=character, 9=rating
+RATING_CATEGORY = 9
+
+
+def load_config(path: Path = CONFIG_PATH) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def load_tags(path: Path) -> tuple[list[str], np.ndarray]:
+    """selected_tags.csv (tag_id,name,category,count) を読み込む。"""
+    with Path(path).open(encoding="utf-8", newline="") as fh:
+        rows = list(csv.DictReader(fh))
+    names = [row["name"] for row in rows]
+    categories = np.array([int(row.get("category") or 0) for row in rows], dtype=np.int32)
+    return names, categories
+
+
+def create_session(model_path: Path, intra_op_threads: int = 0, inter_op_threads: int = 1) -> ort.InferenceSession:
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(str(model_path), sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def model_geometry(session: ort.InferenceSession, batch_size: int) -> tuple[int, int]:
+    """入力テンソル (N, H, W, 3) から画像サイズとバッチサイズを決める。"""
+    shape = session.get_inputs()[0].shape
+    size = shape[1] if isinstance(shape[1], int) else DEFAULT_INPUT_SIZE
+    fixed_batch = shape[0] if isinstance(shape[0], int) and shape[0] > 0 else None
+    return size, fixed_batch or batch_size
+
+
+def iter_images(input_dir: Path) -> list[Path]:
+    return sorted(
+        path for path in Path(input_dir).rglob("*") if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+
+
+def split_caption_collisions(images: list[Path], input_dir: Path) -> tuple[list[Path], list[list[Path]]]:
+    """キャプションのパスが重なる画像 (同じフォルダの a.png と a.jpg) を分ける。
+
+    どちらのキャプションを残すべきか決められないので、重なった組はすべて除外する。
+    返り値は (キャプションを書く画像, 重なった組の一覧)。
+    """
+    groups: dict[Path, list[Path]] = {}
+    for image_path in images:
+        groups.setdefault(image_path.relative_to(input_dir).with_suffix(""), []).append(image_path)
+    collisions = [group for group in groups.values() if len(group) > 1]
+    colliding = {image_path for group in collisions for image_path in group}
+    return [image_path for image_path in images if image_path not in colliding], collisions
+
+
+def load_image(image_path: Path, size: int) -> np.ndarray:
+    """白背景で正方形にパディングし、size x size の RGB uint8 配列にする。"""
+    with Image.open(image_path) as image:
+        if image.format == "JPEG":
+            # DCT 段階で 1/2〜1/8 に縮小してデコードする (size 以上は保たれる)
+            image.draft("RGB", (size, size))
+        image = image.convert("RGBA")
+        canvas = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        canvas.alpha_composite(image)
+        rgb = canvas.convert("RGB")
+    side = max(rgb.size)
+    padded = Image.new("RGB", (side, side), (255, 255, 255))
+    padded.paste(rgb, ((side - rgb.width) // 2, (side - rgb.height) // 2))
+    if side != size:
+        padded = padded.resize((size, size), Image.BICUBIC)
+    return np.asarray(padded, dtype=np.uint8)
+
+
+def preprocess_batch(images: list[np.ndarray], batch_size: int, size: int) -> np.ndarray:
+    """RGB uint8 配列を (batch_size, size, size, 3) の BGR float32 にまとめる (不足分は白で埋める)。"""
+    batch = np.full((batch_size, size, size, 3), 255, dtype=np.uint8)
+    if images:
+        batch[: len(images)] = np.stack(images)
+    return np.ascontiguousarray(batch[..., ::-1], dtype=np.float32)
+
+
+def run_inference(session: ort.InferenceSession, batch: np.ndarray) -> np.ndarray:
+    input_name = session.get_inputs()[0].name
+    output_name = session.get_outputs()[0].name
+    return session.run([output_name], {input_name: batch})[0]
+
+
+def select_tags(
+    probs: np.ndarray,
+    names: list[str],
+    threshold: float,
+    top_k: int,
+    excluded: np.ndarray | None = None,
+) -> list[list[tuple[str, float]]]:
+    """各行から threshold 以上のタグを最大 top_k 件、スコア降順で選ぶ。"""
+    probs = np.asarray(probs, dtype=np.float32)
+    if excluded is not None and excluded.any():
+        probs = np.where(excluded, -np.inf, probs)
+    k = max(1, min(top_k or probs.shape[1], probs.shape[1]))
+    candidates = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(probs, candidates, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    candidates = np.take_along_axis(candidates, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+
+    results = []
+    for row_indices, row_scores in zip(candidates, scores):
+        keep = row_scores >= threshold
+        results.append([(names[index], float(score)) for index, score in zip(row_indices[keep], row_scores[keep])])
+    return results
+
+
+def postprocess(tags: list[tuple[str, float]], settings: dict) -> str:
+    caption = ", ".join(tag for tag, _ in tags)
+    for old, new in settings.get("replace", {}).items():
+        caption = caption.replace(old, new)
+    if settings.get("lowercase"):
+        caption = caption.lower()
+    return caption
+
+
+def caption_path_for(image_path: Path, input_dir: Path, output_dir: Path) -> Path:
+    return output_dir / image_path.relative_to(input_dir).with_suffix(".txt")
+
+
+def write_caption(caption_path: Path, caption: str) -> None:
+    caption_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = caption_path.with_name(f".{caption_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(caption, encoding="utf-8")
+    tmp_path.replace(caption_path)
 
 
-def load_config() -> dict:
-    return json.loads(CONFIG_PATH.read_text(encoding="utf-8"))
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with Path(path).open("rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def run_inference(image_path: Path, session: ort.InferenceSession) -> list[tuple[str, float]]:
-    # 実運用ではモデルに合わせた前処理が必要。ここではテンプレとして疑似処理。
-    # TODO: WD14の実装に合わせた入力/出力変換を追加する。
-    return [("sample_tag", 0.9)]
+def caption_settings(model_path: Path, tags_path: Path, config: dict, size: int, excluded_categories: list[int]) -> dict:
+    """キャプションの内容を左右する設定。これが変わったら全画像を推論し直す。"""
+    model_stat = model_path.stat()
+    return {
+        "version": MANIFEST_VERSION,
+        "model": model_path.name,
+        "model_size": model_stat.st_size,
+        "model_mtime_ns": model_stat.st_mtime_ns,
+        "tags": file_digest(tags_path),
+        "input_size": size,
+        "thresholds": config["thresholds"],
+        "postprocess": config.get("postprocess", {}),
+        "exclude_categories": sorted(excluded_categories),
+    }
 
 
-def write_caption(output_dir: Path, image_path: Path, tags: list[tuple[str, float]], min_score: float) -> None:
-    caption_path = output_dir / (image_path.stem + ".txt")
-    selected = [tag for tag, score in tags if score >= min_score]
-    caption_path.write_text(", ".join(selected), encoding="utf-8")
+def load_manifest(path: Path) -> dict:
+    try:
+        manifest = json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"settings": None, "images": {}}
+    manifest.setdefault("images", {})
+    return manifest
+
+
+def save_manifest(path: Path, manifest: dict) -> None:
+    write_caption(path, json.dumps(manifest, ensure_ascii=False, sort_keys=True))
+
+
+def plan_incremental(
+    images: list[Path], input_dir: Path, output_dir: Path, manifest: dict, settings: dict
+) -> tuple[list[Path], dict[str, dict]]:
+    """推論が必要な画像と、現在の画像の (再利用可能な) マニフェスト項目を返す。
+
+    サイズと mtime が一致すればハッシュを計算せずに済ませ、違う場合だけ内容ハッシュを
+    比べる (touch やコピーで mtime だけ変わった画像は推論しない)。
+    """
+    previous = manifest["images"] if manifest.get("settings") == settings else {}
+    pending = []
+    entries = {}
+    for image_path in images:
+        key = image_path.relative_to(input_dir).as_posix()
+        stat = image_path.stat()
+        entry = previous.get(key)
+        if entry is not None and caption_path_for(image_path, input_dir, output_dir).exists():
+            if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                entries[key] = entry
+                continue
+            if entry["size"] == stat.st_size and entry["sha256"] == file_digest(image_path):
+                entries[key] = {**entry, "mtime_ns": stat.st_mtime_ns}
+                continue
+        pending.append(image_path)
+    return pending, entries
+
+
+def find_orphan_captions(images: list[Path], input_dir: Path, output_dir: Path, manifest: dict) -> dict[str, Path]:
+    """マニフェストに記録された画像のうち、画像がなくなったもののキャプション (キー順)。
+
+    このスクリプトが書いたキャプションだけを対象にするので、output_dir に手で置いた
+    .txt や他のツールの出力は消さない。
+    """
+    current = {image_path.relative_to(input_dir).as_posix() for image_path in images}
+    orphans = {}
+    for key in sorted(manifest["images"]):
+        caption_path = output_dir / Path(key).with_suffix(".txt")
+        if key not in current and caption_path.exists():
+            orphans[key] = caption_path
+    return orphans
+
+
+class StageCounter:
+    """パイプライン1段の処理件数と稼働時間 (ワーカー合計) を数える。"""
+
+    def __init__(self, name: str, workers: int = 1) -> None:
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    @property
+    def capacity(self) -> float:
+        """全ワーカーが休まず動いた場合の処理能力 (件/秒)。"""
+        return self.items * self.workers / self.busy if self.busy else float("inf")
+
+    def summary(self, wall: float) -> str:
+        utilisation = self.busy / (wall * self.workers) if wall else 0.0
+        return f"{self.name}: {self.items} 件, 処理能力 {self.capacity:.1f} 件/秒, 稼働率 {utilisation:.0%}"
+
+
+def prefetch_images(
+    paths: list[Path], size: int, executor: ThreadPoolExecutor, depth: int, counter: StageCounter
+) -> Iterator[tuple[Path, np.ndarray | None]]:
+    """最大 depth 枚を先読みしながら、入力順に (パス, 画像) を返す。読めない画像は None。"""
+
+    def decode(path: Path) -> np.ndarray | None:
+        started = time.perf_counter()
+        try:
+            return load_image(path, size)
+        except (OSError, ValueError) as exc:
+            print(f"警告: {path} を読み込めません: {exc}")
+            return None
+        finally:
+            counter.add(1, time.perf_counter() - started)
+
+    pending: deque[tuple[Path, Future]] = deque()
+    queued = iter(paths)
+    for path in queued:
+        pending.append((path, executor.submit(decode, path)))
+        if len(pending) >= depth:
+            break
+    while pending:
+        path, future = pending.popleft()
+        next_path = next(queued, None)
+        if next_path is not None:
+            pending.append((next_path, executor.submit(decode, next_path)))
+        yield path, future.result()
+
+
+def caption_images(
+    session: ort.InferenceSession,
+    paths: list[Path],
+    caption_path: Callable[[Path], Path],
+    names: list[str],
+    size: int,
+    batch_size: int,
+    threshold: float,
+    top_k: int,
+    settings: dict,
+    excluded: np.ndarray | None = None,
+    decode_workers: int | None = None,
+    prefetch_batches: int = DEFAULT_PREFETCH_BATCHES,
+    on_written: Callable[[Path, str], None] | None = None,
+) -> dict[str, StageCounter]:
+    """デコード → 推論 → 書き込みを並行に流し、段ごとのカウンタを返す。
+
+    デコードは decode_workers 本のスレッドで prefetch_batches バッチ分だけ先読みし、
+    推論は満杯のバッチ (最後だけ不足分を白で埋める) を受け取る。書き込みは専用
+    スレッドで行い、未完了のバッチが prefetch_batches を超えたら待つ。
+    """
+
+    workers = decode_workers or os.cpu_count() or 1
+    counters = {
+        "decode": StageCounter("decode", workers),
+        "inference": StageCounter("inference"),
+        "write": StageCounter("write"),
+    }
+
+    def write_batch(results: list[tuple[Path, str]]) -> None:
+        started = time.perf_counter()
+        for image_path, caption in results:
+            write_caption(caption_path(image_path), caption)
+            if on_written is not None:
+                on_written(image_path, caption)
+        counters["write"].add(len(results), time.perf_counter() - started)
+
+    def flush(batch_paths: list[Path], batch_images: list[np.ndarray]) -> None:
+        started = time.perf_counter()
+        probs = run_inference(session, preprocess_batch(batch_images, batch_size, size))
+        selected = select_tags(probs[: len(batch_paths)], names, threshold, top_k, excluded)
+        counters["inference"].add(len(batch_paths), time.perf_counter() - started)
+        while len(writes) >= max(prefetch_batches, 1):
+            writes.popleft().result()
+        results = [(path, postprocess(tags, settings)) for path, tags in zip(batch_paths, selected)]
+        writes.append(writer.submit(write_batch, results))
+
+    writes: deque[Future] = deque()
+    batch_paths: list[Path] = []
+    batch_images: list[np.ndarray] = []
+    with ThreadPoolExecutor(workers, thread_name_prefix="caption-decode") as decoder, ThreadPoolExecutor(
+        1, thread_name_prefix="caption-write"
+    ) as writer:
+        depth = max(prefetch_batches, 1) * batch_size
+        for done, (path, image) in enumerate(prefetch_images(paths, size, decoder, depth, counters["decode"]), 1):
+            if image is not None:
+                batch_paths.append(path)
+                batch_images.append(image)
+            if len(batch_paths) == batch_size:
+                flush(batch_paths, batch_images)
+                batch_paths, batch_images = [], []
+                print(f"Generated captions for {done}/{len(paths)} images")
+        if batch_paths:
+            flush(batch_paths, batch_images)
+        for future in writes:
+            future.result()
+    return counters
 
 
 def main() -> None:
-    parser = argparse.ArgumentParser(description="自動キャプション生成テンプレ")
+    parser = argparse.ArgumentParser(description="WD14タガーによる自動キャプション生成")
     parser.add_argument("--config", default=str(CONFIG_PATH))
     parser.add_argument("--model", required=False, help="ONNXモデルへのパス")
+    parser.add_argument("--tags", default=None, help="selected_tags.csv (既定: モデルと同じディレクトリ)")
+    parser.add_argument("--input-dir", default=None, help="画像ディレクトリ (既定: 設定の input_dir)")
+    parser.add_argument("--output-dir", default=None, help="キャプション出力先 (既定: 設定の output_dir)")
+    parser.add_argument("--batch-size", type=int, default=None, help="1回の推論でまとめる画像数")
+    parser.add_argument("--intra-op-threads", type=int, default=None, help="ONNX Runtime の演算内スレッド数 (0=自動)")
+    parser.add_argument("--inter-op-threads", type=int, default=None, help="ONNX Runtime の演算間スレッド数")
+    parser.add_argument("--decode-workers", type=int, default=None, help="画像デコードのスレッド数 (既定: CPU数)")
+    parser.add_argument("--prefetch-batches", type=int, default=None, help="先読み・書き込み待ちを許すバッチ数")
+    parser.add_argument("--full", action="store_true", help="マニフェストを無視して全画像を推論する")
+    parser.add_argument("--prune-orphans", action="store_true", help="画像のないキャプションを削除する")
     args = parser.parse_args()
 
-    config = load_config()
-    input_dir = ROOT / "datasets" / "lora_template" / config["input_dir"]
-    output_dir = ROOT / "datasets" / "lora_template" / config["output_dir"]
+    config = load_config(Path(args.config))
+    inference = config.get("inference", {})
+    input_dir = Path(args.input_dir) if args.input_dir else DATASET_ROOT / config["input_dir"]
+    output_dir = Path(args.output_dir) if args.output_dir else DATASET_ROOT / config["output_dir"]
     output_dir.mkdir(parents=True, exist_ok=True)
+    threshold = config["thresholds"]["min_score"]
+    top_k = config["thresholds"].get("top_k", 0)
 
-    session = None
-    if args.model:
-        session = ort.InferenceSession(args.model)
+    all_images = iter_images(input_dir)
+    images, collisions = split_caption_collisions(all_images, input_dir)
+    if collisions:
+        print(f"同じキャプションファイルに書き込む画像が {len(collisions)} 組あるためスキップしました (名前を変えてください)")
+        for group in collisions[:20]:
+            print("  " + ", ".join(str(image_path.relative_to(input_dir)) for image_path in group))
+    if not args.model:
+        for image_path in images:
+            write_caption(caption_path_for(image_path, input_dir, output_dir), "placeholder")
+        print(f"--model 未指定のため {len(images)} 件にプレースホルダを書き込みました")
+        return
 
-    threshold = config["thresholds"]["min_score"]
+    model_path = Path(args.model)
+    tags_path = Path(args.tags) if args.tags else model_path.with_name("selected_tags.csv")
+    names, categories = load_tags(tags_path)
+    excluded_categories = inference.get("exclude_categories", [RATING_CATEGORY])
+    excluded = np.isin(categories, excluded_categories)
+    session = create_session(
+        model_path,
+        intra_op_threads=args.intra_op_threads if args.intra_op_threads is not None else inference.get("intra_op_threads", 0),
+        inter_op_threads=args.inter_op_threads if args.inter_op_threads is not None else inference.get("inter_op_threads", 1),
+    )
+    size, batch_size = model_geometry(session, args.batch_size or inference.get("batch_size", DEFAULT_BATCH_SIZE))
+
+    incremental = config.get("incremental", {})
+    manifest_path = output_dir / incremental.get("manifest", DEFAULT_MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    # スキップした画像も存在はするので、そのキャプションは孤立扱いにしない
+    orphans = find_orphan_captions(all_images, input_dir, output_dir, manifest)
+    # 削除しなかった孤立キャプションは次回も対象にできるようマニフェストに残す
+    kept_orphans: dict[str, dict] = {}
+    if orphans:
+        action = "削除" if args.prune_orphans or incremental.get("prune_orphans") else "検出"
+        print(f"画像のないキャプションを {len(orphans)} 件{action}しました")
+        for orphan in list(orphans.values())[:20]:
+            print(f"  {orphan.relative_to(output_dir)}")
+        if action == "削除":
+            for orphan in orphans.values():
+                orphan.unlink()
+        else:
+            kept_orphans = {key: manifest["images"][key] for key in orphans}
+
+    started = time.perf_counter()
+    settings = caption_settings(model_path, tags_path, config, size, excluded_categories)
+    entries: dict[str, dict] = {}
+    pending = images
+    if incremental.get("enabled", True) and not args.full:
+        pending, entries = plan_incremental(images, input_dir, output_dir, manifest, settings)
+        print(f"{len(images) - len(pending)} 件は変更なし、{len(pending)} 件を推論します")
+
+    def record(image_path: Path, caption: str) -> None:
+        stat = image_path.stat()
+        entries[image_path.relative_to(input_dir).as_posix()] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_digest(image_path),
+        }
 
-    for image_path in input_dir.glob("*.png"):
-        tags = run_inference(image_path, session) if session else [("placeholder", 1.0)]
-        write_caption(output_dir, image_path, tags, threshold)
-        print(f"Generated caption for {image_path.name}")
+    try:
+        counters = caption_images(
+            session,
+            pending,
+            lambda image_path: caption_path_for(image_path, input_dir, output_dir),
+            names,
+            size,
+            batch_size,
+            threshold,
+            top_k,
+            config.get("postprocess", {}),
+            excluded=excluded,
+            decode_workers=args.decode_workers or inference.get("decode_workers"),
+            prefetch_batches=args.prefetch_batches or inference.get("prefetch_batches", DEFAULT_PREFETCH_BATCHES),
+            on_written=record,
+        )
+    finally:
+        # 中断されても書き込み済みの分は次回スキップできるよう保存する
+        save_manifest(manifest_path, {"settings": settings, "images": {**kept_orphans, **entries}})
+    wall = time.perf_counter() - started
+    print(f"{counters['write'].items}/{len(pending)} 件のキャプションを {wall:.1f} 秒で生成しました")
+    for counter in counters.values():
+        print("  " + counter.summary(wall))
+    if counters["write"].items:
+        print(f"  ボトルネック: {min(counters.values(), key=lambda counter: counter.capacity).name}")
 
 
 if __name__ == "__main__":
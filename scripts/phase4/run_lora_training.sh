@@ -10,14 +10,17 @@ VENV="/opt/ai/venvs/base"
 
 function usage() {
   cat <<USAGE
-Usage: $0 [--dataset PATH] [--remote]
+Usage: $0 [--dataset PATH] [--where COLUMN=VALUE]... [--remote]
   --dataset PATH    学習データセットのルート (default: $DATASET_ROOT)
+  --where EXPR      台帳ストアで画像を絞り込む (例: usage=training, commercial_ok=true)
+                    絞り込んだ画像は \$DATASET/selected にリンクして学習に使う
   --remote          リモート実行用設定を有効化 (rsync前提)
 USAGE
 }
 
 DATASET="$DATASET_ROOT"
 REMOTE=false
+WHERE=()
 
 while [[ $# -gt 0 ]]; do
   case "$1" in
@@ -25,6 +28,10 @@ while [[ $# -gt 0 ]]; do
       shift
       DATASET="$1"
       ;;
+    --where)
+      shift
+      WHERE+=(--where "$1")
+      ;;
     --remote)
       REMOTE=true
       ;;
@@ -49,9 +56,18 @@ fi
 source "$VENV/bin/activate"
 mkdir -p "$OUTPUT_DIR"
 
+TRAIN_DIR="$DATASET/images"
+if [[ ${#WHERE[@]} -gt 0 ]]; then
+  # 台帳ストア (SQLite) の索引で条件に合う画像だけを選び、captions/ のキャプションと一緒にシンボリックリンクで渡す
+  TRAIN_DIR="$DATASET/selected"
+  python "$ROOT/scripts/phase5/ledger_store.py" \
+    --store "$DATASET/reports/ledger.sqlite" --images "$DATASET/images" \
+    query "${WHERE[@]}" --present --link-dir "$TRAIN_DIR" --captions "$DATASET/captions"
+fi
+
 python train_network.py \
   --pretrained_model_name_or_path "$MODEL_PATH" \
-  --train_data_dir "$DATASET/images" \
+  --train_data_dir "$TRAIN_DIR" \
   --caption_extension ".txt" \
   --resolution "1024,1024" \
   --output_dir "$OUTPUT_DIR" \
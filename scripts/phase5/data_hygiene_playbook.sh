@@ -18,8 +18,16 @@ codex run --agent Zen --task "品質ゲート失敗時の復旧フローをIf-Th
 pushd "$ROOT" >/dev/null
 python scripts/phase4/generate_captions.py
 python scripts/phase4/dedup_images.py
+# リーク検出はレポートを残す段階として最後まで進め、結果は末尾のゲートで判定する
+LEAKAGE_STATUS=0
+python scripts/phase5/scan_leakage.py || LEAKAGE_STATUS=$?
 python scripts/phase5/validate_ledger.py --ledger config/phase4/dataset_ledger.csv
 popd >/dev/null
 
 # TODOジェネレータで残タスクを整形
 python "$ROOT/scripts/phase5/generate_todo.py" --playbook "$PLAYBOOK_JSON"
+
+if [[ $LEAKAGE_STATUS -ne 0 ]]; then
+  echo "分割間・生成物の近似重複リークがあります (datasets/lora_template/reports/leakage.json)" >&2
+  exit "$LEAKAGE_STATUS"
+fi
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""データ台帳 (dataset_ledger.csv) を SQLite に取り込み、画像ディレクトリと突き合わせる。
+
+台帳は ``image_id`` を主キーに、``license`` / ``usage`` / ``commercial_ok`` に索引を張った
+``ledger`` テーブルへ取り込む。再取り込みは CSV のサイズと mtime が変わったときだけ行い、
+保存済みの行と比べて追加・変更された行だけを upsert し、CSVから消えた行を削除する。
+
+``reconcile`` は画像ディレクトリを1回だけ走査して ``images`` テーブルを更新し、
+台帳にない画像と、画像が存在しない台帳行を SQL の結合で求める。``query`` は
+``--where usage=training`` のような条件で行を絞り込み、学習用にシンボリックリンクの
+ディレクトリを作ることもできる。
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+LEDGER_DEFAULT = ROOT / "config" / "phase4" / "dataset_ledger.csv"
+IMAGES_DEFAULT = ROOT / "datasets" / "lora_template" / "images"
+CAPTION_CONFIG = ROOT / "config" / "phase4" / "caption_config.json"
+STORE_DEFAULT = ROOT / "datasets" / "lora_template" / "reports" / "ledger.sqlite"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+# 取り込み前から存在するカラム。値の比較は大文字小文字を区別しない
+BASE_COLUMNS = ["source", "license", "usage", "commercial_ok", "credit_required", "notes", "personal_data"]
+NOCASE_COLUMNS = {"license", "usage", "commercial_ok", "credit_required", "personal_data"}
+INDEXED_COLUMNS = ["license", "usage", "commercial_ok"]
+COLUMN_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def quote(column: str) -> str:
+    if not COLUMN_NAME.match(column):
+        raise ValueError(f"invalid ledger column name: {column!r}")
+    return f'"{column}"'
+
+
+def scan_images(image_dir: Path) -> dict[str, tuple[str, int, int]]:
+    """画像ディレクトリを os.scandir で1回だけ再帰的に走査する。
+
+    {image_dir からの相対パス: (image_id (= stem), サイズ, mtime_ns)} を返す。
+    """
+    image_dir = Path(image_dir)
+    files = {}
+    stack = [(image_dir, "")]
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((Path(entry.path), f"{prefix}{entry.name}/"))
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    stat = entry.stat()
+                    files[f"{prefix}{entry.name}"] = (os.path.splitext(entry.name)[0], stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class LedgerStore:
+    """台帳の行 (ledger) と画像ディレクトリの状態 (images) を保持する SQLite ストア。"""
+
+    def __init__(self, path: Path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(
+                f"{quote(column)} TEXT" + (" COLLATE NOCASE" if column in NOCASE_COLUMNS else "") for column in BASE_COLUMNS
+            )
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS ledger (image_id TEXT PRIMARY KEY, csv_line INTEGER, {columns})")
+            for column in INDEXED_COLUMNS:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS ledger_{column} ON ledger ({quote(column)})")
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS images (
+                    path TEXT PRIMARY KEY,
+                    image_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL
+                )"""
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS images_image_id ON images (image_id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def get_meta(self, key: str) -> str | None:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def columns(self) -> list[str]:
+        """image_id と台帳のカラム (取り込んだCSVにしかないカラムを含む)。"""
+        return [row[1] for row in self.db.execute("PRAGMA table_info(ledger)") if row[1] != "csv_line"]
+
+    def _ensure_columns(self, header: list[str]) -> None:
+        known = set(self.columns())
+        with self.db:
+            for column in header:
+                if column not in known:
+                    self.db.execute(f"ALTER TABLE ledger ADD COLUMN {quote(column)} TEXT")
+
+    def _read_csv(self, path: Path) -> tuple[list[str], dict[str, tuple[int, list[str]]]]:
+        """(ヘッダ, {image_id: (開始行番号, 値)})。同じ image_id は後の行で上書きする。"""
+        with Path(path).open(encoding="utf-8", newline="") as fh:
+            reader = csv.reader(fh)
+            header = [name.strip() for name in next(reader, [])]
+            if "image_id" not in header:
+                raise ValueError(f"ledger has no image_id column: {path}")
+            key = header.index("image_id")
+            rows = {}
+            start = reader.line_num + 1
+            for row in reader:
+                values = [value.strip() for value in row] + [""] * (len(header) - len(row))
+                if row and values[key]:
+                    rows[values[key]] = (start, values[: len(header)])
+                start = reader.line_num + 1
+        return header, rows
+
+    def _write(self, header: list[str], rows: dict[str, tuple[int, list[str]]]) -> dict[str, int]:
+        """CSVの行と保存済みの行を比べ、追加・変更・削除された行だけを書き込む。
+
+        CSVにないカラムは空文字として扱うので、ヘッダから消えたカラムの値も残らない。
+        """
+        self._ensure_columns(header)
+        absent = [column for column in self.columns() if column not in header]
+        header = header + absent
+        rows = {image_id: (line, values + [""] * len(absent)) for image_id, (line, values) in rows.items()}
+        selected = ", ".join(quote(column) for column in header)
+        known = {
+            row[0]: (row[1], list(row[2:]))
+            for row in self.db.execute(f"SELECT image_id, csv_line, {selected} FROM ledger")
+        }
+        added, updated, moved = [], [], []
+        for image_id, (line, values) in rows.items():
+            previous = known.get(image_id)
+            if previous is None:
+                added.append((line, values))
+            elif [value or "" for value in previous[1]] != values:
+                updated.append((line, values))
+            elif previous[0] != line:
+                moved.append((line, image_id))
+        removed = [image_id for image_id in known if image_id not in rows]
+
+        assignments = ", ".join(f"{quote(column)} = excluded.{quote(column)}" for column in header if column != "image_id")
+        upsert = (
+            f"INSERT INTO ledger (csv_line, {selected}) VALUES (?{', ?' * len(header)}) "
+            f"ON CONFLICT (image_id) DO UPDATE SET csv_line = excluded.csv_line"
+            + (f", {assignments}" if assignments else "")
+        )
+        with self.db:
+            self.db.executemany(upsert, [(line, *values) for line, values in added + updated])
+            self.db.executemany("UPDATE ledger SET csv_line = ? WHERE image_id = ?", moved)
+            self.db.executemany("DELETE FROM ledger WHERE image_id = ?", [(image_id,) for image_id in removed])
+        return {"rows": len(rows), "added": len(added), "updated": len(updated), "removed": len(removed)}
+
+    def import_csv(self, path: Path, force: bool = False) -> dict[str, int] | None:
+        """台帳CSVを取り込み、前回との差分だけを書き込む。CSVが前回から変わっていなければ None。"""
+        path = Path(path)
+        stat = path.stat()
+        signature = json.dumps({"path": str(path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        if not force and self.get_meta("ledger_csv") == signature:
+            return None
+        header, rows = self._read_csv(path)
+        counts = self._write(header, rows)
+        self.set_meta("ledger_csv", signature)
+        return counts
+
+    def reconcile(self, image_dir: Path) -> dict:
+        """画像ディレクトリを1回走査して images を更新し、台帳との食い違いを返す。"""
+        files = scan_images(image_dir)
+        known = {path: (image_id, size, mtime_ns) for path, image_id, size, mtime_ns in self.db.execute("SELECT * FROM images")}
+        with self.db:
+            self.db.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in known if path not in files])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO images (path, image_id, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                [(path, *state) for path, state in files.items() if known.get(path) != state],
+            )
+        self.set_meta("images_root", str(Path(image_dir).resolve()))
+        unregistered = self.db.execute(
+            "SELECT images.path FROM images LEFT JOIN ledger ON ledger.image_id = images.image_id "
+            "WHERE ledger.image_id IS NULL ORDER BY images.path"
+        ).fetchall()
+        missing = self.db.execute(
+            "SELECT image_id, csv_line FROM ledger WHERE NOT EXISTS "
+            "(SELECT 1 FROM images WHERE images.image_id = ledger.image_id) ORDER BY csv_line, image_id"
+        ).fetchall()
+        shared = self.db.execute(
+            "SELECT image_id, group_concat(path, '\n') FROM images GROUP BY image_id HAVING count(*) > 1 ORDER BY image_id"
+        ).fetchall()
+        return {
+            "images": len(files),
+            "unregistered": [path for (path,) in unregistered],
+            "missing": [{"image_id": image_id, "line": line} for image_id, line in missing],
+            "shared_ids": {image_id: sorted(paths.split("\n")) for image_id, paths in shared},
+        }
+
+    def select(self, where: dict[str, list[str]] | None = None, present: bool | None = None) -> list[dict]:
+        """条件に合う台帳行を image_id 順に返す。
+
+        where は {カラム: 許可値のリスト} (カラム同士は AND)。present が True なら画像が
+        あるもの、False なら無いものに絞る。各行の path は images 上の最初のパス。
+        """
+        columns = self.columns()
+        clauses, params = [], []
+        for column, values in (where or {}).items():
+            if column not in columns:
+                raise ValueError(f"unknown ledger column: {column}")
+            clauses.append(f"ledger.{quote(column)} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        if present is not None:
+            clauses.append(("" if present else "NOT ") + "EXISTS (SELECT 1 FROM images WHERE images.image_id = ledger.image_id)")
+        sql = (
+            f"SELECT csv_line, {', '.join('ledger.' + quote(column) for column in columns)}, "
+            "(SELECT min(path) FROM images WHERE images.image_id = ledger.image_id) FROM ledger"
+            + (" WHERE " + " AND ".join(clauses) if clauses else "")
+            + " ORDER BY ledger.image_id"
+        )
+        return [
+            {"line": row[0], **dict(zip(columns, row[1:-1])), "path": row[-1]}
+            for row in self.db.execute(sql, params)
+        ]
+
+
+def parse_where(expressions: list[str]) -> dict[str, list[str]]:
+    """["usage=training,validation", "commercial_ok=true"] -> {カラム: 値のリスト}。"""
+    where: dict[str, list[str]] = {}
+    for expression in expressions:
+        column, separator, values = expression.partition("=")
+        if not separator or not column.strip():
+            raise ValueError(f"expected COLUMN=VALUE[,VALUE...]: {expression!r}")
+        where.setdefault(column.strip(), []).extend(value.strip() for value in values.split(","))
+    return where
+
+
+def caption_dir_for(image_dir: Path, config_path: Path = CAPTION_CONFIG) -> Path:
+    """generate_captions.py の出力先。output_dir は input_dir と同じくデータセットのルート基準。"""
+    config = json.loads(config_path.read_text(encoding="utf-8"))
+    return image_dir.parent / config["output_dir"]
+
+
+def link_selection(rows: list[dict], image_dir: Path, link_dir: Path, caption_dir: Path) -> int:
+    """選ばれた画像と、caption_dir にある同じ相対パスのキャプション (.txt) への
+    シンボリックリンクで link_dir を作り直す。
+
+    リンクは image_dir からの相対パスをそのまま再現するので、別のサブディレクトリにある
+    同名の画像はぶつからない。同じディレクトリで拡張子だけが違う画像 (x.png と x.jpg) は
+    キャプション x.txt を共有してしまうため、link_dir に触れる前に一覧を付けて ValueError にする。
+    """
+    owners: dict[Path, list[str]] = {}
+    for row in rows:
+        if row["path"]:
+            owners.setdefault(Path(row["path"]).with_suffix(""), []).append(row["path"])
+    clashes = sorted(paths for paths in owners.values() if len(paths) > 1)
+    if clashes:
+        listed = "; ".join(", ".join(sorted(paths)) for paths in clashes)
+        raise ValueError(f"拡張子だけが違う画像がキャプションを共有します ({len(clashes)} 組): {listed}")
+
+    link_dir.mkdir(parents=True, exist_ok=True)
+    for entry in sorted(link_dir.rglob("*"), reverse=True):
+        if entry.is_symlink():
+            entry.unlink()
+        elif entry.is_dir() and not any(entry.iterdir()):
+            entry.rmdir()
+    linked = 0
+    for row in rows:
+        if not row["path"]:
+            continue
+        relative = Path(row["path"])
+        image = (image_dir / relative).resolve()
+        caption = caption_dir / relative.with_suffix(".txt")
+        (link_dir / relative).parent.mkdir(parents=True, exist_ok=True)
+        if image.exists():
+            (link_dir / relative).symlink_to(image)
+        if caption.exists():
+            (link_dir / relative.with_suffix(".txt")).symlink_to(caption.resolve())
+        linked += 1
+    return linked
+
+
+def open_store(args) -> LedgerStore:
+    store = LedgerStore(Path(args.store))
+    counts = store.import_csv(Path(args.ledger), force=getattr(args, "force", False))
+    if counts is not None:
+        print(
+            f"ledger: {counts['rows']} rows (added {counts['added']}, updated {counts['updated']}, removed {counts['removed']})",
+            file=sys.stderr,
+        )
+    return store
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="データ台帳のSQLiteストア")
+    parser.add_argument("--store", default=str(STORE_DEFAULT), help="SQLite ストアのパス")
+    parser.add_argument("--ledger", default=str(LEDGER_DEFAULT))
+    parser.add_argument("--images", default=str(IMAGES_DEFAULT), help="突き合わせる画像ディレクトリ")
+    commands = parser.add_subparsers(dest="command", required=True)
+    imported = commands.add_parser("import", help="台帳CSVを差分で取り込む")
+    imported.add_argument("--force", action="store_true", help="CSVのサイズとmtimeが同じでも比較し直す")
+    reconcile = commands.add_parser("reconcile", help="画像ディレクトリと台帳を突き合わせる")
+    reconcile.add_argument("--output", default=None, help="結果のJSONの保存先")
+    query = commands.add_parser("query", help="条件で台帳行を絞り込む")
+    query.add_argument("--where", action="append", default=[], help="COLUMN=VALUE[,VALUE...] (複数指定はAND)")
+    presence = query.add_mutually_exclusive_group()
+    presence.add_argument("--present", dest="present", action="store_true", default=None, help="画像がある行だけ")
+    presence.add_argument("--absent", dest="present", action="store_false", help="画像が無い行だけ")
+    query.add_argument("--format", choices=["ids", "paths", "jsonl"], default="ids", help="出力形式")
+    query.add_argument("--link-dir", default=None, help="選ばれた画像とキャプションへのシンボリックリンクを作るディレクトリ")
+    query.add_argument("--captions", default=None, help="キャプションのディレクトリ (既定: caption_config.json の output_dir)")
+    args = parser.parse_args()
+
+    store = open_store(args)
+    image_dir = Path(args.images)
+    try:
+        if args.command == "reconcile":
+            report = store.reconcile(image_dir)
+            if args.output:
+                Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+            for path in report["unregistered"]:
+                print(f"UNREGISTERED {path}")
+            for row in report["missing"]:
+                print(f"MISSING {row['image_id']} (line {row['line']})")
+            print(f"{report['images']} images, {len(report['unregistered'])} unregistered, {len(report['missing'])} missing")
+            sys.exit(1 if report["unregistered"] or report["missing"] else 0)
+        elif args.command == "query":
+            if args.present is not None or args.link_dir or args.format == "paths":
+                store.reconcile(image_dir)
+            rows = store.select(parse_where(args.where), args.present)
+            if args.link_dir:
+                caption_dir = Path(args.captions) if args.captions else caption_dir_for(image_dir)
+                try:
+                    linked = link_selection(rows, image_dir, Path(args.link_dir), caption_dir)
+                except ValueError as error:
+                    sys.exit(f"✖ {error}")
+                print(f"{linked} images linked into {args.link_dir}", file=sys.stderr)
+            for row in rows:
+                if args.format == "jsonl":
+                    print(json.dumps(row, ensure_ascii=False))
+                elif args.format == "paths":
+                    if row["path"]:
+                        print(image_dir / row["path"])
+                else:
+                    print(row["image_id"])
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""train/validation/test 間と生成物 (outputs/) からの近似重複リークを検出する。
+
+``datasets/*/images`` と ``outputs/`` の画像を1つのハッシュ索引 (dedup_images.py の
+SQLite 索引) にまとめ、多重インデックスハッシュで近傍ペアを求めてクラスタにする。
+各画像はファイル名の stem を image_id としてデータ台帳の ``usage`` と突き合わせ、
+生成物は ``generated``、台帳にない画像は ``unregistered`` として扱う。
+複数の分割 (unregistered を除く) にまたがるクラスタをリークとして報告する。
+"""
+
+import argparse
+import csv
+import json
+import sys
+from collections import Counter
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT / "scripts" / "phase4"))
+
+from dedup_images import (  # noqa: E402
+    HASHER_VERSION,
+    HashIndex,
+    hash_images,
+    indexed_pairs,
+    load_config as load_dedup_config,
+    sync_index,
+)
+
+LEDGER_DEFAULT = ROOT / "config" / "phase4" / "dataset_ledger.csv"
+REPORT_DEFAULT = ROOT / "datasets" / "lora_template" / "reports" / "leakage.json"
+DEFAULT_ROOTS = ["datasets/*/images", "outputs"]
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+# dedup_images.py の既定 (縮小デコード) と同じハッシュ方式
+INDEX_VERSION = f"{HASHER_VERSION}-reduced"
+GENERATED = "generated"
+UNREGISTERED = "unregistered"
+
+
+def collect_images(root: Path, patterns: list[str]) -> dict[str, Path]:
+    """root からの相対パス (POSIX) をキーに、各パターン配下の画像を再帰的に集める。"""
+    files = {}
+    for pattern in patterns:
+        for directory in sorted(root.glob(pattern)):
+            if not directory.is_dir():
+                continue
+            for path in sorted(directory.rglob("*")):
+                if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS and not path.name.startswith("."):
+                    files[path.relative_to(root).as_posix()] = path
+    return files
+
+
+def load_usage(ledger_path: Path) -> dict[str, str]:
+    """image_id -> usage (小文字)。"""
+    with Path(ledger_path).open(encoding="utf-8", newline="") as fh:
+        return {
+            row["image_id"].strip(): (row.get("usage") or "").strip().lower() or UNREGISTERED
+            for row in csv.DictReader(fh)
+            if row.get("image_id")
+        }
+
+
+def split_of(name: str, usage: dict[str, str]) -> str:
+    if name.startswith("outputs/"):
+        return GENERATED
+    return usage.get(Path(name).stem, UNREGISTERED)
+
+
+def clusters_from_pairs(count: int, first: np.ndarray, second: np.ndarray) -> list[list[int]]:
+    """ペアを辺とする連結成分 (要素2以上) を、Union-Find で求める。"""
+    parent = np.arange(count)
+
+    def find(item: int) -> int:
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for a, b in zip(first.tolist(), second.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    members: dict[int, list[int]] = {}
+    for item in sorted(set(first.tolist()) | set(second.tolist())):
+        members.setdefault(find(item), []).append(item)
+    return list(members.values())
+
+
+def scan_leakage(
+    root: Path,
+    ledger_path: Path,
+    index_path: Path,
+    patterns: list[str] = DEFAULT_ROOTS,
+    method: str = "phash",
+    max_distance: int = 6,
+    hasher=hash_images,
+    version: str = INDEX_VERSION,
+) -> dict:
+    """分割をまたぐ近似重複クラスタのレポートを作る。"""
+    index = HashIndex(index_path)
+    try:
+        added, removed = sync_index(index, collect_images(root, patterns), hasher, version)
+        failed = index.failed()
+        names, first, second, distances = indexed_pairs(index, method, max_distance, added)
+    finally:
+        index.close()
+
+    usage = load_usage(ledger_path)
+    splits = [split_of(name, usage) for name in names]
+    clusters = clusters_from_pairs(len(names), first, second)
+    cluster_of = {item: number for number, members in enumerate(clusters) for item in members}
+    widest = Counter()
+    for a, distance in zip(first.tolist(), distances.tolist()):
+        widest[cluster_of[a]] = max(widest[cluster_of[a]], distance)
+    leaks = []
+    for number, members in enumerate(clusters):
+        labels = sorted({splits[item] for item in members} - {UNREGISTERED})
+        if len(labels) < 2:
+            continue
+        leaks.append(
+            {
+                "splits": labels,
+                "max_distance": widest[number],
+                "members": [
+                    {"path": names[item], "image_id": Path(names[item]).stem, "split": splits[item]} for item in members
+                ],
+            }
+        )
+    leaks.sort(key=lambda leak: (leak["splits"], leak["members"][0]["path"]))
+    return {
+        "summary": {
+            "images": len(names),
+            "hashed": len(added),
+            "removed": len(removed),
+            "unreadable": len(failed),
+            "near_duplicate_pairs": len(first),
+            "leaking_clusters": len(leaks),
+            "by_splits": dict(Counter("/".join(leak["splits"]) for leak in leaks)),
+            "images_per_split": dict(Counter(splits)),
+        },
+        "clusters": leaks,
+        "unreadable": failed,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="分割間・生成物の近似重複リーク検出")
+    parser.add_argument("--ledger", default=str(LEDGER_DEFAULT))
+    parser.add_argument("--roots", nargs="+", default=DEFAULT_ROOTS, help="リポジトリ直下からの画像ディレクトリ (glob可)")
+    parser.add_argument("--output", default=str(REPORT_DEFAULT))
+    parser.add_argument("--index", default=None, help="ハッシュ索引 (既定: レポートと同じディレクトリの leakage_index.sqlite)")
+    parser.add_argument("--method", default=None, help="phash / ahash / dhash (既定: dedup_config の method)")
+    parser.add_argument("--max-distance", type=int, default=None, help="近似重複とみなすハミング距離 (既定: dedup_config)")
+    parser.add_argument("--workers", type=int, default=None, help="ハッシュ計算のプロセス数")
+    args = parser.parse_args()
+
+    dedup_config = load_dedup_config()
+    method = args.method or dedup_config["method"]
+    if method not in ("phash", "ahash", "dhash"):
+        method = "phash"
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    report = scan_leakage(
+        ROOT,
+        Path(args.ledger),
+        Path(args.index) if args.index else output_path.with_name("leakage_index.sqlite"),
+        args.roots,
+        method,
+        args.max_distance if args.max_distance is not None else dedup_config["max_distance"],
+        hasher=partial(hash_images, workers=args.workers),
+    )
+    output_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    summary = report["summary"]
+    print(f"{summary['images']} 枚 (新規/変更 {summary['hashed']} 枚) から近似重複ペア {summary['near_duplicate_pairs']} 件")
+    for cluster in report["clusters"][:20]:
+        paths = ", ".join(member["path"] for member in cluster["members"][:4])
+        print(f"LEAK [{'/'.join(cluster['splits'])}] {paths}")
+    print(f"Leakage report saved to {output_path}")
+    sys.exit(1 if report["clusters"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,333 @@
 #!/usr/bin/env python3
-"""データ台帳CSVを検証し、欠落や不正値を報告するユーティリティ。"""
+"""データ台帳CSVを検証し、欠落や不正値を報告するユーティリティ。
+
+ルール (``ledger_rules.json``) はヘッダに対して一度だけコンパイルし、許可値は集合で
+引く。CSV はチャンク単位でストリーミングし、``--workers`` を指定するとチャンクを
+プロセスプールで並列に検証する。違反には ``severity`` の重大度を付け、テキスト・
+JSON Lines・SARIF で出力する。メモリに保持する違反は ``--max-violations`` 件までで、
+件数の集計 (ルール・重大度・カラムごと) は常に全件を数える。
+
+``--images`` を指定すると ledger_store.py の SQLite ストアに台帳を差分で取り込み、
+画像ディレクトリと突き合わせて、画像の無い行と台帳に無い画像も違反として報告する。
+"""
 
 import argparse
 import csv
 import json
 import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterator, TextIO
 
 ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT / "scripts" / "phase5"))
+
+from ledger_store import STORE_DEFAULT, LedgerStore  # noqa: E402
+
 RULES_PATH = ROOT / "config" / "phase5" / "ledger_rules.json"
 LEDGER_DEFAULT = ROOT / "config" / "phase4" / "dataset_ledger.csv"
 
+DEFAULT_CHUNK_ROWS = 50_000
+DEFAULT_MAX_VIOLATIONS = 10_000
+DEFAULT_SEVERITY = "medium"
+SEVERITY_ORDER = ["info", "low", "medium", "high", "critical"]
+SARIF_LEVELS = {"critical": "error", "high": "error", "medium": "warning", "low": "note", "info": "note"}
+RULE_DESCRIPTIONS = {
+    "missing_required": "必須カラムが空、またはヘッダに存在しない",
+    "invalid_value": "validators で許可されていない値",
+    "missing_image": "台帳の行に対応する画像が画像ディレクトリに無い",
+    "unregistered_image": "画像ディレクトリの画像に対応する台帳の行が無い",
+}
+
 
 class LedgerValidationError(Exception):
     """台帳検証例外"""
 
 
-def load_rules() -> dict:
-    return json.loads(RULES_PATH.read_text(encoding="utf-8"))
+def load_rules(path: Path = RULES_PATH) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def compile_rules(rules: dict, header: list[str]) -> dict:
+    """ルールをヘッダの列番号と許可値の集合に変換する。
+
+    返り値の checks は (列番号, カラム名, 必須か, 許可値の frozenset または None)。
+    ヘッダにない必須カラムは missing_columns に入る。
+    """
+    positions = {name: index for index, name in enumerate(header)}
+    required = list(rules["required_columns"])
+    validators = {column: frozenset(value.lower() for value in values) for column, values in rules.get("validators", {}).items()}
+    checks = []
+    for column in required + [column for column in validators if column not in required]:
+        if column in positions:
+            checks.append((positions[column], column, column in required, validators.get(column)))
+    return {
+        "checks": checks,
+        "missing_columns": [column for column in required if column not in positions],
+        "severity": rules.get("severity", {}),
+    }
+
+
+def validate_chunk(compiled: dict, lines: list[int], rows: list[list[str]]) -> tuple[Counter, list[tuple]]:
+    """チャンク内の違反を (rule, 行番号, カラム, 値) のタプルで返す。"""
+    violations = []
+    for line_no, row in zip(lines, rows):
+        width = len(row)
+        for index, column, required, allowed in compiled["checks"]:
+            value = row[index].strip() if index < width else ""
+            if not value:
+                if required:
+                    violations.append(("missing_required", line_no, column, ""))
+            elif allowed is not None and value.lower() not in allowed:
+                violations.append(("invalid_value", line_no, column, value))
+    return Counter(violation[0] for violation in violations), violations
 
 
 def validate_row(row: dict, rules: dict, line_no: int) -> list[str]:
-    errors: list[str] = []
-    required = rules["required_columns"]
-    validators = rules.get("validators", {})
-
-    for column in required:
-        value = (row.get(column) or "").strip()
-        if not value:
-            errors.append(f"missing required column '{column}' at line {line_no}")
-            continue
-        allowed = validators.get(column)
-        if allowed and value.lower() not in allowed:
-            errors.append(f"invalid value '{value}' for column '{column}' at line {line_no}")
-    return errors
-
-
-def validate_ledger(path: Path, rules: dict) -> int:
+    """1行 (DictReader の行) を検証してメッセージを返す。"""
+    compiled = compile_rules(rules, list(row))
+    _, violations = validate_chunk(compiled, [line_no], [[value or "" for value in row.values()]])
+    missing = [("missing_required", line_no, column, "") for column in compiled["missing_columns"]]
+    return [describe(*violation) for violation in missing + violations]
+
+
+def describe(rule: str, line_no: int, column: str, value: str) -> str:
+    if rule == "missing_required":
+        return f"missing required column '{column}' at line {line_no}"
+    if rule == "missing_image":
+        return f"no image file for '{value}' at line {line_no}"
+    if rule == "unregistered_image":
+        return f"image '{value}' has no ledger row"
+    return f"invalid value '{value}' for column '{column}' at line {line_no}"
+
+
+def iter_chunks(reader, chunk_rows: int) -> Iterator[tuple[list[int], list[list[str]]]]:
+    """(各行の開始行番号, 行) を chunk_rows 行ずつ返す。引用符内の改行も行番号に反映する。"""
+    lines: list[int] = []
+    rows: list[list[str]] = []
+    start = reader.line_num + 1
+    for row in reader:
+        if row:
+            lines.append(start)
+            rows.append(row)
+        start = reader.line_num + 1
+        if len(rows) >= chunk_rows:
+            yield lines, rows
+            lines, rows = [], []
+    if rows:
+        yield lines, rows
+
+
+def iter_results(compiled: dict, chunks: Iterator, workers: int) -> Iterator[tuple[int, Counter, list[tuple]]]:
+    """チャンクを順番どおりに検証する。workers > 1 では先行して最大 2*workers チャンクを投入する。"""
+    if workers <= 1:
+        for lines, rows in chunks:
+            yield (len(rows), *validate_chunk(compiled, lines, rows))
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending: deque = deque()
+        for lines, rows in chunks:
+            pending.append((len(rows), pool.submit(validate_chunk, compiled, lines, rows)))
+            if len(pending) >= 2 * workers:
+                count, future = pending.popleft()
+                yield (count, *future.result())
+        while pending:
+            count, future = pending.popleft()
+            yield (count, *future.result())
+
+
+def run_validation(
+    path: Path,
+    rules: dict,
+    on_violation: Callable[[dict], None],
+    workers: int = 1,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    images: Path | None = None,
+    store_path: Path = STORE_DEFAULT,
+) -> dict:
+    """台帳を検証し、違反を1件ずつ on_violation に渡して集計を返す。
+
+    images を渡すと store_path のストアで画像ディレクトリと突き合わせる。
+    """
     if not path.exists():
         raise LedgerValidationError(f"ledger file not found: {path}")
+    severity_of = rules.get("severity", {})
+    summary = {"rows": 0, "violations": 0, "by_rule": Counter(), "by_severity": Counter(), "by_column": Counter()}
+
+    def emit(rule: str, line_no: int, column: str, value: str) -> None:
+        severity = severity_of.get(rule, DEFAULT_SEVERITY)
+        summary["violations"] += 1
+        summary["by_severity"][severity] += 1
+        summary["by_column"][column] += 1
+        on_violation(
+            {"rule": rule, "severity": severity, "line": line_no, "column": column, "value": value,
+             "message": describe(rule, line_no, column, value)}
+        )
 
     with path.open(encoding="utf-8", newline="") as fh:
-        reader = csv.DictReader(fh)
-        missing_columns = [col for col in rules["required_columns"] if col not in reader.fieldnames]
-        if missing_columns:
-            raise LedgerValidationError(f"header missing columns: {missing_columns}")
-
-        violations: list[str] = []
-        for idx, row in enumerate(reader, start=2):
-            violations.extend(validate_row(row, rules, idx))
-
-    if violations:
-        for message in violations:
-            print(f"ERROR: {message}", file=sys.stderr)
-        return 1
+        reader = csv.reader(fh)
+        header = next(reader, [])
+        compiled = compile_rules(rules, header)
+        for column in compiled["missing_columns"]:
+            summary["by_rule"]["missing_required"] += 1
+            emit("missing_required", 1, column, "")
+        for count, counts, violations in iter_results(compiled, iter_chunks(reader, chunk_rows), workers):
+            summary["rows"] += count
+            summary["by_rule"].update(counts)
+            for violation in violations:
+                emit(*violation)
+
+    if images is not None:
+        store = LedgerStore(store_path)
+        try:
+            store.import_csv(path)
+            report = store.reconcile(images)
+        finally:
+            store.close()
+        for row in report["missing"]:
+            summary["by_rule"]["missing_image"] += 1
+            emit("missing_image", row["line"], "image_id", row["image_id"])
+        for name in report["unregistered"]:
+            summary["by_rule"]["unregistered_image"] += 1
+            emit("unregistered_image", 1, "image_id", name)
+
+    rank = {severity: -position for position, severity in enumerate(SEVERITY_ORDER)}
+    summary["by_severity"] = dict(sorted(summary["by_severity"].items(), key=lambda item: rank.get(item[0], 1)))
+    summary["by_rule"] = dict(summary["by_rule"])
+    summary["by_column"] = dict(summary["by_column"].most_common())
+    return summary
+
 
-    print("Ledger validation passed.")
+def to_sarif(path: Path, violations: list[dict], summary: dict, rules: dict) -> dict:
+    severity_of = rules.get("severity", {})
+    return {
+        "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+        "version": "2.1.0",
+        "runs": [
+            {
+                "tool": {
+                    "driver": {
+                        "name": "validate_ledger",
+                        "rules": [
+                            {
+                                "id": rule,
+                                "shortDescription": {"text": text},
+                                "defaultConfiguration": {"level": SARIF_LEVELS.get(severity_of.get(rule, DEFAULT_SEVERITY), "warning")},
+                                "properties": {"severity": severity_of.get(rule, DEFAULT_SEVERITY)},
+                            }
+                            for rule, text in RULE_DESCRIPTIONS.items()
+                        ],
+                    }
+                },
+                "results": [
+                    {
+                        "ruleId": violation["rule"],
+                        "level": SARIF_LEVELS.get(violation["severity"], "warning"),
+                        "message": {"text": violation["message"]},
+                        "locations": [
+                            {
+                                "physicalLocation": {
+                                    "artifactLocation": {"uri": path.as_posix()},
+                                    "region": {"startLine": violation["line"]},
+                                }
+                            }
+                        ],
+                        "properties": {"severity": violation["severity"], "column": violation["column"]},
+                    }
+                    for violation in violations
+                ],
+                "properties": {"summary": summary},
+            }
+        ],
+    }
+
+
+def validate_ledger(
+    path: Path,
+    rules: dict,
+    output_format: str = "text",
+    output: TextIO | None = None,
+    workers: int = 1,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    max_violations: int = DEFAULT_MAX_VIOLATIONS,
+    fail_on: str = "info",
+    images: Path | None = None,
+    store_path: Path = STORE_DEFAULT,
+) -> int:
+    """検証結果を出力し、fail_on 以上の重大度の違反があれば 1 を返す。
+
+    text は先頭 max_violations 件を stderr に、jsonl は全件を逐次 output に書き、最後の
+    行に集計 ({"type": "summary"}) を置く。sarif は先頭 max_violations 件を含める。
+    """
+    output = output or sys.stdout
+    kept: list[dict] = []
+
+    def on_violation(violation: dict) -> None:
+        if output_format == "jsonl":
+            output.write(json.dumps({"type": "violation", **violation}, ensure_ascii=False) + "\n")
+        elif len(kept) < max_violations:
+            kept.append(violation)
+            if output_format == "text":
+                print(f"ERROR: [{violation['severity']}] {violation['message']}", file=sys.stderr)
+
+    summary = run_validation(path, rules, on_violation, workers, chunk_rows, images, store_path)
+    summary["truncated"] = 0 if output_format == "jsonl" else summary["violations"] - len(kept)
+
+    if output_format == "jsonl":
+        output.write(json.dumps({"type": "summary", **summary}, ensure_ascii=False) + "\n")
+    elif output_format == "sarif":
+        json.dump(to_sarif(path, kept, summary, rules), output, ensure_ascii=False, indent=2)
+        output.write("\n")
+    else:
+        if summary["truncated"]:
+            print(f"ERROR: ... 他 {summary['truncated']} 件", file=sys.stderr)
+        counts = ", ".join(f"{rule}={count}" for rule, count in summary["by_rule"].items()) or "none"
+        severities = ", ".join(f"{severity}={count}" for severity, count in summary["by_severity"].items()) or "none"
+        print(f"{summary['rows']} rows checked; violations by rule: {counts}; by severity: {severities}")
+
+    threshold = SEVERITY_ORDER.index(fail_on)
+    failing = sum(
+        count
+        for severity, count in summary["by_severity"].items()
+        if severity not in SEVERITY_ORDER or SEVERITY_ORDER.index(severity) >= threshold
+    )
+    if failing:
+        return 1
+    if output_format == "text":
+        print("Ledger validation passed.")
     return 0
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="データ台帳検証")
     parser.add_argument("--ledger", default=str(LEDGER_DEFAULT))
+    parser.add_argument("--rules", default=str(RULES_PATH))
+    parser.add_argument("--format", choices=["text", "jsonl", "sarif"], default="text", help="出力形式")
+    parser.add_argument("--output", default=None, help="jsonl / sarif の出力先 (既定: 標準出力)")
+    parser.add_argument("--workers", type=int, default=1, help="チャンクを検証するプロセス数")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="1チャンクの行数")
+    parser.add_argument("--max-violations", type=int, default=DEFAULT_MAX_VIOLATIONS, help="保持・表示する違反の上限")
+    parser.add_argument("--images", default=None, help="台帳と突き合わせる画像ディレクトリ")
+    parser.add_argument("--store", default=str(STORE_DEFAULT), help="突き合わせに使う台帳ストア (SQLite)")
+    parser.add_argument("--fail-on", choices=SEVERITY_ORDER, default="info", help="この重大度以上の違反で終了コード1")
     args = parser.parse_args()
 
-    rules = load_rules()
-    exit_code = validate_ledger(Path(args.ledger), rules)
+    rules = load_rules(Path(args.rules))
+    options = dict(
+        output_format=args.format,
+        workers=args.workers,
+        chunk_rows=args.chunk_rows,
+        max_violations=args.max_violations,
+        fail_on=args.fail_on,
+        images=Path(args.images) if args.images else None,
+        store_path=Path(args.store),
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            exit_code = validate_ledger(Path(args.ledger), rules, output=output, **options)
+    else:
+        exit_code = validate_ledger(Path(args.ledger), rules, **options)
     sys.exit(exit_code)
 
 
@@ -1,5 +1,34 @@
 """Utility tools for AI-based image generation workflows."""
 
-__all__ = ["generate_image", "load_pipeline"]
+from __future__ import annotations
 
-from .generate import generate_image, load_pipeline
+import importlib
+from typing import TYPE_CHECKING, Any
+
+__all__ = ["PipelineRegistry", "generate_image", "generate_images", "load_pipeline"]
+
+# Public names are resolved on first access so that ``import aipict`` does not
+# pull in torch/diffusers; those load only once a pipeline is built.
+_LAZY_ATTRIBUTES = {
+    "PipelineRegistry": "registry",
+    "generate_image": "generate",
+    "generate_images": "generate",
+    "load_pipeline": "generate",
+}
+
+if TYPE_CHECKING:
+    from .generate import generate_image, generate_images, load_pipeline
+    from .registry import PipelineRegistry
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
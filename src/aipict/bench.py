@@ -0,0 +1,333 @@
+"""Reproducible CPU benchmarks for load_pipeline/generate on tiny random-weight models.
+
+Nothing is downloaded: the UNet, VAE and CLIP text encoder are built from small
+configs with seeded random weights, and the tokenizer uses a generated
+character-level vocabulary. Absolute numbers are only comparable on the same
+machine, so keep one baseline per render node.
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+from .generate import SCHEDULERS, GenerationRequest, load_pipeline, render_batch
+from .profiling import RssSampler
+
+DTYPES = ("float32", "bfloat16", "float16")
+TOKENIZER_CHARS = "abcdefghijklmnopqrstuvwxyz0123456789,.:_-()"
+BENCH_PROMPT = "char:shirayuki_aoi, cheerful heroine, academy uniform"
+BENCH_NEGATIVE = "blurry, low quality, deformed"
+
+
+@dataclass
+class BenchCase:
+    scheduler: str = "dpmpp_2m"
+    batch_size: int = 1
+    resolution: int = 64
+    dtype: str = "float32"
+
+    @property
+    def name(self) -> str:
+        return f"{self.scheduler}/b{self.batch_size}/{self.resolution}px/{self.dtype}"
+
+
+@dataclass
+class BenchResult:
+    case: str
+    scheduler: str
+    batch_size: int
+    resolution: int
+    dtype: str
+    steps: int
+    repeats: int
+    load_seconds: float
+    images_per_sec: float
+    peak_rss_mb: float
+    latency_ms: dict[str, float] = field(default_factory=dict)
+    step_ms: dict[str, float] = field(default_factory=dict)
+
+
+def write_tiny_tokenizer(directory: Path) -> None:
+    """Write a character-level CLIP vocabulary and an empty merge table."""
+
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}
+    for char in TOKENIZER_CHARS:
+        vocab.setdefault(char, len(vocab))
+        vocab.setdefault(f"{char}</w>", len(vocab))
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "vocab.json").write_text(json.dumps(vocab), encoding="utf-8")
+    (directory / "merges.txt").write_text("#version: 0.2\n", encoding="utf-8")
+
+
+def build_tiny_pipeline(seed: int = 0, workdir: Optional[Path | str] = None) -> Any:
+    """Build a Stable Diffusion pipeline with tiny, seeded random weights (64px native)."""
+
+    import torch
+    from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        norm_num_groups=8,
+        attention_head_dim=4,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 64),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+        norm_num_groups=8,
+    )
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            bos_token_id=0,
+            eos_token_id=1,
+            pad_token_id=1,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            vocab_size=2 * len(TOKENIZER_CHARS) + 3,
+            max_position_embeddings=77,
+        )
+    )
+
+    with tempfile.TemporaryDirectory() if workdir is None else nullcontext(workdir) as directory:
+        tokenizer_dir = Path(directory) / "tokenizer"
+        write_tiny_tokenizer(tokenizer_dir)
+        tokenizer = CLIPTokenizer(
+            str(tokenizer_dir / "vocab.json"),
+            str(tokenizer_dir / "merges.txt"),
+            model_max_length=77,
+        )
+
+    scheduler = DDIMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        clip_sample=False,
+        set_alpha_to_one=False,
+        steps_offset=1,
+    )
+    pipeline = StableDiffusionPipeline(
+        unet=unet,
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def percentiles(samples: Sequence[float]) -> dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(fraction: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+        return round(ordered[index], 3)
+
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "mean": round(sum(ordered) / len(ordered), 3)}
+
+
+def run_case(
+    model_dir: Path,
+    case: BenchCase,
+    steps: int = 4,
+    repeats: int = 3,
+    warmup: int = 1,
+) -> BenchResult:
+    """Load the saved tiny model for ``case`` and time ``repeats`` batched renders."""
+
+    import torch
+
+    start = time.perf_counter()
+    pipeline = load_pipeline(str(model_dir), device="cpu", use_half_precision=False, scheduler=case.scheduler)
+    pipeline.to(dtype=getattr(torch, case.dtype))
+    pipeline.set_progress_bar_config(disable=True)
+    load_seconds = time.perf_counter() - start
+
+    step_times: list[float] = []
+    last_tick = 0.0
+
+    def on_step_end(pipe: Any, step: int, timestep: Any, callback_kwargs: dict) -> dict:
+        nonlocal last_tick
+        now = time.perf_counter()
+        step_times.append((now - last_tick) * 1000)
+        last_tick = now
+        return callback_kwargs
+
+    requests = [
+        GenerationRequest(
+            prompt=f"{BENCH_PROMPT}, view {index}",
+            output_path=Path(),
+            seed=index,
+            negative_prompt=BENCH_NEGATIVE,
+        )
+        for index in range(case.batch_size)
+    ]
+    latencies: list[float] = []
+    measured_steps: list[float] = []
+    with RssSampler() as sampler:
+        for iteration in range(warmup + repeats):
+            step_times.clear()
+            start = last_tick = time.perf_counter()
+            render_batch(
+                pipeline,
+                requests,
+                num_inference_steps=steps,
+                width=case.resolution,
+                height=case.resolution,
+                step_callback=on_step_end,
+            )
+            if iteration >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+                measured_steps.extend(step_times)
+
+    total_seconds = sum(latencies) / 1000
+    return BenchResult(
+        case=case.name,
+        scheduler=case.scheduler,
+        batch_size=case.batch_size,
+        resolution=case.resolution,
+        dtype=case.dtype,
+        steps=steps,
+        repeats=repeats,
+        load_seconds=round(load_seconds, 4),
+        images_per_sec=round(case.batch_size * repeats / total_seconds, 3) if total_seconds else 0.0,
+        peak_rss_mb=round(sampler.peak / (1024 * 1024), 1),
+        latency_ms=percentiles(latencies),
+        step_ms=percentiles(measured_steps),
+    )
+
+
+def run_suite(
+    cases: Sequence[BenchCase],
+    steps: int = 4,
+    repeats: int = 3,
+    warmup: int = 1,
+    threads: Optional[int] = None,
+) -> dict:
+    import diffusers
+    import torch
+
+    if threads:
+        torch.set_num_threads(threads)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="aipict-bench-") as directory:
+        model_dir = Path(directory) / "tiny-sd"
+        build_tiny_pipeline(workdir=directory).save_pretrained(model_dir)
+        for case in cases:
+            result = run_case(model_dir, case, steps=steps, repeats=repeats, warmup=warmup)
+            print(
+                f"{result.case:<36} {result.images_per_sec:>8.2f} img/s  "
+                f"p50 {result.latency_ms['p50']:>8.1f} ms  step p50 {result.step_ms.get('p50', 0):>6.1f} ms  "
+                f"rss {result.peak_rss_mb:>7.1f} MB",
+                file=sys.stderr,
+            )
+            results.append(asdict(result))
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "diffusers": diffusers.__version__,
+            "threads": torch.get_num_threads(),
+            "steps": steps,
+            "repeats": repeats,
+        },
+        "results": results,
+    }
+
+
+def compare_results(current: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """List cases whose throughput dropped or p50 latency grew by more than ``tolerance``."""
+
+    reference = {result["case"]: result for result in baseline.get("results", [])}
+    regressions: list[str] = []
+    for result in current.get("results", []):
+        base = reference.get(result["case"])
+        if base is None:
+            continue
+        if result["images_per_sec"] < base["images_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{result['case']}: images/sec {result['images_per_sec']} < baseline {base['images_per_sec']}"
+            )
+        current_p50 = result["latency_ms"].get("p50", 0.0)
+        base_p50 = base["latency_ms"].get("p50", 0.0)
+        if base_p50 and current_p50 > base_p50 * (1 + tolerance):
+            regressions.append(f"{result['case']}: latency p50 {current_p50} ms > baseline {base_p50} ms")
+    return regressions
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark tiny random-weight Stable Diffusion pipelines on CPU")
+    parser.add_argument("--schedulers", nargs="+", default=["dpmpp_2m", "euler"], choices=sorted(SCHEDULERS))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--resolutions", nargs="+", type=int, default=[64, 128])
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=DTYPES)
+    parser.add_argument("--steps", type=int, default=4, help="Denoising steps per render")
+    parser.add_argument("--repeats", type=int, default=3, help="Measured renders per case")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured renders per case")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", default=None, help="Write JSON results here (default: stdout)")
+    parser.add_argument("--baseline", default=None, help="Baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = parse_args(argv)
+    cases = [
+        BenchCase(scheduler=scheduler, batch_size=batch_size, resolution=resolution, dtype=dtype)
+        for scheduler, batch_size, resolution, dtype in itertools.product(
+            args.schedulers, args.batch_sizes, args.resolutions, args.dtypes
+        )
+    ]
+    report = run_suite(cases, steps=args.steps, repeats=args.repeats, warmup=args.warmup, threads=args.threads)
+
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(payload + "\n", encoding="utf-8")
+    else:
+        print(payload)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare_results(report, baseline, tolerance=args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION: {message}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Memoized CLIP prompt embeddings shared across generation calls."""
+from __future__ import annotations
+
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+from .registry import weights_fingerprint
+
+EmbeddingKey = tuple[str, str, str]
+
+
+@dataclass
+class EmbeddingCacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+def tokenizer_key(tokenizer: Any) -> str:
+    return f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}:{tokenizer.model_max_length}"
+
+
+class PromptEmbeddingCache:
+    """LRU of text-encoder outputs keyed by (model, tokenizer, text).
+
+    The model part of the key is a fingerprint of the text encoder weights, so
+    checkpoints that share an encoder share cache entries and a modified
+    encoder never serves stale embeddings. With ``cache_dir`` set, encodings
+    are also persisted as safetensors files and survive process restarts.
+    """
+
+    def __init__(self, max_entries: int = 256, cache_dir: Optional[Path | str] = None) -> None:
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self._entries: OrderedDict[EmbeddingKey, Any] = OrderedDict()
+        self._fingerprints: weakref.WeakKeyDictionary[Any, str] = weakref.WeakKeyDictionary()
+        self._stats = EmbeddingCacheStats()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> EmbeddingCacheStats:
+        with self._lock:
+            return EmbeddingCacheStats(**self._stats.as_dict())
+
+    def forget(self, text_encoder: Any) -> None:
+        """Drop the memoized fingerprint after mutating ``text_encoder`` in place."""
+
+        with self._lock:
+            self._fingerprints.pop(text_encoder, None)
+
+    def key(self, pipeline: Any, text: str) -> EmbeddingKey:
+        with self._lock:
+            fingerprint = self._fingerprints.get(pipeline.text_encoder)
+            if fingerprint is None:
+                fingerprint = weights_fingerprint(pipeline.text_encoder)
+                self._fingerprints[pipeline.text_encoder] = fingerprint
+        return (fingerprint, tokenizer_key(pipeline.tokenizer), text)
+
+    def encode(self, pipeline: Any, text: str) -> Any:
+        """Return the ``[1, seq, dim]`` embedding of ``text`` on the pipeline's device."""
+
+        key = self.key(pipeline, text)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self._stats.hits += 1
+                return cached
+
+            embeds = self._load(key, pipeline)
+            if embeds is None:
+                embeds = _run_text_encoder(pipeline, text)
+                self._stats.misses += 1
+                self._store(key, embeds)
+            else:
+                self._stats.disk_hits += 1
+
+            self._entries[key] = embeds
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return embeds
+
+    def encode_batch(self, pipeline: Any, texts: Sequence[str]) -> Any:
+        import torch
+
+        return torch.cat([self.encode(pipeline, text) for text in texts])
+
+    def _path(self, key: EmbeddingKey) -> Path:
+        assert self.cache_dir is not None
+        digest = hashlib.sha256("\0".join(key).encode("utf-8")).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.safetensors"
+
+    def _load(self, key: EmbeddingKey, pipeline: Any) -> Any:
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        if not path.exists():
+            return None
+        from safetensors.torch import load_file
+
+        embeds = load_file(str(path))["prompt_embeds"]
+        return embeds.to(device=pipeline.device, dtype=pipeline.text_encoder.dtype)
+
+    def _store(self, key: EmbeddingKey, embeds: Any) -> None:
+        if self.cache_dir is None:
+            return
+        from safetensors.torch import save_file
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        save_file({"prompt_embeds": embeds.detach().cpu().contiguous()}, str(tmp_path))
+        tmp_path.replace(path)
+
+
+def _run_text_encoder(pipeline: Any, text: str) -> Any:
+    """Encode ``text`` exactly like ``StableDiffusionPipeline.encode_prompt`` does."""
+
+    import torch
+
+    tokenizer = pipeline.tokenizer
+    text_encoder = pipeline.text_encoder
+    inputs = tokenizer(
+        text,
+        padding="max_length",
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    )
+    attention_mask = None
+    if getattr(text_encoder.config, "use_attention_mask", False):
+        attention_mask = inputs.attention_mask.to(pipeline.device)
+
+    with torch.no_grad():
+        embeds = text_encoder(inputs.input_ids.to(pipeline.device), attention_mask=attention_mask)[0]
+    return embeds.to(dtype=text_encoder.dtype, device=pipeline.device)
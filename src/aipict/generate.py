@@ -2,13 +2,67 @@
 from __future__ import annotations
 
 import argparse
+import functools
 import os
+import sys
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, Optional, Sequence
 
-import torch
-from diffusers import DPMSolverMultistepScheduler, StableDiffusionPipeline
-from dotenv import load_dotenv
+from .embeddings import PromptEmbeddingCache
+from .memory import MemoryPlan, PeakMemoryMonitor, apply_memory_plan, default_budget_bytes, pipeline_device, plan_memory, report
+from .previews import LatentPreviewer
+from .profiling import GenerationProfiler
+from .registry import PipelineRegistry
+from .results import ResultCache, generation_params, result_key
+from .writer import AsyncImageWriter, save_image_atomic
+
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionPipeline
+
+# torch and diffusers are imported inside the functions that need them so that
+# importing this module (and running ``--help``) stays cheap.
+SCHEDULERS = {
+    "dpmpp_2m": ("DPMSolverMultistepScheduler", {}),
+    "dpmpp_2m_karras": ("DPMSolverMultistepScheduler", {"use_karras_sigmas": True}),
+    "euler": ("EulerDiscreteScheduler", {}),
+    "euler_a": ("EulerAncestralDiscreteScheduler", {}),
+    "ddim": ("DDIMScheduler", {}),
+}
+DEFAULT_SCHEDULER = "dpmpp_2m"
+DEFAULT_MODEL = "runwayml/stable-diffusion-v1-5"
+
+# (pipeline, step_index, timestep, callback_kwargs) -> callback_kwargs
+StepCallback = Callable[[Any, int, Any, dict], dict]
+
+
+def resolve_device(device: Optional[str] = None) -> str:
+    if device:
+        return device
+    import torch
+
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def resolve_dtype(use_half_precision: bool = True) -> torch.dtype:
+    import torch
+
+    return torch.float16 if use_half_precision and torch.cuda.is_available() else torch.float32
+
+
+def apply_scheduler(pipe: StableDiffusionPipeline, scheduler: str) -> None:
+    """Swap the pipeline scheduler for one of the entries in ``SCHEDULERS``."""
+
+    try:
+        scheduler_name, overrides = SCHEDULERS[scheduler]
+    except KeyError:
+        raise ValueError(f"Unknown scheduler '{scheduler}', expected one of {sorted(SCHEDULERS)}") from None
+    import diffusers
+
+    scheduler_cls = getattr(diffusers, scheduler_name)
+    pipe.scheduler = scheduler_cls.from_config(pipe.scheduler.config, **overrides)
 
 
 def load_pipeline(
@@ -16,25 +70,295 @@ def load_pipeline(
     device: Optional[str] = None,
     use_half_precision: bool = True,
     auth_token: Optional[str] = None,
+    scheduler: str = DEFAULT_SCHEDULER,
+    registry: Optional[PipelineRegistry] = None,
 ) -> StableDiffusionPipeline:
-    """Instantiate a Stable Diffusion pipeline with sensible defaults."""
+    """Instantiate a Stable Diffusion pipeline with sensible defaults.
 
-    load_dotenv()
-    token = auth_token or os.getenv("HUGGINGFACE_TOKEN")
+    When ``registry`` is given, a warm pipeline for the same model, dtype,
+    device and scheduler is returned from it instead of reloading weights.
+    """
 
-    dtype = torch.float16 if use_half_precision and torch.cuda.is_available() else torch.float32
-    pipe = StableDiffusionPipeline.from_pretrained(
-        model_id,
-        torch_dtype=dtype,
-        use_auth_token=token,
-    )
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    dtype = resolve_dtype(use_half_precision)
+    device = resolve_device(device)
+
+    def build() -> StableDiffusionPipeline:
+        from diffusers import StableDiffusionPipeline
+        from dotenv import load_dotenv
+
+        load_dotenv()
+        token = auth_token or os.getenv("HUGGINGFACE_TOKEN")
+
+        pipe = StableDiffusionPipeline.from_pretrained(
+            model_id,
+            torch_dtype=dtype,
+            use_auth_token=token,
+        )
+        apply_scheduler(pipe, scheduler)
+        return pipe.to(device)
+
+    if registry is None:
+        return build()
+    return registry.get((model_id, str(dtype), device, scheduler), build)
+
+
+@dataclass
+class GenerationRequest:
+    """One image to render as part of a batch."""
+
+    prompt: str
+    output_path: Path
+    seed: Optional[int] = None
+    negative_prompt: Optional[str] = None
+
+
+def load_prompts(path: Path | str) -> list[str]:
+    """Read one prompt per line, skipping blank lines and ``#`` comments."""
+
+    lines = Path(path).read_text(encoding="utf-8").splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+
+def build_requests(
+    prompts: Sequence[str],
+    output_dir: Path | str = "outputs",
+    seed: Optional[int] = None,
+    negative_prompt: Optional[str] = None,
+) -> list[GenerationRequest]:
+    """Assign each prompt an output file and, if ``seed`` is set, the seed ``seed + index``."""
+
+    output_dir = Path(output_dir)
+    return [
+        GenerationRequest(
+            prompt=prompt,
+            output_path=output_dir / f"{index:04d}.png",
+            seed=None if seed is None else seed + index,
+            negative_prompt=negative_prompt,
+        )
+        for index, prompt in enumerate(prompts)
+    ]
+
+
+def chain_step_callbacks(*callbacks: Optional[StepCallback]) -> Optional[StepCallback]:
+    """Combine ``callback_on_step_end`` hooks, running them in the given order."""
+
+    active = [callback for callback in callbacks if callback is not None]
+    if len(active) <= 1:
+        return active[0] if active else None
+
+    def chained(pipeline: Any, step: int, timestep: Any, callback_kwargs: dict) -> dict:
+        for callback in active:
+            callback_kwargs = callback(pipeline, step, timestep, callback_kwargs)
+        return callback_kwargs
+
+    return chained
+
+
+def _make_generator(pipeline: StableDiffusionPipeline, seed: Optional[int]) -> torch.Generator:
+    import torch
+
+    generator = torch.Generator(device=pipeline_device(pipeline))
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+
+def image_metadata(request: GenerationRequest, num_inference_steps: int, guidance_scale: float) -> dict:
+    """Generation parameters stored alongside each saved image."""
+
+    return {
+        "prompt": request.prompt,
+        "negative_prompt": request.negative_prompt,
+        "seed": request.seed,
+        "steps": num_inference_steps,
+        "guidance_scale": guidance_scale,
+    }
+
+
+def render_batch(
+    pipeline: StableDiffusionPipeline,
+    batch: Sequence[GenerationRequest],
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    embedding_cache: Optional[PromptEmbeddingCache] = None,
+    step_callback: Optional[StepCallback] = None,
+    profiler: Optional[GenerationProfiler] = None,
+    latents: Optional[torch.Tensor] = None,
+) -> list:
+    """Run one pipeline call over ``batch`` and return the PIL images in order.
+
+    The UNet sees the whole batch in one forward pass per denoising step. Each
+    item keeps its own generator, so a request gets the same initial noise
+    whatever batch it lands in; the pixels are only byte-identical across runs
+    with the same batch size, since batched kernels may accumulate in a
+    different order. With ``embedding_cache`` set, prompts and negatives are
+    encoded through it and handed to the pipeline as
+    ``prompt_embeds``/``negative_prompt_embeds``. ``step_callback`` is passed
+    to the pipeline as ``callback_on_step_end``. With ``profiler`` set, the
+    pipeline is instrumented for the duration of the call. ``latents``
+    replaces the seeded initial noise (one row per request).
+    """
+
+    if profiler is not None:
+        step_callback = chain_step_callbacks(profiler.step_callback, step_callback)
+        profiler.attach(pipeline)
+    try:
+        with profiler.span("pipeline", batch_size=len(batch)) if profiler else nullcontext():
+            prompts = [request.prompt for request in batch]
+            negatives = [request.negative_prompt or "" for request in batch]
+            if embedding_cache is None:
+                text_inputs = {"prompt": prompts, "negative_prompt": negatives if any(negatives) else None}
+            else:
+                with profiler.span("prompt_embeds") if profiler else nullcontext():
+                    text_inputs = {"prompt_embeds": embedding_cache.encode_batch(pipeline, prompts)}
+                    if guidance_scale > 1:
+                        text_inputs["negative_prompt_embeds"] = embedding_cache.encode_batch(pipeline, negatives)
+
+            output = pipeline(
+                **text_inputs,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                width=width,
+                height=height,
+                generator=[_make_generator(pipeline, request.seed) for request in batch],
+                latents=latents,
+                callback_on_step_end=step_callback,
+            )
+    finally:
+        if profiler is not None:
+            profiler.detach()
+    return list(output.images)
+
+
+def iter_generate_images(
+    pipeline: StableDiffusionPipeline,
+    requests: Iterable[GenerationRequest],
+    batch_size: int = 4,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    embedding_cache: Optional[PromptEmbeddingCache] = None,
+    writer: Optional[AsyncImageWriter] = None,
+    profiler: Optional[GenerationProfiler] = None,
+    memory_plan: Optional[MemoryPlan] = None,
+    result_cache: Optional[ResultCache] = None,
+    previewer: Optional[LatentPreviewer] = None,
+) -> Iterator[Path]:
+    """Render ``requests`` in micro-batches, yielding each path once it is saved.
+
+    Every micro-batch is one ``render_batch`` call. With ``writer`` set, images
+    are queued on it instead of written inline and the yielded paths only
+    exist on disk after ``writer.flush()``. ``profiler`` records every stage,
+    including the inline save or the time spent queueing on the writer.
+    ``memory_plan`` (see ``plan_memory``) is applied to the pipeline first and
+    caps the micro-batch size. With ``result_cache`` set, seeded requests whose
+    full parameter set was rendered before are linked from the cache (and
+    yielded first) instead of denoised, and new renders are added to it.
+    ``previewer`` receives approximate previews every few steps and can abort
+    the run with ``GenerationAborted``.
+    """
+
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if memory_plan is not None:
+        apply_memory_plan(pipeline, memory_plan)
+        batch_size = min(batch_size, memory_plan.batch_size)
 
-    if device is None:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-    pipe = pipe.to(device)
+    pending: list[tuple[GenerationRequest, Optional[tuple[str, dict]]]] = []
+    for request in requests:
+        params = None
+        if result_cache is not None:
+            params = generation_params(pipeline, request, num_inference_steps, guidance_scale, width, height)
+        if params is None:
+            pending.append((request, None))
+            continue
+        key = result_key(params)
+        if result_cache.fetch(key, request.output_path):
+            yield Path(request.output_path)
+        else:
+            pending.append((request, (key, params)))
 
-    return pipe
+    for start in range(0, len(pending), batch_size):
+        batch = [request for request, _ in pending[start : start + batch_size]]
+        cache_entries = [entry for _, entry in pending[start : start + batch_size]]
+        images = render_batch(
+            pipeline,
+            batch,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            width=width,
+            height=height,
+            embedding_cache=embedding_cache,
+            step_callback=previewer.step_callback if previewer is not None else None,
+            profiler=profiler,
+        )
+
+        for request, entry, image in zip(batch, cache_entries, images):
+            metadata = image_metadata(request, num_inference_steps, guidance_scale)
+            if writer is None:
+                with profiler.span("image_save") if profiler else nullcontext():
+                    path = save_image_atomic(image, request.output_path, metadata)
+                if entry is not None:
+                    result_cache.store(entry[0], path, entry[1])
+            else:
+                on_written = None
+                if entry is not None:
+                    on_written = functools.partial(_store_result, result_cache, entry)
+                with profiler.span("image_submit") if profiler else nullcontext():
+                    writer.submit(image, request.output_path, metadata, on_written=on_written)
+                path = Path(request.output_path)
+            yield path
+
+
+def _store_result(result_cache: ResultCache, entry: tuple[str, dict], path: Path) -> None:
+    result_cache.store(entry[0], path, entry[1])
+
+
+def generate_images(
+    pipeline: StableDiffusionPipeline,
+    requests: Iterable[GenerationRequest],
+    batch_size: int = 4,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    embedding_cache: Optional[PromptEmbeddingCache] = None,
+    writer: Optional[AsyncImageWriter] = None,
+    profiler: Optional[GenerationProfiler] = None,
+    memory_plan: Optional[MemoryPlan] = None,
+    result_cache: Optional[ResultCache] = None,
+    previewer: Optional[LatentPreviewer] = None,
+) -> list[Path]:
+    """Render every request in micro-batches and return the saved paths in request order.
+
+    ``iter_generate_images`` yields result-cache hits first; the paths are put
+    back into the order of ``requests`` here.
+    """
+
+    requests = list(requests)
+    saved = set(
+        iter_generate_images(
+            pipeline,
+            requests,
+            batch_size=batch_size,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            width=width,
+            height=height,
+            embedding_cache=embedding_cache,
+            writer=writer,
+            profiler=profiler,
+            memory_plan=memory_plan,
+            result_cache=result_cache,
+            previewer=previewer,
+        )
+    )
+    return [Path(request.output_path) for request in requests if Path(request.output_path) in saved]
 
 
 def generate_image(
@@ -45,34 +369,54 @@ def generate_image(
     guidance_scale: float = 7.5,
     seed: Optional[int] = None,
     output_path: Path | str = "outputs/generated.png",
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    embedding_cache: Optional[PromptEmbeddingCache] = None,
+    writer: Optional[AsyncImageWriter] = None,
+    profiler: Optional[GenerationProfiler] = None,
+    memory_plan: Optional[MemoryPlan] = None,
+    result_cache: Optional[ResultCache] = None,
+    previewer: Optional[LatentPreviewer] = None,
 ) -> Path:
     """Run the diffusion pipeline and persist the resulting image."""
 
-    generator = None
-    if seed is not None:
-        generator = torch.Generator(device=pipeline.device).manual_seed(seed)
-
-    output = pipeline(
-        prompt,
+    request = GenerationRequest(
+        prompt=prompt,
+        output_path=Path(output_path),
+        seed=seed,
         negative_prompt=negative_prompt,
+    )
+    (path,) = generate_images(
+        pipeline,
+        [request],
+        batch_size=1,
         num_inference_steps=num_inference_steps,
         guidance_scale=guidance_scale,
-        generator=generator,
+        width=width,
+        height=height,
+        embedding_cache=embedding_cache,
+        writer=writer,
+        profiler=profiler,
+        memory_plan=memory_plan,
+        result_cache=result_cache,
+        previewer=previewer,
     )
-
-    image = output.images[0]
-    output_path = Path(output_path)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    image.save(output_path)
-
-    return output_path
+    return path
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Generate an image with Stable Diffusion")
-    parser.add_argument("prompt", help="Positive text prompt")
+    parser.add_argument("prompt", nargs="?", help="Positive text prompt")
+    parser.add_argument("--prompts", default=None, help="File with one prompt per line (batch mode)")
+    parser.add_argument("--batch-size", type=int, default=4, help="Prompts per UNet forward pass in batch mode")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Render --prompts on this many processes, each pinned to its share of the CPU cores",
+    )
     parser.add_argument("--negative", dest="negative", help="Negative prompt", default=None)
-    parser.add_argument("--model", default="runwayml/stable-diffusion-v1-5", help="Model repo id")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Model repo id")
     parser.add_argument("--steps", type=int, default=30, help="Number of inference steps")
     parser.add_argument("--guidance", type=float, default=7.5, help="Classifier-free guidance scale")
     parser.add_argument("--seed", type=int, default=None, help="Random seed for reproducibility")
@@ -81,6 +425,52 @@ def parse_args() -> argparse.Namespace:
         default="outputs/generated.png",
         help="Where to save the generated image",
     )
+    parser.add_argument(
+        "--output-dir",
+        default="outputs",
+        help="Directory for numbered images in batch mode",
+    )
+    parser.add_argument("--width", type=int, default=None, help="Image width in pixels")
+    parser.add_argument("--height", type=int, default=None, help="Image height in pixels")
+    parser.add_argument(
+        "--scheduler",
+        default=DEFAULT_SCHEDULER,
+        choices=sorted(SCHEDULERS),
+        help="Sampler used for denoising",
+    )
+    parser.add_argument(
+        "--embedding-cache",
+        default=None,
+        help="Directory for persisted prompt embeddings (in-memory only if omitted)",
+    )
+    parser.add_argument(
+        "--result-cache",
+        default=None,
+        help="Directory of previously rendered seeded images to reuse instead of denoising again",
+    )
+    parser.add_argument(
+        "--writer-threads",
+        type=int,
+        default=2,
+        help="Background threads encoding images (0 writes inline)",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="Write a Chrome trace of every generation stage here and print a summary table",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        help="Peak memory (MB) the memory planner may use (default: AIPICT_MEMORY_BUDGET_MB or free memory)",
+    )
+    parser.add_argument(
+        "--no-memory-plan",
+        dest="memory_plan",
+        action="store_false",
+        help="Run without attention slicing/VAE tiling/batch reduction chosen by the memory planner",
+    )
     parser.add_argument("--device", default=None, help="Force a device (cpu/cuda)")
     parser.add_argument(
         "--no-fp16",
@@ -88,27 +478,142 @@ def parse_args() -> argparse.Namespace:
         action="store_false",
         help="Disable half precision weights",
     )
-    parser.set_defaults(use_half_precision=True)
-    return parser.parse_args()
+    parser.set_defaults(use_half_precision=True, memory_plan=True)
+    args = parser.parse_args()
+    if (args.prompt is None) == (args.prompts is None):
+        parser.error("give either a prompt or --prompts FILE")
+    if args.workers > 1 and not args.prompts:
+        parser.error("--workers needs --prompts FILE")
+    return args
 
 
-def main() -> None:
-    args = parse_args()
-    pipe = load_pipeline(
-        model_id=args.model,
-        device=args.device,
-        use_half_precision=args.use_half_precision,
-    )
-    output_path = generate_image(
-        pipeline=pipe,
-        prompt=args.prompt,
+def run_workers(args: argparse.Namespace) -> None:
+    from .workers import WorkerConfig, run_pool
+
+    requests = build_requests(
+        load_prompts(args.prompts),
+        output_dir=args.output_dir,
+        seed=args.seed,
         negative_prompt=args.negative,
+    )
+    config = WorkerConfig(
+        model_id=args.model,
+        scheduler=args.scheduler,
         num_inference_steps=args.steps,
         guidance_scale=args.guidance,
-        seed=args.seed,
-        output_path=args.output,
+        width=args.width,
+        height=args.height,
+        device=args.device or "cpu",
+        use_half_precision=args.use_half_precision,
     )
-    print(f"Saved image to {output_path}")
+    results = run_pool(requests, config, workers=args.workers, batch_size=args.batch_size)
+    failures = [result for result in results if not result.ok]
+    for result in results:
+        if result.ok:
+            print(f"Saved image to {result.output_path}")
+        else:
+            print(f"Failed {result.output_path}: {result.error}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+def run(
+    args: argparse.Namespace,
+    pipe: StableDiffusionPipeline,
+    embedding_cache: PromptEmbeddingCache,
+    writer: Optional[AsyncImageWriter],
+    profiler: Optional[GenerationProfiler] = None,
+) -> None:
+    memory_plan = None
+    if args.memory_plan:
+        device = str(pipe.device)
+        budget = args.memory_budget * 2**20 if args.memory_budget else default_budget_bytes(device)
+        memory_plan = plan_memory(
+            pipe,
+            batch_size=args.batch_size if args.prompts else 1,
+            width=args.width,
+            height=args.height,
+            guidance_scale=args.guidance,
+            budget_bytes=budget,
+        )
+        report(memory_plan)
+
+    result_cache = ResultCache(args.result_cache) if args.result_cache else None
+    with PeakMemoryMonitor(str(pipe.device)) if memory_plan else nullcontext() as monitor:
+        if args.prompts:
+            requests = build_requests(
+                load_prompts(args.prompts),
+                output_dir=args.output_dir,
+                seed=args.seed,
+                negative_prompt=args.negative,
+            )
+            for output_path in iter_generate_images(
+                pipe,
+                requests,
+                batch_size=args.batch_size,
+                num_inference_steps=args.steps,
+                guidance_scale=args.guidance,
+                width=args.width,
+                height=args.height,
+                embedding_cache=embedding_cache,
+                writer=writer,
+                profiler=profiler,
+                memory_plan=memory_plan,
+                result_cache=result_cache,
+            ):
+                print(f"Saved image to {output_path}")
+        else:
+            output_path = generate_image(
+                pipeline=pipe,
+                prompt=args.prompt,
+                negative_prompt=args.negative,
+                num_inference_steps=args.steps,
+                guidance_scale=args.guidance,
+                seed=args.seed,
+                output_path=args.output,
+                width=args.width,
+                height=args.height,
+                embedding_cache=embedding_cache,
+                writer=writer,
+                profiler=profiler,
+                memory_plan=memory_plan,
+                result_cache=result_cache,
+            )
+            print(f"Saved image to {output_path}")
+    if memory_plan is not None:
+        report(memory_plan, monitor.peak)
+    if result_cache is not None:
+        stats = result_cache.stats
+        print(f"Result cache: {stats.hits} reused, {stats.misses} not cached yet")
+
+
+def main() -> None:
+    args = parse_args()
+    if args.workers > 1:
+        run_workers(args)
+        return
+
+    profiler = GenerationProfiler() if args.profile else None
+    with profiler.span("load_pipeline") if profiler else nullcontext():
+        pipe = load_pipeline(
+            model_id=args.model,
+            device=args.device,
+            use_half_precision=args.use_half_precision,
+            scheduler=args.scheduler,
+        )
+    embedding_cache = PromptEmbeddingCache(cache_dir=args.embedding_cache)
+    writer = AsyncImageWriter(max_workers=args.writer_threads) if args.writer_threads > 0 else None
+    try:
+        run(args, pipe, embedding_cache, writer, profiler)
+    finally:
+        if writer is not None:
+            with profiler.span("writer_flush") if profiler else nullcontext():
+                writer.close()
+
+    if profiler is not None:
+        trace_path = profiler.write_chrome_trace(args.profile)
+        print(profiler.format_summary())
+        print(f"Saved Chrome trace to {trace_path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,374 @@
+"""Predict peak generation memory and pick slicing/tiling/offload settings that fit."""
+from __future__ import annotations
+
+import os
+import sys
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Any, Optional
+
+from .profiling import RssSampler, current_rss_bytes
+from .registry import SHARED_COMPONENTS, module_nbytes
+
+BUDGET_ENV = "AIPICT_MEMORY_BUDGET_MB"
+# Fraction of the currently available memory a plan may use; the rest is left
+# for the allocator's fragmentation, the OS page cache and other jobs.
+HEADROOM = 0.85
+# Rough number of full-resolution feature maps alive at once in a ResNet block
+# (input, normalised input, conv output, residual sum).
+LIVE_FEATURE_MAPS = 4
+# Models moved to ``meta`` and streamed in per submodule by sequential offload.
+OFFLOADED_COMPONENTS = ("unet", "text_encoder", "vae")
+
+
+@dataclass(frozen=True)
+class MemoryPlan:
+    """Memory-saving settings for one render configuration and the peak they predict."""
+
+    batch_size: int
+    attention_slicing: Optional[str] = None
+    vae_slicing: bool = False
+    vae_tiling: bool = False
+    sequential_offload: bool = False
+    predicted_peak_bytes: int = 0
+    budget_bytes: Optional[int] = None
+
+    @property
+    def fits(self) -> bool:
+        return self.budget_bytes is None or self.predicted_peak_bytes <= self.budget_bytes
+
+    def describe(self) -> str:
+        enabled = [
+            name
+            for name, on in (
+                (f"attention slicing ({self.attention_slicing})", self.attention_slicing),
+                ("VAE slicing", self.vae_slicing),
+                ("VAE tiling", self.vae_tiling),
+                ("sequential offload", self.sequential_offload),
+            )
+            if on
+        ]
+        budget = "unbounded" if self.budget_bytes is None else f"{self.budget_bytes / 2**20:.0f} MB"
+        return (
+            f"batch {self.batch_size}, {', '.join(enabled) or 'no memory savers'}; "
+            f"predicted peak {self.predicted_peak_bytes / 2**20:.0f} MB of {budget}"
+        )
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def available_memory_bytes(device: str = "cpu") -> Optional[int]:
+    """Memory this process can still allocate: free device memory, or host RAM bounded by the cgroup limit."""
+
+    if str(device).startswith("cuda"):
+        import torch
+
+        return int(torch.cuda.mem_get_info()[0])
+
+    available = None
+    try:
+        for line in Path("/proc/meminfo").read_text(encoding="ascii").splitlines():
+            if line.startswith("MemAvailable:"):
+                available = int(line.split()[1]) * 1024
+                break
+    except OSError:
+        pass
+    try:
+        limit = Path("/sys/fs/cgroup/memory.max").read_text(encoding="ascii").strip()
+        usage = int(Path("/sys/fs/cgroup/memory.current").read_text(encoding="ascii"))
+        if limit != "max":
+            cgroup_free = max(int(limit) - usage, 0)
+            available = cgroup_free if available is None else min(available, cgroup_free)
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+def default_budget_bytes(device: str = "cpu") -> Optional[int]:
+    """Budget for the predicted peak: ``AIPICT_MEMORY_BUDGET_MB`` or what is in use plus free memory."""
+
+    if os.getenv(BUDGET_ENV):
+        return int(os.environ[BUDGET_ENV]) * 2**20
+    available = available_memory_bytes(device)
+    if available is None:
+        return None
+    return _in_use_bytes(device) + int(available * HEADROOM)
+
+
+def _in_use_bytes(device: str) -> int:
+    if str(device).startswith("cuda"):
+        import torch
+
+        return int(torch.cuda.memory_allocated())
+    return current_rss_bytes()
+
+
+def _attention_heads(unet_config: Any, block_index: int) -> int:
+    heads = unet_config.num_attention_heads or unet_config.attention_head_dim
+    if isinstance(heads, (list, tuple)):
+        heads = heads[block_index]
+    return int(heads)
+
+
+def uses_fused_attention(model: Any) -> bool:
+    """True when every attention layer runs ``scaled_dot_product_attention``.
+
+    Those kernels never materialise the full score matrix, so attention
+    slicing (which does, one slice at a time) only adds memory.
+    """
+
+    processors = getattr(model, "attn_processors", None)
+    return bool(processors) and all(type(p).__name__.endswith("2_0") for p in processors.values())
+
+
+def _slice_size(heads: int, attention_slicing: Optional[str]) -> Optional[int]:
+    if attention_slicing is None:
+        return None
+    return 1 if attention_slicing == "max" else max(heads // 2, 1)
+
+
+def estimate_unet_bytes(
+    pipeline: Any,
+    batch_size: int,
+    width: int,
+    height: int,
+    guidance_scale: float = 7.5,
+    attention_slicing: Optional[str] = None,
+) -> int:
+    """Peak activation bytes of one UNet forward pass.
+
+    Counts the skip connections kept for the up path, the live feature maps
+    of the widest block and, unless fused attention is in use, the largest
+    self-attention score matrix with its softmax copy, which dominates at high
+    resolution (it grows with the fourth power of the side).
+    """
+
+    config = pipeline.unet.config
+    element = pipeline.unet.dtype.itemsize
+    rows = batch_size * (2 if guidance_scale > 1 else 1)
+    tokens = (height // pipeline.vae_scale_factor) * (width // pipeline.vae_scale_factor)
+
+    fused = attention_slicing is None and uses_fused_attention(pipeline.unet)
+    skips = working = attention = 0
+    for index, (block_type, channels) in enumerate(zip(config.down_block_types, config.block_out_channels)):
+        level_tokens = tokens // 4**index
+        feature_map = rows * channels * level_tokens * element
+        skips += (config.layers_per_block + 1) * feature_map
+        working = max(working, LIVE_FEATURE_MAPS * feature_map)
+        if "CrossAttn" in block_type:
+            heads = _attention_heads(config, index)
+            slices = _slice_size(heads, attention_slicing) or rows * heads
+            scores = 0 if fused else 2 * min(slices, rows * heads) * level_tokens**2 * element
+            # GEGLU feed-forward: 8x channels for the projected hidden states.
+            attention = max(attention, scores, 8 * feature_map)
+    return skips + working + attention
+
+
+def estimate_vae_decode_bytes(
+    pipeline: Any,
+    batch_size: int,
+    width: int,
+    height: int,
+    vae_slicing: bool = False,
+    vae_tiling: bool = False,
+) -> int:
+    """Peak activation bytes of decoding ``batch_size`` latents to pixels."""
+
+    vae = pipeline.vae
+    element = vae.dtype.itemsize
+    images = 1 if vae_slicing else batch_size
+    tile = getattr(vae, "tile_sample_min_size", max(width, height))
+    tiled = vae_tiling and max(width, height) > tile
+    tile_width, tile_height = (min(width, tile), min(height, tile)) if tiled else (width, height)
+
+    pixels = tile_width * tile_height
+    # block_out_channels[0] is the full-resolution level of the decoder.
+    feature_maps = max(
+        LIVE_FEATURE_MAPS * channels * pixels // 4**index for index, channels in enumerate(vae.config.block_out_channels)
+    )
+    mid_tokens = pixels // pipeline.vae_scale_factor**2
+    has_attention = vae.config.get("mid_block_add_attention", True)
+    attention = 2 * mid_tokens**2 if has_attention and not uses_fused_attention(vae) else 0
+    decoded = 3 * width * height * element * batch_size * (2 if tiled else 1)
+    return images * (feature_maps + attention) * element + decoded
+
+
+def is_sequentially_offloaded(pipeline: Any) -> bool:
+    """True while ``enable_sequential_cpu_offload`` hooks are attached to the pipeline's models."""
+
+    return any(hasattr(getattr(pipeline, name, None), "_hf_hook") for name in OFFLOADED_COMPONENTS)
+
+
+def pipeline_device(pipeline: Any) -> str:
+    """The device the pipeline runs on; offloaded weights sit on ``meta`` between forward calls."""
+
+    if is_sequentially_offloaded(pipeline):
+        return str(pipeline._offload_device)
+    return str(pipeline.device)
+
+
+def estimate_peak_bytes(pipeline: Any, plan: MemoryPlan, width: int, height: int, guidance_scale: float) -> int:
+    """Memory in use now plus the larger of the UNet and VAE activation peaks under ``plan``."""
+
+    device = pipeline_device(pipeline)
+    in_use = _in_use_bytes(device)
+    offloaded = is_sequentially_offloaded(pipeline)
+    if plan.sequential_offload != offloaded and device.startswith("cuda"):
+        weights = sum(module_nbytes(getattr(pipeline, name)) for name in OFFLOADED_COMPONENTS)
+        in_use += -weights if plan.sequential_offload else weights
+    activations = max(
+        estimate_unet_bytes(pipeline, plan.batch_size, width, height, guidance_scale, plan.attention_slicing),
+        estimate_vae_decode_bytes(pipeline, plan.batch_size, width, height, plan.vae_slicing, plan.vae_tiling),
+    )
+    output_images = plan.batch_size * width * height * 3
+    return max(in_use, 0) + activations + output_images
+
+
+def plan_memory(
+    pipeline: Any,
+    batch_size: int,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    guidance_scale: float = 7.5,
+    budget_bytes: Optional[int] = None,
+) -> MemoryPlan:
+    """Pick the cheapest settings whose predicted peak fits ``budget_bytes``.
+
+    Savers are tried in order of their cost to throughput: attention slicing
+    (skipped when the UNet already uses fused attention), VAE slicing, VAE
+    tiling, then halving the batch, and finally sequential CPU offload on CUDA
+    (it frees no host RAM on CPU-only nodes). If nothing fits, the most
+    conservative plan is returned with ``fits`` false.
+    """
+
+    default_side = pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    width, height = width or default_side, height or default_side
+    base = MemoryPlan(batch_size=batch_size, budget_bytes=budget_bytes)
+    if uses_fused_attention(pipeline.unet):
+        candidates = [base, replace(base, vae_slicing=True)]
+    else:
+        candidates = [
+            base,
+            replace(base, attention_slicing="auto"),
+            replace(base, attention_slicing="max", vae_slicing=True),
+        ]
+    candidates.append(replace(candidates[-1], vae_slicing=True, vae_tiling=True))
+    most_saving = candidates[-1]
+    reduced = batch_size
+    while reduced > 1:
+        reduced = (reduced + 1) // 2
+        candidates.append(replace(most_saving, batch_size=reduced))
+    if pipeline_device(pipeline).startswith("cuda"):
+        candidates.append(replace(candidates[-1], sequential_offload=True))
+
+    plan = base
+    for candidate in candidates:
+        plan = replace(candidate, predicted_peak_bytes=estimate_peak_bytes(pipeline, candidate, width, height, guidance_scale))
+        if plan.fits:
+            break
+    return plan
+
+
+def apply_memory_plan(pipeline: Any, plan: MemoryPlan) -> None:
+    """Switch the pipeline's memory savers to match ``plan`` (undoing those it does not use).
+
+    Sequential offload is undone too, so a render planned without it after
+    one that needed it runs at full speed with the weights back on the device.
+    """
+
+    if plan.attention_slicing:
+        pipeline.enable_attention_slicing(plan.attention_slicing)
+    elif any("Sliced" in type(p).__name__ for p in pipeline.unet.attn_processors.values()):
+        pipeline.disable_attention_slicing()
+    if plan.vae_slicing:
+        pipeline.enable_vae_slicing()
+    else:
+        pipeline.disable_vae_slicing()
+    if plan.vae_tiling:
+        pipeline.enable_vae_tiling()
+    else:
+        pipeline.disable_vae_tiling()
+    offloaded = is_sequentially_offloaded(pipeline)
+    if plan.sequential_offload and not offloaded:
+        _unshare_components(pipeline)
+        pipeline.enable_sequential_cpu_offload(device=pipeline.device)
+    elif offloaded and not plan.sequential_offload:
+        remove_sequential_offload(pipeline)
+
+
+def _unshare_components(pipeline: Any) -> None:
+    """Give the pipeline private copies of the components a ``PipelineRegistry`` may share.
+
+    Offload hooks (and the move to ``meta``) apply to the module object, so
+    offloading a shared text encoder would change every pipeline using it.
+    The copy stays private after the offload is removed.
+    """
+
+    import copy
+
+    for name in SHARED_COMPONENTS:
+        module = getattr(pipeline, name, None)
+        if module is not None:
+            setattr(pipeline, name, copy.deepcopy(module))
+
+
+def remove_sequential_offload(pipeline: Any) -> None:
+    """Detach the offload hooks and move the pipeline back onto the device it ran on.
+
+    Removing an accelerate hook restores the weights it kept in host memory,
+    so the models come back on the CPU and are then moved as a whole.
+    """
+
+    from accelerate.hooks import remove_hook_from_module
+
+    device = pipeline._offload_device
+    for name in OFFLOADED_COMPONENTS:
+        module = getattr(pipeline, name, None)
+        if module is not None:
+            remove_hook_from_module(module, recurse=True)
+    pipeline.to(device)
+
+
+class PeakMemoryMonitor:
+    """Measure the peak RSS (or CUDA allocation) while the context is active."""
+
+    def __init__(self, device: str = "cpu") -> None:
+        self.device = str(device)
+        self.peak = 0
+        self._sampler: Optional[RssSampler] = None
+
+    def __enter__(self) -> "PeakMemoryMonitor":
+        if self.device.startswith("cuda"):
+            import torch
+
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self._sampler = RssSampler().__enter__()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        if self._sampler is not None:
+            self._sampler.__exit__(*exc_info)
+            self.peak = self._sampler.peak
+        else:
+            import torch
+
+            self.peak = int(torch.cuda.max_memory_allocated())
+
+
+def report(plan: MemoryPlan, measured_peak_bytes: Optional[int] = None, file: Any = None) -> None:
+    """Print the plan and, once known, the measured peak next to the prediction."""
+
+    file = file or sys.stderr
+    if measured_peak_bytes is None:
+        print(f"memory plan: {plan.describe()}", file=file)
+        if not plan.fits:
+            print("memory plan: warning: no plan fits the budget; expect swapping or OOM", file=file)
+        return
+    error = (measured_peak_bytes - plan.predicted_peak_bytes) / max(plan.predicted_peak_bytes, 1)
+    print(
+        f"memory plan: predicted peak {plan.predicted_peak_bytes / 2**20:.0f} MB, "
+        f"measured {measured_peak_bytes / 2**20:.0f} MB ({error:+.0%})",
+        file=file,
+    )
@@ -0,0 +1,458 @@
+"""Run ComfyUI preset files directly, with LoRA stacks fused into cached weights."""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Sequence
+
+from .embeddings import PromptEmbeddingCache
+from .generate import (
+    DEFAULT_MODEL,
+    DEFAULT_SCHEDULER,
+    SCHEDULERS,
+    apply_scheduler,
+    load_pipeline,
+    resolve_device,
+    resolve_dtype,
+)
+from .results import set_weight_variant
+from .sweep import SweepVariant, make_contact_sheet, parse_resolution, run_sweep, variants_from_preset
+from .writer import save_image_atomic
+
+if TYPE_CHECKING:
+    import torch
+
+DEFAULT_PRESET_REGISTRY = Path("config/phase3/preset_registry.json")
+DEFAULT_PRESET_DIR = Path("presets/comfyui")
+DEFAULT_LORA_DIR = "outputs/lora"
+DEFAULT_FUSED_CACHE_DIR = Path.home() / ".cache" / "aipict" / "fused"
+FUSED_BUDGET_ENV = "AIPICT_FUSED_CACHE_MB"
+# An fp16 SD 1.5 UNet plus text encoder is about 2 GB, so roughly eight stacks.
+DEFAULT_FUSED_BUDGET_MB = 16384
+
+FUSED_COMPONENTS = ("unet", "text_encoder")
+
+# (suffix, role) pairs for the kohya (sd-scripts), diffusers and peft LoRA layouts.
+LORA_KEY_SUFFIXES = (
+    (".lora_down.weight", "down"),
+    (".lora_up.weight", "up"),
+    (".lora.down.weight", "down"),
+    (".lora.up.weight", "up"),
+    (".lora_linear_layer.down.weight", "down"),
+    (".lora_linear_layer.up.weight", "up"),
+    (".lora_A.weight", "down"),
+    (".lora_B.weight", "up"),
+    (".alpha", "alpha"),
+)
+# (key prefix, pipeline component, whether module paths use "_" instead of ".").
+LORA_KEY_PREFIXES = (
+    ("lora_unet_", "unet", True),
+    ("lora_te1_", "text_encoder", True),
+    ("lora_te2_", "text_encoder_2", True),
+    ("lora_te_", "text_encoder", True),
+    ("unet.", "unet", False),
+    ("text_encoder.", "text_encoder", False),
+    ("text_encoder_2.", "text_encoder_2", False),
+)
+
+
+@dataclass(frozen=True)
+class LoraSpec:
+    name: str
+    weight: float
+
+
+def load_preset_registry(path: Path | str = DEFAULT_PRESET_REGISTRY) -> dict[str, Path]:
+    """Map preset ids to preset files (relative to the registry's preset directory)."""
+
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    return {entry["id"]: Path(entry["file"]) for entry in data.get("presets", [])}
+
+
+def resolve_preset(
+    reference: str,
+    registry_path: Path | str = DEFAULT_PRESET_REGISTRY,
+    preset_dir: Path | str = DEFAULT_PRESET_DIR,
+) -> dict:
+    """Load a preset by registry id, or directly from a JSON path."""
+
+    path = Path(reference)
+    if not path.is_file():
+        registry = load_preset_registry(registry_path)
+        if reference not in registry:
+            raise KeyError(f"Unknown preset '{reference}', expected one of {sorted(registry)} or a JSON file")
+        path = Path(preset_dir) / registry[reference]
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def preset_loras(preset: dict) -> tuple[LoraSpec, ...]:
+    return tuple(LoraSpec(item["name"], float(item.get("weight", 1.0))) for item in preset.get("loras", []))
+
+
+def find_lora(name: str, lora_dir: Path | str) -> Path:
+    path = Path(lora_dir) / name
+    for candidate in (path, path.with_name(f"{path.name}.safetensors")):
+        if candidate.is_file():
+            return candidate
+    raise FileNotFoundError(f"LoRA '{name}' not found in {lora_dir} (expected {path.name}.safetensors)")
+
+
+def _split_lora_key(key: str) -> Optional[tuple[str, str, bool, str]]:
+    for prefix, component, underscored in LORA_KEY_PREFIXES:
+        if key.startswith(prefix):
+            break
+    else:
+        return None
+    for suffix, role in LORA_KEY_SUFFIXES:
+        if key.endswith(suffix):
+            return component, key[len(prefix) : -len(suffix)], underscored, role
+    return None
+
+
+def lora_targets(pipeline: Any, state_dict: dict[str, torch.Tensor]) -> list[tuple[Any, dict[str, torch.Tensor]]]:
+    """Match a LoRA state dict to the pipeline's Linear/Conv modules without touching any weight.
+
+    Returns ``(module, {"down", "up"[, "alpha"]})`` pairs. Keys for components
+    the pipeline does not have (e.g. ``lora_te2_`` on SD 1.x) are skipped; a
+    key naming an unknown module, or a file matching nothing, is a ValueError.
+    """
+
+    import torch
+
+    layers: dict[tuple[str, str, bool], dict[str, torch.Tensor]] = {}
+    for key, tensor in state_dict.items():
+        parsed = _split_lora_key(key)
+        if parsed is not None:
+            component, module_name, underscored, role = parsed
+            layers.setdefault((component, module_name, underscored), {})[role] = tensor
+
+    lookups: dict[tuple[str, bool], dict[str, Any]] = {}
+    targets = []
+    for (component, module_name, underscored), parts in layers.items():
+        model = getattr(pipeline, component, None)
+        if model is None or "down" not in parts or "up" not in parts:
+            continue
+        lookup = lookups.get((component, underscored))
+        if lookup is None:
+            lookup = {
+                (name.replace(".", "_") if underscored else name): module
+                for name, module in model.named_modules()
+                if isinstance(module, (torch.nn.Linear, torch.nn.Conv2d))
+            }
+            lookups[(component, underscored)] = lookup
+        module = lookup.get(module_name)
+        if module is None:
+            raise ValueError(f"LoRA targets unknown {component} module '{module_name}'")
+        targets.append((module, parts))
+    if not targets:
+        raise ValueError("no LoRA layers matched the pipeline")
+    return targets
+
+
+def fuse_lora_targets(targets: list[tuple[Any, dict[str, torch.Tensor]]], weight: float) -> int:
+    """Add ``weight * alpha / rank * up @ down`` to every matched weight in place (see ``lora_targets``)."""
+
+    import torch
+
+    with torch.no_grad():
+        for module, parts in targets:
+            down, up = parts["down"].float(), parts["up"].float()
+            rank = down.shape[0]
+            alpha = float(parts["alpha"]) if "alpha" in parts else rank
+            delta = (up.flatten(1) @ down.flatten(1)).reshape(module.weight.shape)
+            target = module.weight
+            target.copy_((target.float() + delta.to(target.device) * (weight * alpha / rank)).to(target.dtype))
+    return len(targets)
+
+
+def fuse_lora(pipeline: Any, state_dict: dict[str, torch.Tensor], weight: float) -> int:
+    """Fuse one LoRA into the pipeline in place and return the number of modules updated.
+
+    Every key is matched before the first weight changes, so a file with an
+    unknown target leaves the pipeline untouched.
+    """
+
+    return fuse_lora_targets(lora_targets(pipeline, state_dict), weight)
+
+
+class FusedWeightCache:
+    """Size-bounded on-disk store of fused UNet/text-encoder weights keyed by base model and LoRA stack.
+
+    Each entry is a directory of ``<component>.safetensors`` files. Loading
+    reads each file into new tensors on the model's device and assigns them
+    to the modules (``load_state_dict(assign=True)``), so switching to a
+    cached stack costs one read per component instead of re-fusing every
+    layer. The entry directory's mtime records its last use; least-recently-
+    used entries are evicted once ``max_bytes`` is exceeded, except those in
+    ``pinned``.
+    """
+
+    def __init__(self, cache_dir: Path | str = DEFAULT_FUSED_CACHE_DIR, max_bytes: Optional[int] = None) -> None:
+        self.cache_dir = Path(cache_dir).expanduser()
+        if max_bytes is None:
+            max_bytes = int(os.getenv(FUSED_BUDGET_ENV, DEFAULT_FUSED_BUDGET_MB)) * 2**20
+        self.max_bytes = max_bytes
+        self.pinned: set[str] = set()
+
+    @staticmethod
+    def key(model_id: str, dtype: Any, loras: Sequence[LoraSpec], lora_dir: Path | str) -> str:
+        parts = [model_id, str(dtype)]
+        for spec in loras:
+            stat = find_lora(spec.name, lora_dir).stat()
+            parts.append(f"{spec.name}:{spec.weight!r}:{stat.st_size}:{stat.st_mtime_ns}")
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:32]
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and all(
+            (self.path(key) / f"{component}.safetensors").exists() for component in FUSED_COMPONENTS
+        )
+
+    def load(self, key: str, pipeline: Any) -> bool:
+        if key not in self:
+            return False
+        from safetensors.torch import load_file
+
+        for component in FUSED_COMPONENTS:
+            model = getattr(pipeline, component)
+            state = load_file(str(self.path(key) / f"{component}.safetensors"), device=str(model.device))
+            model.load_state_dict(state, strict=True, assign=True)
+        os.utime(self.path(key))
+        return True
+
+    def store(self, key: str, pipeline: Any, description: Optional[dict] = None) -> Path:
+        from safetensors.torch import save_file
+
+        entry = self.path(key)
+        entry.mkdir(parents=True, exist_ok=True)
+        for component in FUSED_COMPONENTS:
+            state = {name: tensor.detach().contiguous() for name, tensor in getattr(pipeline, component).state_dict().items()}
+            tmp_path = entry / f"{component}.safetensors.tmp"
+            save_file(state, str(tmp_path))
+            tmp_path.replace(entry / f"{component}.safetensors")
+        if description is not None:
+            (entry / "meta.json").write_text(json.dumps(description, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.utime(entry)
+        self._evict(keep=key)
+        return entry
+
+    def prune(self, max_bytes: Optional[int] = None) -> int:
+        """Evict down to ``max_bytes`` (default: the configured bound) and return the entries removed."""
+
+        return self._evict(max_bytes=max_bytes)
+
+    def _evict(self, keep: Optional[str] = None, max_bytes: Optional[int] = None) -> int:
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        if not self.cache_dir.is_dir():
+            return 0
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            if entry.is_dir():
+                size = sum(path.stat().st_size for path in entry.iterdir() if path.is_file())
+                entries.append((entry.stat().st_mtime_ns, entry, size))
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for _, entry, size in sorted(entries, key=lambda item: item[0]):
+            if total <= limit:
+                break
+            if entry.name == keep or entry.name in self.pinned:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+
+class PresetRunner:
+    """Keep one pipeline per base model and switch its fused LoRA stack per preset.
+
+    The first stack applied to a freshly loaded pipeline is fused from the
+    base weights, which are themselves cached (as the empty stack) so any
+    later stack can start from them. The pipeline is private to the runner and
+    never handed to a ``PipelineRegistry``, because its weights change in place.
+    """
+
+    def __init__(
+        self,
+        model_id: str = DEFAULT_MODEL,
+        device: Optional[str] = None,
+        use_half_precision: bool = True,
+        lora_dir: Path | str = DEFAULT_LORA_DIR,
+        cache_dir: Path | str = DEFAULT_FUSED_CACHE_DIR,
+        cache_max_bytes: Optional[int] = None,
+        embedding_cache: Optional[PromptEmbeddingCache] = None,
+        pipeline: Any = None,
+    ) -> None:
+        self.model_id = model_id
+        self.lora_dir = Path(lora_dir)
+        self.fused_cache = FusedWeightCache(cache_dir, cache_max_bytes)
+        self.embedding_cache = embedding_cache if embedding_cache is not None else PromptEmbeddingCache()
+        self.dtype = resolve_dtype(use_half_precision) if pipeline is None else pipeline.unet.dtype
+        if pipeline is None:
+            pipeline = load_pipeline(model_id, device=resolve_device(device), use_half_precision=use_half_precision)
+        self.pipeline = pipeline
+        self.active: tuple[LoraSpec, ...] = ()
+        self.fused_from_scratch = 0
+
+    def apply_loras(self, loras: Sequence[LoraSpec]) -> None:
+        loras = tuple(loras)
+        if loras == self.active:
+            return
+        key = self.fused_cache.key(self.model_id, self.dtype, loras, self.lora_dir)
+        if not self.fused_cache.load(key, self.pipeline):
+            from safetensors.torch import load_file
+
+            # Resolve, read and match every file before the first weight changes.
+            stack = [
+                (lora_targets(self.pipeline, load_file(str(find_lora(spec.name, self.lora_dir)))), spec.weight)
+                for spec in loras
+            ]
+            base_key = self.fused_cache.key(self.model_id, self.dtype, (), self.lora_dir)
+            # Every stack is fused from the base weights, so they must survive eviction.
+            self.fused_cache.pinned.add(base_key)
+            if not self.active:
+                if base_key not in self.fused_cache:
+                    self.fused_cache.store(base_key, self.pipeline, {"model": self.model_id, "loras": []})
+            elif not self.fused_cache.load(base_key, self.pipeline):
+                raise RuntimeError(f"base weights for {self.model_id} are missing from {self.fused_cache.cache_dir}")
+            self.active = ()
+            try:
+                for targets, weight in stack:
+                    fuse_lora_targets(targets, weight)
+                self.fused_cache.store(
+                    key,
+                    self.pipeline,
+                    {"model": self.model_id, "loras": [{"name": spec.name, "weight": spec.weight} for spec in loras]},
+                )
+            except BaseException:
+                # Never leave a half-fused stack behind: go back to the clean base weights.
+                self.fused_cache.load(base_key, self.pipeline)
+                set_weight_variant(self.pipeline, None)
+                self.embedding_cache.forget(self.pipeline.text_encoder)
+                raise
+            self.fused_from_scratch += 1
+        self.active = loras
+        # Result-cache keys must tell the fused stacks (and the base) apart.
+        set_weight_variant(self.pipeline, f"loras:{key}" if loras else None)
+        self.embedding_cache.forget(self.pipeline.text_encoder)
+
+    def run(
+        self,
+        preset: dict,
+        output_dir: Path | str,
+        seeds: Optional[Sequence[int]] = None,
+        steps: Optional[int] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        batch_size: int = 8,
+    ) -> list[tuple[SweepVariant, Any]]:
+        """Render every view of ``preset`` with its LoRA stack, sampler, steps, cfg and resolution."""
+
+        self.apply_loras(preset_loras(preset))
+        sampler = preset.get("sampler", DEFAULT_SCHEDULER)
+        apply_scheduler(self.pipeline, sampler if sampler in SCHEDULERS else DEFAULT_SCHEDULER)
+        if seeds is None and preset.get("seed_mode") == "random":
+            seeds = [random.randrange(2**32)]
+        if "resolution" in preset:
+            preset_width, preset_height = parse_resolution(preset["resolution"])
+            width, height = width or preset_width, height or preset_height
+
+        variants = variants_from_preset(preset, output_dir, seeds=seeds)
+        return run_sweep(
+            self.pipeline,
+            variants,
+            num_inference_steps=steps or int(preset.get("steps", 30)),
+            width=width,
+            height=height,
+            batch_size=batch_size,
+            embedding_cache=self.embedding_cache,
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Render ComfyUI presets without a UI")
+    parser.add_argument("presets", nargs="*", help="Preset ids from the registry or preset JSON paths")
+    parser.add_argument("--list", action="store_true", help="List the registered presets and exit")
+    parser.add_argument("--registry", default=str(DEFAULT_PRESET_REGISTRY), help="Preset registry JSON")
+    parser.add_argument("--preset-dir", default=str(DEFAULT_PRESET_DIR), help="Directory holding the preset files")
+    parser.add_argument("--model", default=os.getenv("MODEL_ID", DEFAULT_MODEL), help="Base model repo id")
+    parser.add_argument(
+        "--lora-dir",
+        default=os.getenv("AIPICT_LORA_DIR", DEFAULT_LORA_DIR),
+        help="Directory with <name>.safetensors LoRA files",
+    )
+    parser.add_argument(
+        "--fused-cache-dir",
+        default=os.getenv("AIPICT_FUSED_CACHE_DIR", str(DEFAULT_FUSED_CACHE_DIR)),
+        help="Where fused UNet/text-encoder weights are cached",
+    )
+    parser.add_argument(
+        "--fused-cache-mb",
+        type=int,
+        default=None,
+        help=f"Evict least-recently-used fused stacks above this size (default: ${FUSED_BUDGET_ENV} or {DEFAULT_FUSED_BUDGET_MB})",
+    )
+    parser.add_argument("--seeds", nargs="+", type=int, default=None, help="Override the preset seed(s)")
+    parser.add_argument("--steps", type=int, default=None, help="Override the number of inference steps")
+    parser.add_argument("--width", type=int, default=None, help="Override the image width")
+    parser.add_argument("--height", type=int, default=None, help="Override the image height")
+    parser.add_argument("--batch-size", type=int, default=8, help="Views per pipeline call")
+    parser.add_argument("--output-dir", default="outputs/presets", help="Output directory (one subfolder per preset)")
+    parser.add_argument("--device", default=None, help="Force a device (cpu/cuda)")
+    parser.add_argument(
+        "--no-fp16",
+        dest="use_half_precision",
+        action="store_false",
+        help="Disable half precision weights",
+    )
+    parser.set_defaults(use_half_precision=True)
+    args = parser.parse_args()
+    if not args.list and not args.presets:
+        parser.error("give at least one preset (or --list)")
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    if args.list:
+        for preset_id, path in load_preset_registry(args.registry).items():
+            print(f"{preset_id}\t{Path(args.preset_dir) / path}")
+        return
+
+    presets = [resolve_preset(reference, args.registry, args.preset_dir) for reference in args.presets]
+    runner = PresetRunner(
+        args.model,
+        device=args.device,
+        use_half_precision=args.use_half_precision,
+        lora_dir=args.lora_dir,
+        cache_dir=args.fused_cache_dir,
+        cache_max_bytes=args.fused_cache_mb * 2**20 if args.fused_cache_mb is not None else None,
+    )
+    for preset in presets:
+        output_dir = Path(args.output_dir) / preset.get("name", "preset")
+        results = runner.run(
+            preset,
+            output_dir,
+            seeds=args.seeds,
+            steps=args.steps,
+            width=args.width,
+            height=args.height,
+            batch_size=args.batch_size,
+        )
+        for variant, _ in results:
+            print(f"Saved image to {variant.output_path}")
+        if len(results) > 1:
+            sheet_path = save_image_atomic(make_contact_sheet(results), output_dir / "contact_sheet.png")
+            print(f"Saved contact sheet to {sheet_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Low-cost intermediate previews of a render and cooperative early abort."""
+from __future__ import annotations
+
+import queue
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional, Sequence
+
+if TYPE_CHECKING:
+    import torch
+
+# Linear maps from the four SD latent channels to RGB (approximately [-1, 1]),
+# as used by ComfyUI's latent previews.
+SD15_LATENT_RGB_FACTORS = (
+    (0.3512, 0.2297, 0.3227),
+    (0.3250, 0.4974, 0.2350),
+    (-0.2829, 0.1762, 0.2721),
+    (-0.2120, -0.2616, -0.7177),
+)
+SDXL_LATENT_RGB_FACTORS = (
+    (0.3920, 0.4054, 0.4549),
+    (-0.2634, -0.0196, 0.0653),
+    (0.0568, 0.1687, -0.0755),
+    (-0.3112, -0.2359, -0.2076),
+)
+SDXL_LATENT_RGB_BIAS = (0.1084, -0.0175, -0.0011)
+
+
+class GenerationAborted(RuntimeError):
+    """Raised out of the pipeline call when a caller cancels a render."""
+
+    def __init__(self, step: int) -> None:
+        super().__init__(f"generation aborted after step {step}")
+        self.step = step
+
+
+@dataclass
+class Preview:
+    """Approximate images after ``step`` of ``total_steps``.
+
+    The final item of ``stream_previews`` has no images and carries the saved ``path``.
+    """
+
+    step: int
+    total_steps: int
+    images: list = field(default_factory=list)
+    path: Optional[Path] = None
+
+    @property
+    def final(self) -> bool:
+        return self.path is not None
+
+
+def default_latent_rgb_factors(pipeline: Any) -> tuple[Sequence[Sequence[float]], Optional[Sequence[float]]]:
+    """Pick the SD 1.x or SDXL projection from the UNet's text-conditioning width."""
+
+    if getattr(pipeline.unet.config, "cross_attention_dim", 768) == 2048:
+        return SDXL_LATENT_RGB_FACTORS, SDXL_LATENT_RGB_BIAS
+    return SD15_LATENT_RGB_FACTORS, None
+
+
+def fit_latent_rgb_factors(pipeline: Any, samples: int = 4, seed: int = 0) -> tuple[Any, Any]:
+    """Least-squares fit of a latent->RGB projection against real VAE decodes.
+
+    Useful for custom or fine-tuned VAEs whose latents the stock factors do
+    not match. Costs ``samples`` decodes at the UNet's native resolution once.
+    """
+
+    import torch
+
+    config = pipeline.unet.config
+    generator = torch.Generator().manual_seed(seed)
+    shape = (samples, config.in_channels, config.sample_size, config.sample_size)
+    latents = torch.randn(shape, generator=generator).to(pipeline.vae.device, pipeline.vae.dtype)
+    with torch.no_grad():
+        decoded = pipeline.vae.decode(latents / pipeline.vae.config.scaling_factor).sample
+    target = torch.nn.functional.avg_pool2d(decoded.float(), pipeline.vae_scale_factor)
+
+    inputs = latents.float().permute(0, 2, 3, 1).reshape(-1, config.in_channels)
+    inputs = torch.cat([inputs, torch.ones(len(inputs), 1, device=inputs.device)], dim=1)
+    outputs = target.permute(0, 2, 3, 1).reshape(-1, 3)
+    solution = torch.linalg.lstsq(inputs.cpu(), outputs.cpu()).solution
+    return solution[:-1], solution[-1]
+
+
+def latents_to_rgb(latents: torch.Tensor, factors: Any, bias: Any = None) -> list:
+    """Project ``[B, 4, h, w]`` latents to ``h x w`` PIL previews."""
+
+    import torch
+    from PIL import Image
+
+    factors = torch.as_tensor(factors, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum("bchw,cr->bhwr", latents.float(), factors)
+    if bias is not None:
+        rgb = rgb + torch.as_tensor(bias, dtype=torch.float32, device=latents.device)
+    pixels = ((rgb + 1) / 2).clamp(0, 1).mul(255).round().to(torch.uint8).cpu().numpy()
+    return [Image.fromarray(array) for array in pixels]
+
+
+class LatentPreviewer:
+    """``callback_on_step_end`` hook producing previews every ``every`` steps.
+
+    Previews come from a linear latent->RGB projection (no VAE), or from
+    ``decoder`` (e.g. a ``diffusers.AutoencoderTiny``) when given. Where the
+    scheduler keeps its latest clean-sample prediction (DPM-Solver's
+    ``model_outputs``), that is previewed instead of the noisy latents, so
+    early previews already show the composition. ``should_abort`` (or
+    ``cancel()``) stops the render at the next step by raising
+    ``GenerationAborted`` out of the pipeline call, skipping the remaining
+    steps and the final decode.
+    """
+
+    def __init__(
+        self,
+        every: int = 5,
+        on_preview: Optional[Callable[[Preview], None]] = None,
+        should_abort: Optional[Callable[[int], bool]] = None,
+        factors: Any = None,
+        bias: Any = None,
+        decoder: Any = None,
+    ) -> None:
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.every = every
+        self.on_preview = on_preview
+        self.should_abort = should_abort
+        self.factors = factors
+        self.bias = bias
+        self.decoder = decoder
+        self.previews = 0
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def step_callback(self, pipeline: Any, step: int, timestep: Any, callback_kwargs: dict) -> dict:
+        completed = step + 1
+        total = pipeline.num_timesteps
+        if self.on_preview is not None and (completed % self.every == 0 or completed == total):
+            self.on_preview(Preview(completed, total, self.render(pipeline, callback_kwargs["latents"])))
+            self.previews += 1
+        if self._cancelled.is_set() or (self.should_abort is not None and self.should_abort(completed)):
+            raise GenerationAborted(completed)
+        return callback_kwargs
+
+    def render(self, pipeline: Any, latents: torch.Tensor) -> list:
+        import torch
+
+        model_outputs = getattr(pipeline.scheduler, "model_outputs", None)
+        predicted = model_outputs[-1] if model_outputs and model_outputs[-1] is not None else None
+        if predicted is not None and predicted.shape == latents.shape:
+            latents = predicted
+        with torch.no_grad():
+            if self.decoder is not None:
+                from diffusers.image_processor import VaeImageProcessor
+
+                decoded = self.decoder.decode(latents.to(self.decoder.dtype)).sample
+                return VaeImageProcessor().postprocess(decoded.float(), output_type="pil")
+        if self.factors is None:
+            self.factors, self.bias = default_latent_rgb_factors(pipeline)
+        return latents_to_rgb(latents, self.factors, self.bias)
+
+
+def stream_previews(
+    run: Callable[[LatentPreviewer], Path],
+    every: int = 5,
+    **previewer_options: Any,
+) -> Iterator[Preview]:
+    """Yield previews while ``run(previewer)`` renders on a background thread.
+
+    The last item carries the saved ``path``. Closing the generator early
+    (e.g. ``break``) cancels the render at its next step.
+    """
+
+    previews: queue.Queue = queue.Queue()
+    previewer = LatentPreviewer(every=every, on_preview=previews.put, **previewer_options)
+    outcome: dict[str, Any] = {}
+
+    def target() -> None:
+        try:
+            outcome["path"] = run(previewer)
+        except BaseException as error:  # noqa: BLE001 - re-raised on the consumer side
+            outcome["error"] = error
+        finally:
+            previews.put(None)
+
+    worker = threading.Thread(target=target, name="aipict-preview", daemon=True)
+    worker.start()
+    last = Preview(step=0, total_steps=0)
+    try:
+        while (preview := previews.get()) is not None:
+            last = preview
+            yield preview
+    finally:
+        previewer.cancel()
+        worker.join()
+    error = outcome.get("error")
+    if error is not None and not isinstance(error, GenerationAborted):
+        raise error
+    if "path" in outcome:
+        yield Preview(last.step, last.total_steps, path=Path(outcome["path"]))
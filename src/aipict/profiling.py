@@ -0,0 +1,248 @@
+"""Per-stage timing and memory instrumentation for generation runs."""
+from __future__ import annotations
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+HOOKED_MODULES = {
+    "text_encoder": "text_encoder",
+    "unet": "unet",
+    "vae.decoder": "vae_decode",
+    "vae.encoder": "vae_encode",
+}
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process, falling back to the peak where /proc is missing."""
+
+    try:
+        with open("/proc/self/statm", encoding="ascii") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class RssSampler:
+    """Track the peak RSS seen while the context is active."""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "RssSampler":
+        self.peak = current_rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_bytes())
+
+
+def _device_memory_bytes() -> Optional[int]:
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return int(torch.cuda.memory_allocated())
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    end: float
+    thread_id: int
+    rss_start: int
+    rss_end: int
+    device_bytes: Optional[int] = None
+    args: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class GenerationProfiler:
+    """Record wall time and memory for each stage of a generation run.
+
+    ``attach`` installs forward hooks on the text encoder, UNet and VAE and
+    wraps ``scheduler.step``; ``step_callback`` closes one span per denoising
+    step. Spans can be exported as a Chrome trace (``chrome://tracing`` or
+    Perfetto) and summarised as a table.
+    """
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.spans: list[Span] = []
+        self._open: dict[tuple[int, str], tuple[float, int]] = {}
+        self._handles: list[Any] = []
+        self._patched_schedulers: list[Any] = []
+        self._step_start: Optional[float] = None
+        self._step_rss = 0
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, rss_start: int, **args: Any) -> None:
+        span = Span(
+            name=name,
+            start=start,
+            end=time.perf_counter(),
+            thread_id=threading.get_ident(),
+            rss_start=rss_start,
+            rss_end=current_rss_bytes(),
+            device_bytes=_device_memory_bytes(),
+            args=args,
+        )
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        start, rss_start = time.perf_counter(), current_rss_bytes()
+        try:
+            yield
+        finally:
+            self.record(name, start, rss_start, **args)
+
+    def attach(self, pipeline: Any) -> None:
+        """Hook the pipeline's modules and scheduler until ``detach`` is called."""
+
+        for path, name in HOOKED_MODULES.items():
+            module = pipeline
+            for part in path.split("."):
+                module = getattr(module, part, None)
+            if module is None or not hasattr(module, "register_forward_hook"):
+                continue
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name)))
+
+        scheduler = pipeline.scheduler
+        original_step = scheduler.step
+
+        def timed_step(*args: Any, **kwargs: Any) -> Any:
+            with self.span("scheduler_step"):
+                return original_step(*args, **kwargs)
+
+        scheduler.step = timed_step
+        self._patched_schedulers.append(scheduler)
+
+    def detach(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self._handles.clear()
+        for scheduler in self._patched_schedulers:
+            scheduler.__dict__.pop("step", None)
+        self._patched_schedulers.clear()
+        self._step_start = None
+
+    def step_callback(self, pipeline: Any, step: int, timestep: Any, callback_kwargs: dict) -> dict:
+        """``callback_on_step_end`` hook closing the span of denoising step ``step``."""
+
+        if self._step_start is not None:
+            self.record("denoise_step", self._step_start, self._step_rss, step=step, timestep=float(timestep))
+        self._step_start = None
+        return callback_kwargs
+
+    def _pre_hook(self, name: str) -> Any:
+        def hook(module: Any, inputs: Any) -> None:
+            now = time.perf_counter()
+            if name == "unet" and self._step_start is None:
+                self._step_start, self._step_rss = now, current_rss_bytes()
+            self._open[(threading.get_ident(), name)] = (now, current_rss_bytes())
+
+        return hook
+
+    def _post_hook(self, name: str) -> Any:
+        def hook(module: Any, inputs: Any, output: Any) -> None:
+            opened = self._open.pop((threading.get_ident(), name), None)
+            if opened is not None:
+                self.record(name, opened[0], opened[1])
+
+        return hook
+
+    def to_chrome_trace(self) -> dict:
+        pid = os.getpid()
+        events: list[dict] = [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "aipict"}},
+        ]
+        for span in sorted(self.spans, key=lambda item: item.start):
+            args = {
+                "rss_mb": round(span.rss_end / 2**20, 1),
+                "rss_delta_mb": round((span.rss_end - span.rss_start) / 2**20, 2),
+                **span.args,
+            }
+            if span.device_bytes is not None:
+                args["device_mb"] = round(span.device_bytes / 2**20, 1)
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": "generation",
+                    "ph": "X",
+                    "ts": round((span.start - self.origin) * 1e6, 1),
+                    "dur": round(span.duration * 1e6, 1),
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": args,
+                }
+            )
+            events.append(
+                {
+                    "name": "rss_mb",
+                    "ph": "C",
+                    "ts": round((span.end - self.origin) * 1e6, 1),
+                    "pid": pid,
+                    "args": {"rss_mb": args["rss_mb"]},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: Path | str) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_chrome_trace()), encoding="utf-8")
+        return path
+
+    def summary(self) -> list[dict]:
+        """Aggregate spans per stage, ordered by total time."""
+
+        stages: dict[str, dict] = {}
+        for span in self.spans:
+            stage = stages.setdefault(
+                span.name,
+                {"stage": span.name, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "peak_rss_mb": 0.0},
+            )
+            stage["count"] += 1
+            stage["total_ms"] += span.duration * 1000
+            stage["max_ms"] = max(stage["max_ms"], span.duration * 1000)
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], span.rss_end / 2**20)
+        for stage in stages.values():
+            stage["mean_ms"] = stage["total_ms"] / stage["count"]
+        return sorted(stages.values(), key=lambda stage: stage["total_ms"], reverse=True)
+
+    def format_summary(self) -> str:
+        wall_ms = max((span.end for span in self.spans), default=self.origin) - self.origin
+        wall_ms *= 1000
+        lines = [f"{'stage':<16} {'count':>6} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'% wall':>7} {'rss MB':>8}"]
+        for stage in self.summary():
+            share = 100 * stage["total_ms"] / wall_ms if wall_ms else 0.0
+            lines.append(
+                f"{stage['stage']:<16} {stage['count']:>6} {stage['total_ms']:>10.1f} {stage['mean_ms']:>9.1f} "
+                f"{stage['max_ms']:>9.1f} {share:>6.1f}% {stage['peak_rss_mb']:>8.1f}"
+            )
+        lines.append(f"wall time {wall_ms:.1f} ms (nested stages overlap, so shares do not sum to 100%)")
+        return "\n".join(lines)
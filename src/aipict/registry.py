@@ -0,0 +1,233 @@
+"""In-process registry of warm diffusion pipelines with LRU eviction."""
+from __future__ import annotations
+
+import gc
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass, field
+from itertools import chain
+from typing import Any, Callable, Optional
+
+# Only the text encoder is shared: memory plans toggle slicing/tiling on each
+# pipeline's VAE, which must not leak into other pipelines. Modules carrying
+# accelerate offload hooks are never shared (see ``apply_memory_plan``).
+SHARED_COMPONENTS = ("text_encoder",)
+BUDGET_ENV = "AIPICT_PIPELINE_CACHE_MB"
+DEFAULT_BUDGET_MB = 8192
+
+PipelineKey = tuple[str, str, str, str]
+
+
+@dataclass
+class RegistryStats:
+    """Counters describing how well the registry is serving requests."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    shared_components: int = 0
+    entries: int = 0
+    resident_bytes: int = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+@dataclass
+class _SharedComponent:
+    module: Any
+    nbytes: int
+    refcount: int = 0
+
+
+@dataclass
+class _Entry:
+    pipeline: Any
+    own_bytes: int
+    fingerprints: list[str] = field(default_factory=list)
+
+
+def module_nbytes(module: Any) -> int:
+    """Return the number of bytes held by a module's parameters and buffers."""
+
+    tensors = chain(module.parameters(), module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def weights_fingerprint(module: Any) -> str:
+    """Hash a module's class, tensor layout and raw weights."""
+
+    import torch
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(type(module).__qualname__.encode())
+    for name, tensor in module.state_dict().items():
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        raw = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8)
+        digest.update(raw.numpy().tobytes())
+    return digest.hexdigest()
+
+
+def module_device(module: Any) -> str:
+    """Return the device of a module's first parameter (``cpu`` for modules without any)."""
+
+    for tensor in chain(module.parameters(), module.buffers()):
+        return str(tensor.device)
+    return "cpu"
+
+
+def _budget_from_env() -> int:
+    megabytes = int(os.getenv(BUDGET_ENV, DEFAULT_BUDGET_MB))
+    return megabytes * 1024 * 1024
+
+
+class PipelineRegistry:
+    """Cache pipelines keyed by (model_id, dtype, device, scheduler).
+
+    Entries are evicted least-recently-used first once the resident size of
+    all cached weights exceeds ``max_bytes``. Text encoders whose weights are
+    byte-identical across checkpoints and that live on the same device are
+    stored once and shared between pipelines, and only count against the
+    budget once. Loaders run outside the registry lock, so a slow load only
+    blocks callers waiting for the same key.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        self.max_bytes = _budget_from_env() if max_bytes is None else max_bytes
+        self._entries: OrderedDict[PipelineKey, _Entry] = OrderedDict()
+        self._components: dict[str, _SharedComponent] = {}
+        self._loading: dict[PipelineKey, Future] = {}
+        self._stats = RegistryStats()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    @property
+    def stats(self) -> RegistryStats:
+        with self._lock:
+            return RegistryStats(
+                hits=self._stats.hits,
+                misses=self._stats.misses,
+                evictions=self._stats.evictions,
+                shared_components=self._stats.shared_components,
+                entries=len(self._entries),
+                resident_bytes=self.resident_bytes,
+            )
+
+    @property
+    def resident_bytes(self) -> int:
+        shared = sum(component.nbytes for component in self._components.values())
+        return shared + sum(entry.own_bytes for entry in self._entries.values())
+
+    def get(self, key: PipelineKey, loader: Callable[[], Any]) -> Any:
+        """Return the cached pipeline for ``key``, building it with ``loader`` on a miss.
+
+        Concurrent misses for the same key wait for the first caller's load
+        instead of loading the checkpoint twice.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats.hits += 1
+                return entry.pipeline
+            waiting = self._loading.get(key)
+            if waiting is None:
+                self._stats.misses += 1
+                loading = self._loading[key] = Future()
+            else:
+                self._stats.hits += 1
+        if waiting is not None:
+            return waiting.result()
+
+        try:
+            pipeline = loader()
+            share_keys = self._share_keys(pipeline)
+            with self._lock:
+                self._entries[key] = self._admit(pipeline, share_keys)
+                self._evict(keep=key)
+        except BaseException as exc:
+            loading.set_exception(exc)
+            raise
+        else:
+            loading.set_result(pipeline)
+        finally:
+            with self._lock:
+                del self._loading[key]
+        return pipeline
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._components.clear()
+            gc.collect()
+
+    @staticmethod
+    def _share_keys(pipeline: Any) -> dict[str, str]:
+        """Key each shareable component by its weights and device (hashed outside the lock)."""
+
+        keys = {}
+        for name in SHARED_COMPONENTS:
+            module = getattr(pipeline, name, None)
+            # Offloaded modules keep their weights in hooks, and the hooks are per pipeline.
+            if module is not None and not hasattr(module, "_hf_hook"):
+                keys[name] = f"{weights_fingerprint(module)}@{module_device(module)}"
+        return keys
+
+    def _admit(self, pipeline: Any, share_keys: dict[str, str]) -> _Entry:
+        fingerprints: list[str] = []
+        for name, fingerprint in share_keys.items():
+            module = getattr(pipeline, name)
+            shared = self._components.get(fingerprint)
+            if shared is None:
+                shared = _SharedComponent(module=module, nbytes=module_nbytes(module))
+                self._components[fingerprint] = shared
+            elif shared.module is not module:
+                setattr(pipeline, name, shared.module)
+                self._stats.shared_components += 1
+            shared.refcount += 1
+            fingerprints.append(fingerprint)
+
+        own_bytes = 0
+        for name, module in pipeline.components.items():
+            if name in SHARED_COMPONENTS or not hasattr(module, "parameters"):
+                continue
+            own_bytes += module_nbytes(module)
+        return _Entry(pipeline=pipeline, own_bytes=own_bytes, fingerprints=fingerprints)
+
+    def _evict(self, keep: PipelineKey) -> None:
+        evicted = False
+        while self.resident_bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            for fingerprint in entry.fingerprints:
+                shared = self._components[fingerprint]
+                shared.refcount -= 1
+                if shared.refcount == 0:
+                    del self._components[fingerprint]
+            self._stats.evictions += 1
+            evicted = True
+        if evicted:
+            gc.collect()
+
+
+_default_registry: Optional[PipelineRegistry] = None
+
+
+def default_registry() -> PipelineRegistry:
+    """Return the process-wide registry, creating it on first use."""
+
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = PipelineRegistry()
+    return _default_registry
@@ -0,0 +1,366 @@
+"""Content-addressed store of finished images, keyed by every parameter that determines them."""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import weakref
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+
+from .writer import image_format_for
+
+if TYPE_CHECKING:
+    from .generate import GenerationRequest
+
+BUDGET_ENV = "AIPICT_RESULT_CACHE_MB"
+DEFAULT_BUDGET_MB = 2048
+
+MANIFEST_COLUMNS = (
+    "key",
+    "size",
+    "created",
+    "last_used",
+    "hits",
+    "model",
+    "revision",
+    "prompt",
+    "negative_prompt",
+    "seed",
+    "steps",
+    "guidance_scale",
+    "scheduler",
+    "width",
+    "height",
+)
+
+_revisions: weakref.WeakKeyDictionary[Any, str] = weakref.WeakKeyDictionary()
+_weight_variants: weakref.WeakKeyDictionary[Any, str] = weakref.WeakKeyDictionary()
+
+
+def model_revision(pipeline: Any) -> str:
+    """Identify the exact weights behind ``pipeline``.
+
+    Hub models resolve to the snapshot commit their components were loaded
+    from (falling back to ``refs/main`` in the local Hugging Face cache),
+    local directories to a digest of their file names, sizes and mtimes, and
+    pipelines built in memory to a fingerprint of the UNet weights. Weights
+    changed in place are tagged with ``set_weight_variant``.
+    """
+
+    revision = _revisions.get(pipeline)
+    if revision is None:
+        revision = _source_revision(pipeline)
+        _revisions[pipeline] = revision
+    variant = _weight_variants.get(pipeline)
+    return f"{revision}+{variant}" if variant else revision
+
+
+def set_weight_variant(pipeline: Any, variant: Optional[str]) -> None:
+    """Record that ``pipeline``'s weights were changed in place (``None``: back to the loaded weights).
+
+    The variant (e.g. the fused LoRA stack's key) becomes part of
+    ``model_revision``, so renders with different in-place weights never
+    share result-cache entries. The memoized source revision is dropped too.
+    """
+
+    _revisions.pop(pipeline, None)
+    if variant:
+        _weight_variants[pipeline] = variant
+    else:
+        _weight_variants.pop(pipeline, None)
+
+
+def _source_revision(pipeline: Any) -> str:
+    source = getattr(pipeline, "name_or_path", None)
+    if source and Path(source).is_dir():
+        digest = hashlib.sha256()
+        for path in sorted(Path(source).rglob("*")):
+            if path.is_file():
+                stat = path.stat()
+                digest.update(f"{path.relative_to(source)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+        return f"dir:{digest.hexdigest()[:16]}"
+    if source:
+        # Components loaded from the Hub cache record .../snapshots/<commit>/<component>,
+        # which is the commit actually used even when from_pretrained pinned a revision.
+        loaded_from = Path(str(getattr(pipeline.unet.config, "_name_or_path", "") or ""))
+        if "snapshots" in loaded_from.parts[:-1]:
+            return loaded_from.parts[loaded_from.parts.index("snapshots") + 1]
+        from huggingface_hub.constants import HF_HUB_CACHE
+
+        ref = Path(HF_HUB_CACHE) / f"models--{source.replace('/', '--')}" / "refs" / "main"
+        if ref.is_file():
+            return ref.read_text(encoding="utf-8").strip()
+    from .registry import weights_fingerprint
+
+    return f"weights:{weights_fingerprint(pipeline.unet)}"
+
+
+def generation_params(
+    pipeline: Any,
+    request: GenerationRequest,
+    num_inference_steps: int,
+    guidance_scale: float,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+) -> Optional[dict]:
+    """Every input that determines the image, or ``None`` for unseeded (non-deterministic) requests.
+
+    This includes the memory savers currently switched on (see
+    ``apply_memory_plan``): VAE tiling changes the decoded pixels, and
+    attention and VAE slicing change the floating-point accumulation order.
+    """
+
+    if request.seed is None:
+        return None
+    default_side = pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    scheduler_config = {key: value for key, value in dict(pipeline.scheduler.config).items() if not key.startswith("_")}
+    return {
+        "model": getattr(pipeline, "name_or_path", None) or "",
+        "revision": model_revision(pipeline),
+        "dtype": str(pipeline.unet.dtype),
+        "device": pipeline.device.type,
+        "prompt": request.prompt,
+        "negative_prompt": request.negative_prompt or "",
+        "seed": request.seed,
+        "steps": num_inference_steps,
+        "guidance_scale": float(guidance_scale),
+        "scheduler": type(pipeline.scheduler).__name__,
+        "scheduler_config": scheduler_config,
+        "width": width or default_side,
+        "height": height or default_side,
+        "vae_tiling": bool(getattr(pipeline.vae, "use_tiling", False)),
+        "vae_slicing": bool(getattr(pipeline.vae, "use_slicing", False)),
+        "attention_processors": sorted({type(processor).__name__ for processor in pipeline.unet.attn_processors.values()}),
+        "format": image_format_for(request.output_path),
+    }
+
+
+def result_key(params: dict) -> str:
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ResultCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+def _place(source: Path, target: Path) -> None:
+    """Hard-link ``source`` to ``target`` (copying across filesystems), replacing ``target`` atomically."""
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    tmp_path.replace(target)
+
+
+class ResultCache:
+    """Size-bounded on-disk store of rendered images with an SQLite manifest.
+
+    Images live under ``objects/<key[:2]>/<key>.png`` and are handed out by
+    hard link (or copy across filesystems). The manifest records the
+    generation parameters, size, hit count and last use of every entry;
+    least-recently-used entries are evicted once ``max_bytes`` is exceeded.
+    """
+
+    def __init__(self, cache_dir: Path | str, max_bytes: Optional[int] = None) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if max_bytes is None:
+            max_bytes = int(os.getenv(BUDGET_ENV, DEFAULT_BUDGET_MB)) * 2**20
+        self.max_bytes = max_bytes
+        self._stats = ResultCacheStats()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.cache_dir / "manifest.sqlite", check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    model TEXT,
+                    revision TEXT,
+                    prompt TEXT,
+                    negative_prompt TEXT,
+                    seed INTEGER,
+                    steps INTEGER,
+                    guidance_scale REAL,
+                    scheduler TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    params TEXT NOT NULL
+                )"""
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @property
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            return ResultCacheStats(**self._stats.as_dict())
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def object_path(self, key: str) -> Path:
+        return self.cache_dir / "objects" / key[:2] / f"{key}.png"
+
+    def fetch(self, key: str, output_path: Path | str) -> bool:
+        """Place the stored image for ``key`` at ``output_path``; False on a miss."""
+
+        with self._lock:
+            row = self._db.execute("SELECT key FROM results WHERE key = ?", (key,)).fetchone()
+            source = self.object_path(key)
+            if row is None or not source.exists():
+                if row is not None:
+                    with self._db:
+                        self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._stats.misses += 1
+                return False
+            _place(source, Path(output_path))
+            with self._db:
+                self._db.execute(
+                    "UPDATE results SET hits = hits + 1, last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+            self._stats.hits += 1
+            return True
+
+    def store(self, key: str, image_path: Path | str, params: dict) -> None:
+        """Add the finished image at ``image_path`` and evict old entries past the size bound."""
+
+        target = self.object_path(key)
+        _place(Path(image_path), target)
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    """INSERT OR REPLACE INTO results
+                    (key, size, created, last_used, hits, model, revision, prompt, negative_prompt,
+                     seed, steps, guidance_scale, scheduler, width, height, params)
+                    VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        key,
+                        target.stat().st_size,
+                        now,
+                        now,
+                        params.get("model"),
+                        params.get("revision"),
+                        params.get("prompt"),
+                        params.get("negative_prompt"),
+                        params.get("seed"),
+                        params.get("steps"),
+                        params.get("guidance_scale"),
+                        params.get("scheduler"),
+                        params.get("width"),
+                        params.get("height"),
+                        json.dumps(params, sort_keys=True, default=str),
+                    ),
+                )
+            self._stats.stores += 1
+            self._evict(keep=key)
+
+    def query(self, where: str = "", args: tuple = (), limit: Optional[int] = None) -> list[dict]:
+        """Manifest rows, most recently used first, optionally filtered by an SQL ``where`` clause."""
+
+        sql = f"SELECT {', '.join(MANIFEST_COLUMNS)} FROM results"
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY last_used DESC"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, args)]
+
+    def prune(self, max_bytes: Optional[int] = None) -> int:
+        """Evict down to ``max_bytes`` (default: the configured bound) and return the entries removed."""
+
+        with self._lock:
+            before = self._stats.evictions
+            self._evict(max_bytes=max_bytes)
+            return self._stats.evictions - before
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _evict(self, keep: Optional[str] = None, max_bytes: Optional[int] = None) -> None:
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= limit:
+            return
+        rows = self._db.execute("SELECT key, size FROM results ORDER BY last_used ASC").fetchall()
+        with self._db:
+            for row in rows:
+                if total <= limit:
+                    break
+                if row["key"] == keep:
+                    continue
+                self.object_path(row["key"]).unlink(missing_ok=True)
+                self._db.execute("DELETE FROM results WHERE key = ?", (row["key"],))
+                total -= row["size"]
+                self._stats.evictions += 1
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Inspect or prune the generation result cache")
+    parser.add_argument("cache_dir", help="Result cache directory (as passed to --result-cache)")
+    parser.add_argument("--prompt", default=None, help="Only list entries whose prompt contains this text")
+    parser.add_argument("--model", default=None, help="Only list entries for this model")
+    parser.add_argument("--limit", type=int, default=50, help="Maximum rows to list")
+    parser.add_argument("--prune-mb", type=int, default=None, help="Evict least-recently-used entries down to this size")
+    parser.add_argument("--json", action="store_true", help="Print rows as JSON lines")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    cache = ResultCache(args.cache_dir)
+    if args.prune_mb is not None:
+        removed = cache.prune(args.prune_mb * 2**20)
+        print(f"Evicted {removed} entries")
+
+    clauses, values = [], []
+    if args.prompt:
+        clauses.append("prompt LIKE ?")
+        values.append(f"%{args.prompt}%")
+    if args.model:
+        clauses.append("model = ?")
+        values.append(args.model)
+    rows = cache.query(" AND ".join(clauses), tuple(values), limit=args.limit)
+    for row in rows:
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False))
+        else:
+            print(f"{row['key'][:12]}  hits={row['hits']:<4} seed={row['seed']:<10} {row['model']}  {row['prompt']}")
+    print(f"{len(cache)} entries, {cache.total_bytes / 2**20:.1f} MB of {cache.max_bytes / 2**20:.0f} MB")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+"""Local HTTP generation server with a job queue and dynamic micro-batching."""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from .embeddings import PromptEmbeddingCache
+from .generate import (
+    DEFAULT_MODEL,
+    DEFAULT_SCHEDULER,
+    SCHEDULERS,
+    GenerationRequest,
+    image_metadata,
+    load_pipeline,
+    render_batch,
+)
+from .registry import PipelineRegistry
+from .writer import AsyncImageWriter
+
+DEFAULT_PORT = 7870
+DEFAULT_JOB_TTL = 3600.0
+DEFAULT_MAX_FINISHED_JOBS = 10_000
+TERMINAL_STATES = ("done", "failed")
+
+BatchKey = tuple[str, str, int, Optional[int], Optional[int], float]
+PipelineLoader = Callable[[str, str], Any]
+
+
+@dataclass
+class JobSpec:
+    """Parameters of a single queued render."""
+
+    prompt: str
+    model: str = DEFAULT_MODEL
+    negative_prompt: Optional[str] = None
+    seed: Optional[int] = None
+    steps: int = 30
+    guidance: float = 7.5
+    width: Optional[int] = None
+    height: Optional[int] = None
+    scheduler: str = DEFAULT_SCHEDULER
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.prompt, str) or not self.prompt.strip():
+            raise ValueError("prompt is required")
+        if self.negative_prompt is not None and not isinstance(self.negative_prompt, str):
+            raise ValueError("negative_prompt must be a string")
+        if self.scheduler not in SCHEDULERS:
+            raise ValueError(f"unknown scheduler '{self.scheduler}'")
+        self.steps = int(self.steps)
+        if self.steps < 1:
+            raise ValueError("steps must be at least 1")
+        self.guidance = float(self.guidance)
+        if not math.isfinite(self.guidance):
+            raise ValueError("guidance must be a finite number")
+        for name in ("seed", "width", "height"):
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, int(value))
+        # A bad job would fail the whole micro-batch it is coalesced into, so reject it here.
+        for name in ("width", "height"):
+            value = getattr(self, name)
+            if value is not None and (value <= 0 or value % 8):
+                raise ValueError(f"{name} must be a positive multiple of 8")
+
+    @classmethod
+    def from_payload(cls, payload: dict, default_model: str = DEFAULT_MODEL) -> "JobSpec":
+        unknown = set(payload) - set(cls.__dataclass_fields__)
+        if unknown:
+            raise ValueError(f"unknown fields: {sorted(unknown)}")
+        return cls(**{"model": default_model, **payload})
+
+    @property
+    def batch_key(self) -> BatchKey:
+        """Jobs with equal keys can share one pipeline call."""
+
+        return (self.model, self.scheduler, self.steps, self.width, self.height, self.guidance)
+
+
+@dataclass
+class Job:
+    id: str
+    spec: JobSpec
+    output_path: Path
+    status: str = "queued"
+    error: Optional[str] = None
+    batch_size: Optional[int] = None
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    version: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "output_path": str(self.output_path),
+            "error": self.error,
+            "batch_size": self.batch_size,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "spec": asdict(self.spec),
+        }
+
+
+class QueueFull(Exception):
+    """Raised when the server holds ``max_queue`` pending jobs or is shutting down."""
+
+
+class GenerationService:
+    """Serialize renders on one worker thread, coalescing compatible jobs.
+
+    The worker takes the oldest queued job and waits up to ``max_wait`` seconds
+    (measured from that job's arrival) for more jobs with the same model,
+    scheduler, steps, resolution and guidance, up to ``max_batch_size``. The
+    batch then runs as one pipeline call; incompatible jobs keep their place
+    in the queue.
+
+    Finished jobs stay queryable for ``job_ttl`` seconds, and at most
+    ``max_finished_jobs`` of them are kept (oldest dropped first).
+    """
+
+    def __init__(
+        self,
+        output_dir: Path | str = "outputs/server",
+        default_model: str = DEFAULT_MODEL,
+        device: Optional[str] = None,
+        use_half_precision: bool = True,
+        max_batch_size: int = 4,
+        max_wait: float = 0.05,
+        max_queue: int = 1024,
+        pipeline_loader: Optional[PipelineLoader] = None,
+        writer: Optional[AsyncImageWriter] = None,
+        embedding_cache: Optional[PromptEmbeddingCache] = None,
+        job_ttl: float = DEFAULT_JOB_TTL,
+        max_finished_jobs: int = DEFAULT_MAX_FINISHED_JOBS,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.output_dir = Path(output_dir)
+        self.default_model = default_model
+        self.device = device
+        self.use_half_precision = use_half_precision
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        self.registry = PipelineRegistry()
+        self.pipeline_loader = pipeline_loader or self._load_pipeline
+        self.writer = writer or AsyncImageWriter()
+        self.embedding_cache = embedding_cache if embedding_cache is not None else PromptEmbeddingCache()
+        self.batches_run = 0
+        self._jobs: dict[str, Job] = {}
+        # Ids of finished jobs, oldest finish first.
+        self._finished: OrderedDict[str, float] = OrderedDict()
+        self._queue: list[Job] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name="aipict-batcher", daemon=True)
+
+    def start(self) -> None:
+        self._worker.start()
+
+    def stop(self) -> None:
+        """Stop the worker and fail every job still queued, so pollers and streams see a terminal state."""
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._worker.is_alive():
+            self._worker.join()
+        with self._cond:
+            abandoned, self._queue = self._queue, []
+        for job in abandoned:
+            self._fail(job, RuntimeError("server shut down before the job ran"))
+        self.writer.close()
+
+    def submit(self, spec: JobSpec) -> Job:
+        with self._cond:
+            if self._stopped:
+                raise QueueFull("server is shutting down")
+            if len(self._queue) >= self.max_queue:
+                raise QueueFull(f"queue already holds {len(self._queue)} jobs")
+            self._prune_finished()
+            job_id = uuid.uuid4().hex
+            job = Job(id=job_id, spec=spec, output_path=self.output_dir / f"{job_id}.png")
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def snapshot(self, job: Job) -> dict:
+        with self._cond:
+            return job.as_dict()
+
+    def wait(self, job: Job, version: int, timeout: Optional[float] = None) -> dict:
+        """Block until ``job`` changes past ``version`` or reaches a terminal state."""
+
+        with self._cond:
+            self._cond.wait_for(
+                lambda: job.version > version or job.status in TERMINAL_STATES,
+                timeout=timeout,
+            )
+            return job.as_dict() | {"version": job.version}
+
+    def health(self) -> dict:
+        with self._cond:
+            queued = len(self._queue)
+        return {
+            "queued": queued,
+            "batches_run": self.batches_run,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": round(self.max_wait * 1000),
+            "registry": self.registry.stats.as_dict(),
+            "embedding_cache": self.embedding_cache.stats.as_dict(),
+        }
+
+    def next_batch(self) -> list[Job]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._queue or self._stopped)
+            if self._stopped:
+                return []
+            head = self._queue[0]
+            deadline = time.monotonic() + max(0.0, head.created + self.max_wait - time.time())
+            while True:
+                batch = [job for job in self._queue if job.spec.batch_key == head.spec.batch_key]
+                batch = batch[: self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0 or self._stopped:
+                    break
+                self._cond.wait(remaining)
+            for job in batch:
+                self._queue.remove(job)
+                self._update(job, status="running", started=time.time(), batch_size=len(batch))
+            return batch
+
+    def run_batch(self, batch: list[Job]) -> None:
+        spec = batch[0].spec
+        requests = [
+            GenerationRequest(
+                prompt=job.spec.prompt,
+                output_path=job.output_path,
+                seed=job.spec.seed,
+                negative_prompt=job.spec.negative_prompt,
+            )
+            for job in batch
+        ]
+        try:
+            pipeline = self.pipeline_loader(spec.model, spec.scheduler)
+            images = render_batch(
+                pipeline,
+                requests,
+                num_inference_steps=spec.steps,
+                guidance_scale=spec.guidance,
+                width=spec.width,
+                height=spec.height,
+                embedding_cache=self.embedding_cache,
+            )
+        except Exception as error:  # noqa: BLE001 - reported through the job status
+            for job in batch:
+                self._fail(job, error)
+            return
+        finally:
+            self.batches_run += 1
+
+        for index, (job, request, image) in enumerate(zip(batch, requests, images)):
+            metadata = image_metadata(request, spec.steps, spec.guidance)
+            try:
+                future = self.writer.submit(image, job.output_path, metadata)
+            except Exception as error:  # noqa: BLE001 - e.g. the writer was closed
+                for remaining in batch[index:]:
+                    self._fail(remaining, error)
+                return
+            future.add_done_callback(lambda done, job=job: self._finish(job, done))
+
+    def _run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            try:
+                self.run_batch(batch)
+            except Exception as error:  # noqa: BLE001 - keep the worker alive for later batches
+                for job in batch:
+                    if job.status not in TERMINAL_STATES:
+                        self._fail(job, error)
+
+    def _load_pipeline(self, model: str, scheduler: str) -> Any:
+        return load_pipeline(
+            model,
+            device=self.device,
+            use_half_precision=self.use_half_precision,
+            scheduler=scheduler,
+            registry=self.registry,
+        )
+
+    def _finish(self, job: Job, future: Any) -> None:
+        error = future.exception()
+        if error is not None:
+            self._fail(job, error)
+        else:
+            self._update(job, status="done", finished=time.time())
+
+    def _fail(self, job: Job, error: BaseException) -> None:
+        self._update(job, status="failed", error=f"{type(error).__name__}: {error}", finished=time.time())
+
+    def _update(self, job: Job, **changes: Any) -> None:
+        with self._cond:
+            for name, value in changes.items():
+                setattr(job, name, value)
+            job.version += 1
+            if job.status in TERMINAL_STATES:
+                self._finished[job.id] = job.finished or time.time()
+                self._finished.move_to_end(job.id)
+                self._prune_finished()
+            self._cond.notify_all()
+
+    def _prune_finished(self) -> None:
+        """Forget finished jobs older than ``job_ttl`` or beyond ``max_finished_jobs`` (caller holds the lock)."""
+
+        expiry = time.time() - self.job_ttl
+        while self._finished:
+            job_id, finished = next(iter(self._finished.items()))
+            if finished >= expiry and len(self._finished) <= self.max_finished_jobs:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    """JSON API: ``POST /jobs``, ``GET /jobs/<id>``, ``GET /jobs/<id>/events``, ``GET /health``."""
+
+    service: GenerationService
+
+    def do_POST(self) -> None:  # noqa: N802 - http.server naming
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(payload, dict):
+                raise ValueError("body must be a JSON object")
+            spec = JobSpec.from_payload(payload, default_model=self.service.default_model)
+        except (ValueError, TypeError) as error:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(error)})
+            return
+        try:
+            job = self.service.submit(spec)
+        except QueueFull as error:
+            self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(error)})
+            return
+        self._send_json(HTTPStatus.ACCEPTED, self.service.snapshot(job))
+
+    def do_GET(self) -> None:  # noqa: N802 - http.server naming
+        path, _, query = self.path.partition("?")
+        parts = [part for part in path.split("/") if part]
+        if parts == ["health"]:
+            self._send_json(HTTPStatus.OK, self.service.health())
+            return
+        if len(parts) not in (2, 3) or parts[0] != "jobs" or (len(parts) == 3 and parts[2] != "events"):
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        job = self.service.get(parts[1])
+        if job is None:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown job {parts[1]}"})
+            return
+        if len(parts) == 3:
+            self._stream_events(job)
+        elif "wait=1" in query.split("&"):
+            self._send_json(HTTPStatus.OK, self.service.wait(job, version=job.version, timeout=30.0))
+        else:
+            self._send_json(HTTPStatus.OK, self.service.snapshot(job))
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002 - signature from base class
+        if os.getenv("AIPICT_SERVER_ACCESS_LOG"):
+            super().log_message(format, *args)
+
+    def _stream_events(self, job: Job) -> None:
+        """Send every status change as a server-sent event until the job ends."""
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        version = -1
+        while True:
+            state = self.service.wait(job, version=version, timeout=15.0)
+            if state["version"] != version:
+                self.wfile.write(f"data: {json.dumps(state)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                version = state["version"]
+            if state["status"] in TERMINAL_STATES:
+                return
+
+    def _send_json(self, status: HTTPStatus, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(service: GenerationService, host: str = "127.0.0.1", port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+    handler = type("BoundGenerationHandler", (GenerationHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve Stable Diffusion renders over a local HTTP job queue")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument(
+        "--model",
+        default=os.getenv("MODEL_ID", DEFAULT_MODEL),
+        help="Model used by jobs that do not name one",
+    )
+    parser.add_argument("--output-dir", default="outputs/server", help="Where finished images are written")
+    parser.add_argument("--max-batch-size", type=int, default=4, help="Most jobs coalesced into one pipeline call")
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=50.0,
+        help="How long the oldest job may wait for compatible jobs before its batch starts",
+    )
+    parser.add_argument("--max-queue", type=int, default=1024, help="Pending jobs accepted before returning 503")
+    parser.add_argument(
+        "--job-ttl",
+        type=float,
+        default=DEFAULT_JOB_TTL,
+        help="Seconds a finished job stays queryable",
+    )
+    parser.add_argument(
+        "--max-finished-jobs",
+        type=int,
+        default=DEFAULT_MAX_FINISHED_JOBS,
+        help="Most finished jobs kept for status queries",
+    )
+    parser.add_argument("--device", default=None, help="Force a device (cpu/cuda)")
+    parser.add_argument(
+        "--no-fp16",
+        dest="use_half_precision",
+        action="store_false",
+        help="Disable half precision weights",
+    )
+    parser.set_defaults(use_half_precision=True)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    service = GenerationService(
+        output_dir=args.output_dir,
+        default_model=args.model,
+        device=args.device,
+        use_half_precision=args.use_half_precision,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        max_queue=args.max_queue,
+        job_ttl=args.job_ttl,
+        max_finished_jobs=args.max_finished_jobs,
+    )
+    service.start()
+    server = make_server(service, host=args.host, port=args.port)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Turnaround and seed/prompt/guidance sweeps that share noise and embeddings."""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Sequence
+
+from .embeddings import PromptEmbeddingCache
+from .generate import (
+    DEFAULT_MODEL,
+    DEFAULT_SCHEDULER,
+    SCHEDULERS,
+    GenerationRequest,
+    image_metadata,
+    load_pipeline,
+    load_prompts,
+    render_batch,
+)
+from .writer import save_image_atomic
+
+if TYPE_CHECKING:
+    import torch
+
+SHEET_LABEL_HEIGHT = 18
+
+
+@dataclass
+class SweepVariant:
+    """One cell of a sweep: a labelled prompt rendered with a given seed and guidance."""
+
+    label: str
+    prompt: str
+    seed: int
+    guidance_scale: float
+    output_path: Path
+    negative_prompt: Optional[str] = None
+
+    def as_request(self) -> GenerationRequest:
+        return GenerationRequest(
+            prompt=self.prompt,
+            output_path=self.output_path,
+            seed=self.seed,
+            negative_prompt=self.negative_prompt,
+        )
+
+
+def parse_resolution(value: str) -> tuple[int, int]:
+    """Parse a preset resolution such as ``"1024x1024"`` into (width, height)."""
+
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def join_prompt(prefix: str, suffix: str) -> str:
+    return f"{prefix.rstrip(', ')}, {suffix}" if suffix else prefix
+
+
+def variants_from_preset(
+    preset: dict,
+    output_dir: Path | str,
+    seeds: Optional[Sequence[int]] = None,
+    guidance_scales: Optional[Sequence[float]] = None,
+) -> list[SweepVariant]:
+    """Expand a preset's ``views``/``view_prompts`` into one variant per view, seed and guidance.
+
+    Presets without views (e.g. ``lightnovel_pose``) produce a single column
+    labelled with their ``view`` (or ``name``).
+    """
+
+    output_dir = Path(output_dir)
+    seeds = list(seeds) if seeds else [int(preset.get("seed", 0))]
+    guidance_scales = list(guidance_scales) if guidance_scales else [float(preset.get("cfg", 7.5))]
+    view_prompts = preset.get("view_prompts", {})
+    views = preset.get("views") or [preset.get("view") or preset.get("name", "image")]
+
+    variants = []
+    for seed, guidance, view in itertools.product(seeds, guidance_scales, views):
+        variants.append(
+            SweepVariant(
+                label=view,
+                prompt=join_prompt(preset["prompt"], view_prompts.get(view, "")),
+                seed=seed,
+                guidance_scale=guidance,
+                negative_prompt=preset.get("negative_prompt"),
+                output_path=output_dir / f"{preset.get('name', 'sweep')}_{view}_s{seed}_g{guidance:g}.png",
+            )
+        )
+    return variants
+
+
+def grid_variants(
+    prompts: Sequence[str],
+    seeds: Sequence[int],
+    guidance_scales: Sequence[float],
+    output_dir: Path | str,
+    negative_prompt: Optional[str] = None,
+) -> list[SweepVariant]:
+    """Build the full seed x prompt x guidance grid."""
+
+    output_dir = Path(output_dir)
+    return [
+        SweepVariant(
+            label=f"p{prompt_index}",
+            prompt=prompt,
+            seed=seed,
+            guidance_scale=guidance,
+            negative_prompt=negative_prompt,
+            output_path=output_dir / f"p{prompt_index}_s{seed}_g{guidance:g}.png",
+        )
+        for seed, guidance, (prompt_index, prompt) in itertools.product(seeds, guidance_scales, enumerate(prompts))
+    ]
+
+
+def initial_noise(pipeline: Any, seed: int, width: int, height: int) -> torch.Tensor:
+    """Draw the same ``[1, C, H/8, W/8]`` noise the pipeline would draw for ``seed``."""
+
+    import torch
+    from diffusers.utils.torch_utils import randn_tensor
+
+    shape = (
+        1,
+        pipeline.unet.config.in_channels,
+        height // pipeline.vae_scale_factor,
+        width // pipeline.vae_scale_factor,
+    )
+    generator = torch.Generator(device=pipeline.device).manual_seed(seed)
+    return randn_tensor(shape, generator=generator, device=pipeline.device, dtype=pipeline.text_encoder.dtype)
+
+
+def run_sweep(
+    pipeline: Any,
+    variants: Sequence[SweepVariant],
+    num_inference_steps: int = 30,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    batch_size: int = 8,
+    embedding_cache: Optional[PromptEmbeddingCache] = None,
+) -> list[tuple[SweepVariant, Any]]:
+    """Render every variant and return ``(variant, image)`` pairs in input order.
+
+    Initial noise is drawn once per seed and reused by every variant with that
+    seed, and prompts/negatives go through ``embedding_cache`` so each distinct
+    text is encoded once. Variants sharing a guidance scale run together in
+    batches of up to ``batch_size``. Each image is saved to its variant's
+    ``output_path`` as soon as its batch finishes.
+    """
+
+    import torch
+
+    width = width or pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    height = height or pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    if embedding_cache is None:
+        embedding_cache = PromptEmbeddingCache()
+    noise = {seed: initial_noise(pipeline, seed, width, height) for seed in dict.fromkeys(v.seed for v in variants)}
+
+    groups: OrderedDict[float, list[int]] = OrderedDict()
+    for index, variant in enumerate(variants):
+        groups.setdefault(variant.guidance_scale, []).append(index)
+
+    images: dict[int, Any] = {}
+    for guidance, indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start : start + batch_size]
+            requests = [variants[index].as_request() for index in chunk]
+            rendered = render_batch(
+                pipeline,
+                requests,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance,
+                width=width,
+                height=height,
+                embedding_cache=embedding_cache,
+                latents=torch.cat([noise[variants[index].seed] for index in chunk]),
+            )
+            for index, request, image in zip(chunk, requests, rendered):
+                save_image_atomic(image, request.output_path, image_metadata(request, num_inference_steps, guidance))
+                images[index] = image
+    return [(variant, images[index]) for index, variant in enumerate(variants)]
+
+
+def make_contact_sheet(results: Sequence[tuple[SweepVariant, Any]], columns: Optional[int] = None) -> Any:
+    """Tile rendered images into one labelled sheet, ``columns`` per row."""
+
+    from PIL import Image, ImageDraw
+
+    if not results:
+        raise ValueError("nothing to put on a contact sheet")
+    columns = columns or len(dict.fromkeys(variant.label for variant, _ in results))
+    tile_width = max(image.width for _, image in results)
+    tile_height = max(image.height for _, image in results) + SHEET_LABEL_HEIGHT
+    rows = -(-len(results) // columns)
+    sheet = Image.new("RGB", (columns * tile_width, rows * tile_height), "white")
+    draw = ImageDraw.Draw(sheet)
+    for position, (variant, image) in enumerate(results):
+        left = (position % columns) * tile_width
+        top = (position // columns) * tile_height
+        sheet.paste(image, (left, top))
+        label = f"{variant.label} seed={variant.seed} cfg={variant.guidance_scale:g}"
+        draw.text((left + 2, top + image.height + 3), label, fill="black")
+    return sheet
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Render a turnaround preset or a seed x prompt x guidance grid")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--preset", help="Preset JSON with views/view_prompts (e.g. turnaround_workflow.json)")
+    source.add_argument("--prompts", help="File with one prompt per line for a grid sweep")
+    parser.add_argument("--negative", default=None, help="Negative prompt for grid sweeps")
+    parser.add_argument("--seeds", nargs="+", type=int, default=None, help="Seeds to sweep (preset seed by default)")
+    parser.add_argument("--guidance", nargs="+", type=float, default=None, help="Guidance scales to sweep")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Model repo id")
+    parser.add_argument("--scheduler", default=None, choices=sorted(SCHEDULERS), help="Override the sampler")
+    parser.add_argument("--steps", type=int, default=None, help="Override the number of inference steps")
+    parser.add_argument("--width", type=int, default=None, help="Override the image width")
+    parser.add_argument("--height", type=int, default=None, help="Override the image height")
+    parser.add_argument("--batch-size", type=int, default=8, help="Variants per pipeline call")
+    parser.add_argument("--output-dir", default="outputs/sweep", help="Where images and the contact sheet go")
+    parser.add_argument("--device", default=None, help="Force a device (cpu/cuda)")
+    parser.add_argument(
+        "--no-fp16",
+        dest="use_half_precision",
+        action="store_false",
+        help="Disable half precision weights",
+    )
+    parser.set_defaults(use_half_precision=True)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    output_dir = Path(args.output_dir)
+    width, height, steps, scheduler = args.width, args.height, args.steps or 30, args.scheduler
+    if args.preset:
+        preset = json.loads(Path(args.preset).read_text(encoding="utf-8"))
+        variants = variants_from_preset(preset, output_dir, seeds=args.seeds, guidance_scales=args.guidance)
+        if "resolution" in preset:
+            preset_width, preset_height = parse_resolution(preset["resolution"])
+            width, height = width or preset_width, height or preset_height
+        steps = args.steps or int(preset.get("steps", steps))
+        scheduler = scheduler or preset.get("sampler")
+    else:
+        variants = grid_variants(
+            load_prompts(args.prompts),
+            seeds=args.seeds or [0],
+            guidance_scales=args.guidance or [7.5],
+            output_dir=output_dir,
+            negative_prompt=args.negative,
+        )
+
+    pipe = load_pipeline(
+        args.model,
+        device=args.device,
+        use_half_precision=args.use_half_precision,
+        scheduler=scheduler if scheduler in SCHEDULERS else DEFAULT_SCHEDULER,
+    )
+    results = run_sweep(pipe, variants, num_inference_steps=steps, width=width, height=height, batch_size=args.batch_size)
+    for variant, _ in results:
+        print(f"Saved image to {variant.output_path}")
+    sheet_path = save_image_atomic(make_contact_sheet(results), output_dir / "contact_sheet.png")
+    print(f"Saved contact sheet to {sheet_path}")
+
+
+if __name__ == "__main__":
+    main()
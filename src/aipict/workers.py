@@ -0,0 +1,159 @@
+"""Multi-process CPU rendering that shards a job list across pinned workers."""
+from __future__ import annotations
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+from .generate import DEFAULT_SCHEDULER, GenerationRequest, iter_generate_images, load_pipeline
+
+
+@dataclass(frozen=True)
+class WorkerConfig:
+    """Everything a worker needs to load its pipeline and render jobs."""
+
+    model_id: str
+    scheduler: str = DEFAULT_SCHEDULER
+    num_inference_steps: int = 30
+    guidance_scale: float = 7.5
+    width: Optional[int] = None
+    height: Optional[int] = None
+    device: str = "cpu"
+    use_half_precision: bool = False
+
+
+@dataclass
+class JobResult:
+    index: int
+    output_path: Path
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def available_cores() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(workers: int, cores: Optional[Sequence[int]] = None) -> list[list[int]]:
+    """Split ``cores`` into ``workers`` contiguous slices (cores are reused if there are fewer)."""
+
+    cores = list(cores if cores is not None else available_cores())
+    if workers <= len(cores):
+        size, extra = divmod(len(cores), workers)
+        slices, start = [], 0
+        for index in range(workers):
+            end = start + size + (1 if index < extra else 0)
+            slices.append(cores[start:end])
+            start = end
+        return slices
+    return [[cores[index % len(cores)]] for index in range(workers)]
+
+
+_worker_state: dict[str, Any] = {}
+
+
+def _init_worker(config: WorkerConfig, core_slices: list[list[int]], slot: Any) -> None:
+    import torch
+
+    with slot.get_lock():
+        index = slot.value
+        slot.value += 1
+    try:
+        cores = core_slices[index % len(core_slices)]
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        torch.set_num_interop_threads(1)
+
+        pipeline = load_pipeline(
+            config.model_id,
+            device=config.device,
+            use_half_precision=config.use_half_precision,
+            scheduler=config.scheduler,
+        )
+        pipeline.set_progress_bar_config(disable=True)
+    except Exception as error:  # noqa: BLE001 - a raising initializer breaks the whole pool
+        _worker_state.update(config=config, init_error=f"worker initialization failed: {type(error).__name__}: {error}")
+        return
+    _worker_state.update(config=config, pipeline=pipeline)
+
+
+def _render_chunk(chunk: list[tuple[int, GenerationRequest]]) -> list[JobResult]:
+    """Render one chunk; a failure only marks the jobs whose images were not saved yet."""
+
+    if "init_error" in _worker_state:
+        return [JobResult(index, Path(request.output_path), _worker_state["init_error"]) for index, request in chunk]
+    config: WorkerConfig = _worker_state["config"]
+    written: set[Path] = set()
+    message = None
+    try:
+        # Saved inline (no writer), so every yielded path is already on disk.
+        for path in iter_generate_images(
+            _worker_state["pipeline"],
+            [request for _, request in chunk],
+            batch_size=len(chunk),
+            num_inference_steps=config.num_inference_steps,
+            guidance_scale=config.guidance_scale,
+            width=config.width,
+            height=config.height,
+        ):
+            written.add(Path(path))
+    except Exception as error:  # noqa: BLE001 - reported per job instead of killing the pool
+        message = f"{type(error).__name__}: {error}"
+    return [
+        JobResult(index, Path(request.output_path), None if Path(request.output_path) in written else message)
+        for index, request in chunk
+    ]
+
+
+def run_pool(
+    requests: Sequence[GenerationRequest],
+    config: WorkerConfig,
+    workers: int = 2,
+    batch_size: int = 1,
+    cores: Optional[Sequence[int]] = None,
+) -> list[JobResult]:
+    """Render ``requests`` on ``workers`` processes and return results in request order.
+
+    Each worker loads the pipeline once, pins itself to its own slice of
+    ``cores`` and sets ``torch.set_num_threads`` to the slice size. Jobs are
+    handed out ``batch_size`` at a time from a shared list; since every
+    request carries its own seed and output path, the images match a serial
+    run. When a chunk fails, the jobs whose images were not saved report the
+    error through ``JobResult.error`` while the remaining jobs keep running.
+    A worker that cannot load its pipeline fails every chunk it takes with
+    the load error, and a worker that dies fails the chunks left unfinished.
+    """
+
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    indexed = list(enumerate(requests))
+    chunks = [indexed[start : start + batch_size] for start in range(0, len(indexed), batch_size)]
+    context = multiprocessing.get_context("spawn")
+    slot = context.Value("i", 0)
+
+    results: list[JobResult] = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(config, partition_cores(workers, cores), slot),
+    ) as executor:
+        futures = [executor.submit(_render_chunk, chunk) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.extend(future.result())
+            except BrokenProcessPool as error:
+                # A worker died (e.g. killed for memory); its chunk and every unfinished one fail.
+                message = f"{type(error).__name__}: {error}"
+                results.extend(JobResult(index, Path(request.output_path), message) for index, request in chunk)
+    return sorted(results, key=lambda result: result.index)
@@ -0,0 +1,142 @@
+"""Background image writer that keeps PNG encoding off the render loop."""
+from __future__ import annotations
+
+import os
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Mapping, Optional
+
+
+def image_format_for(path: Path | str) -> str:
+    """The PIL format ``save_image_atomic`` encodes ``path`` with (PNG for unknown suffixes)."""
+
+    from PIL import Image
+
+    return Image.registered_extensions().get(Path(path).suffix.lower(), "PNG")
+
+
+def save_image_atomic(image: Any, path: Path | str, metadata: Optional[Mapping[str, Any]] = None) -> Path:
+    """Save ``image`` via a temporary file in the target directory and rename it into place.
+
+    ``metadata`` is stored as PNG text chunks; other formats ignore it.
+    """
+
+    from PIL.PngImagePlugin import PngInfo
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    image_format = image_format_for(path)
+
+    options: dict[str, Any] = {}
+    if metadata and image_format == "PNG":
+        info = PngInfo()
+        for key, value in metadata.items():
+            if value is not None:
+                info.add_text(key, str(value))
+        options["pnginfo"] = info
+
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        image.save(tmp_path, format=image_format, **options)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+class AsyncImageWriter:
+    """Encode and write images on a thread pool with a bounded queue.
+
+    ``submit`` blocks once ``max_pending`` writes are in flight, so a fast
+    producer cannot pile up decoded images in memory. ``flush`` is a barrier
+    that waits for every queued write and re-raises the first failure.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8) -> None:
+        if max_workers < 1 or max_pending < 1:
+            raise ValueError("max_workers and max_pending must be at least 1")
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aipict-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: set[Future] = set()
+        self._errors: list[BaseException] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self) -> "AsyncImageWriter":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def submit(
+        self,
+        image: Any,
+        path: Path | str,
+        metadata: Optional[Mapping[str, Any]] = None,
+        on_written: Optional[Callable[[Path], None]] = None,
+    ) -> "Future[Path]":
+        """Queue ``image`` for writing; ``on_written(path)`` runs on the writer thread before the future completes."""
+
+        if self._closed:
+            raise RuntimeError("writer is closed")
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, image, path, metadata, on_written)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._release)
+        return future
+
+    def flush(self) -> None:
+        """Block until every submitted image is on disk."""
+
+        with self._lock:
+            futures = list(self._pending)
+        for future in futures:
+            future.exception()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._executor.shutdown(wait=True)
+
+    def _write(
+        self,
+        image: Any,
+        path: Path | str,
+        metadata: Optional[Mapping[str, Any]],
+        on_written: Optional[Callable[[Path], None]] = None,
+    ) -> Path:
+        try:
+            written = save_image_atomic(image, path, metadata)
+            if on_written is not None:
+                on_written(written)
+            return written
+        except BaseException as error:
+            with self._lock:
+                self._errors.append(error)
+            raise
+
+    def _release(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
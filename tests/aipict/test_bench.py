@@ -0,0 +1,33 @@
+import copy
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from aipict.bench import BenchCase, compare_results, percentiles, run_suite  # noqa: E402
+
+
+def test_percentiles() -> None:
+    stats = percentiles([4.0, 1.0, 3.0, 2.0, 5.0])
+    assert stats["p50"] == 3.0
+    assert stats["p99"] == 5.0
+    assert stats["mean"] == 3.0
+
+
+def test_suite_reports_every_metric_and_compares() -> None:
+    report = run_suite([BenchCase(scheduler="euler", batch_size=2, resolution=64)], steps=2, repeats=1, warmup=0)
+    (result,) = report["results"]
+    assert result["case"] == "euler/b2/64px/float32"
+    assert result["images_per_sec"] > 0
+    assert result["load_seconds"] > 0
+    assert result["peak_rss_mb"] > 0
+    assert len(report["meta"]) >= 5
+    assert set(result["latency_ms"]) == {"p50", "p90", "p99", "mean"}
+    assert result["step_ms"]["p50"] > 0
+
+    assert compare_results(report, report) == []
+    slower = copy.deepcopy(report)
+    slower["results"][0]["images_per_sec"] /= 2
+    slower["results"][0]["latency_ms"]["p50"] *= 2
+    assert len(compare_results(slower, report, tolerance=0.2)) == 2
@@ -0,0 +1,77 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("safetensors")
+
+from aipict.embeddings import PromptEmbeddingCache  # noqa: E402
+
+
+class FakeTokenizer:
+    name_or_path = "fake-tokenizer"
+    model_max_length = 6
+
+    def __len__(self) -> int:
+        return 128
+
+    def __call__(self, text, max_length, **kwargs):
+        ids = [ord(char) % 128 for char in text][:max_length]
+        ids += [0] * (max_length - len(ids))
+        return SimpleNamespace(input_ids=torch.tensor([ids]), attention_mask=torch.ones(1, max_length))
+
+
+class FakeTextEncoder(torch.nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        torch.manual_seed(0)
+        self.embedding = torch.nn.Embedding(128, 4)
+        self.config = SimpleNamespace()
+        self.calls = 0
+
+    @property
+    def dtype(self):
+        return self.embedding.weight.dtype
+
+    def forward(self, input_ids, attention_mask=None):
+        self.calls += 1
+        return (self.embedding(input_ids),)
+
+
+def make_pipeline() -> SimpleNamespace:
+    return SimpleNamespace(device=torch.device("cpu"), tokenizer=FakeTokenizer(), text_encoder=FakeTextEncoder())
+
+
+def test_repeated_text_is_encoded_once() -> None:
+    pipeline = make_pipeline()
+    cache = PromptEmbeddingCache(max_entries=2)
+    first = cache.encode(pipeline, "char:Shirayuki_Aoi")
+    second = cache.encode(pipeline, "char:Shirayuki_Aoi")
+    assert first is second
+    assert first.shape == (1, 6, 4)
+    assert pipeline.text_encoder.calls == 1
+    assert cache.encode_batch(pipeline, ["a", "b", "a"]).shape == (3, 6, 4)
+    assert len(cache) == 2
+    assert (cache.stats.hits, cache.stats.misses) == (2, 3)
+
+
+def test_disk_store_survives_new_cache(tmp_path: Path) -> None:
+    pipeline = make_pipeline()
+    expected = PromptEmbeddingCache(cache_dir=tmp_path).encode(pipeline, "blurry, low quality")
+
+    fresh = PromptEmbeddingCache(cache_dir=tmp_path)
+    loaded = fresh.encode(pipeline, "blurry, low quality")
+    assert torch.equal(loaded, expected)
+    assert fresh.stats.disk_hits == 1
+    assert pipeline.text_encoder.calls == 1
+
+
+def test_modified_encoder_gets_new_key() -> None:
+    pipeline = make_pipeline()
+    cache = PromptEmbeddingCache()
+    before = cache.key(pipeline, "prompt")
+    with torch.no_grad():
+        pipeline.text_encoder.embedding.weight.add_(1.0)
+    cache.forget(pipeline.text_encoder)
+    assert cache.key(pipeline, "prompt") != before
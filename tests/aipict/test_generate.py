@@ -0,0 +1,64 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+from aipict.generate import build_requests, generate_images, load_prompts  # noqa: E402
+
+
+class RecordingPipeline:
+    device = "cpu"
+
+    def __init__(self) -> None:
+        self.calls: list[dict] = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        images = []
+        for generator in kwargs["generator"]:
+            value = int(torch.randint(0, 255, (1,), generator=generator))
+            images.append(Image.new("RGB", (8, 8), (value, 0, 0)))
+        return SimpleNamespace(images=images)
+
+
+def test_load_prompts_skips_comments(tmp_path: Path) -> None:
+    prompt_file = tmp_path / "prompts.txt"
+    prompt_file.write_text("# nightly\nfirst prompt\n\n  second prompt  \n", encoding="utf-8")
+    assert load_prompts(prompt_file) == ["first prompt", "second prompt"]
+
+
+def test_generate_images_micro_batches(tmp_path: Path) -> None:
+    pipeline = RecordingPipeline()
+    requests = build_requests([f"prompt {i}" for i in range(5)], output_dir=tmp_path, seed=10)
+    paths = generate_images(pipeline, requests, batch_size=2, num_inference_steps=2)
+
+    assert [len(call["prompt"]) for call in pipeline.calls] == [2, 2, 1]
+    assert paths == [tmp_path / f"{i:04d}.png" for i in range(5)]
+    assert all(path.exists() for path in paths)
+    assert [request.seed for request in requests] == [10, 11, 12, 13, 14]
+
+
+def test_generate_images_seed_is_independent_of_batching(tmp_path: Path) -> None:
+    prompts = ["a", "b", "c"]
+    batched = generate_images(RecordingPipeline(), build_requests(prompts, tmp_path / "batched", seed=3), batch_size=3)
+    single = generate_images(RecordingPipeline(), build_requests(prompts, tmp_path / "single", seed=3), batch_size=1)
+    for left, right in zip(batched, single):
+        assert Image.open(left).getpixel((0, 0)) == Image.open(right).getpixel((0, 0))
+
+
+def test_tiny_pipeline_batches_match_single_renders(tmp_path: Path) -> None:
+    pytest.importorskip("diffusers")
+    from aipict.bench import build_tiny_pipeline
+
+    pipeline = build_tiny_pipeline()
+    prompts = ["char:aoi, front view", "char:aoi, back view"]
+    requests = build_requests(prompts, tmp_path / "batched", seed=5, negative_prompt="blurry")
+    batched = generate_images(pipeline, requests, batch_size=2, num_inference_steps=2)
+    singles = [
+        generate_images(pipeline, [request], batch_size=1, num_inference_steps=2)[0].read_bytes()
+        for request in build_requests(prompts, tmp_path / "single", seed=5, negative_prompt="blurry")
+    ]
+    assert [path.read_bytes() for path in batched] == singles
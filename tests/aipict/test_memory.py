@@ -0,0 +1,100 @@
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.generate import build_requests, generate_images  # noqa: E402
+from aipict.memory import (  # noqa: E402
+    MemoryPlan,
+    apply_memory_plan,
+    estimate_unet_bytes,
+    is_sequentially_offloaded,
+    plan_memory,
+    uses_fused_attention,
+)
+from aipict.registry import PipelineRegistry  # noqa: E402
+
+
+def test_unbounded_budget_keeps_the_plain_plan() -> None:
+    pipeline = build_tiny_pipeline()
+    plan = plan_memory(pipeline, batch_size=4, width=64, height=64)
+    assert plan == MemoryPlan(batch_size=4, predicted_peak_bytes=plan.predicted_peak_bytes)
+    assert plan.fits
+
+
+def test_tight_budget_adds_savers_then_shrinks_the_batch() -> None:
+    pipeline = build_tiny_pipeline()
+    plain = plan_memory(pipeline, batch_size=4, width=256, height=256)
+    plan = plan_memory(pipeline, batch_size=4, width=256, height=256, budget_bytes=plain.predicted_peak_bytes - 1)
+    assert plan.fits and plan.predicted_peak_bytes < plain.predicted_peak_bytes
+    assert plan.vae_slicing and plan.vae_tiling and plan.batch_size < 4
+    # The UNet already uses fused attention, where slicing would add memory.
+    assert plan.attention_slicing is None
+
+    impossible = plan_memory(pipeline, batch_size=4, width=256, height=256, budget_bytes=1)
+    assert not impossible.fits and impossible.batch_size == 1
+
+
+def test_attention_slicing_only_pays_off_without_fused_attention() -> None:
+    pipeline = build_tiny_pipeline()
+    assert uses_fused_attention(pipeline.unet)
+    apply_memory_plan(pipeline, MemoryPlan(batch_size=1, attention_slicing="max"))
+    assert not uses_fused_attention(pipeline.unet)
+    assert estimate_unet_bytes(pipeline, 2, 256, 256, attention_slicing="max") < estimate_unet_bytes(pipeline, 2, 256, 256)
+    apply_memory_plan(pipeline, MemoryPlan(batch_size=1))
+    assert uses_fused_attention(pipeline.unet)
+
+
+def test_sequential_offload_is_undone_by_a_plan_without_it() -> None:
+    pytest.importorskip("accelerate")
+    pipeline = build_tiny_pipeline()
+    weights = {name: tensor.clone() for name, tensor in pipeline.unet.state_dict().items()}
+
+    apply_memory_plan(pipeline, MemoryPlan(batch_size=1, sequential_offload=True))
+    assert is_sequentially_offloaded(pipeline)
+    assert next(pipeline.unet.parameters()).device.type == "meta"
+    # Re-applying the same plan must not stack a second set of hooks.
+    apply_memory_plan(pipeline, MemoryPlan(batch_size=1, sequential_offload=True))
+
+    apply_memory_plan(pipeline, MemoryPlan(batch_size=1))
+    assert not is_sequentially_offloaded(pipeline)
+    assert str(pipeline.device) == "cpu"
+    restored = pipeline.unet.state_dict()
+    assert all(restored[name].equal(tensor) for name, tensor in weights.items())
+
+
+def test_offload_does_not_touch_a_shared_text_encoder() -> None:
+    pytest.importorskip("accelerate")
+    registry = PipelineRegistry(max_bytes=1 << 40)
+    offloaded = registry.get(("a", "torch.float32", "cpu", "euler"), build_tiny_pipeline)
+    other = registry.get(("b", "torch.float32", "cpu", "euler"), build_tiny_pipeline)
+    assert offloaded.text_encoder is other.text_encoder
+
+    apply_memory_plan(offloaded, MemoryPlan(batch_size=1, sequential_offload=True))
+    assert offloaded.text_encoder is not other.text_encoder
+    assert not hasattr(other.text_encoder, "_hf_hook")
+    assert next(other.text_encoder.parameters()).device.type == "cpu"
+
+    apply_memory_plan(offloaded, MemoryPlan(batch_size=1))
+    assert not is_sequentially_offloaded(offloaded) and not is_sequentially_offloaded(other)
+    assert next(other.text_encoder.parameters()).device.type == "cpu"
+
+
+def test_memory_plan_caps_the_micro_batch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    pipeline = build_tiny_pipeline()
+    calls = []
+    original = type(pipeline).__call__
+
+    def counting_call(self, **kwargs):
+        calls.append(len(kwargs["generator"]))
+        return original(self, **kwargs)
+
+    monkeypatch.setattr(type(pipeline), "__call__", counting_call)
+    plan = MemoryPlan(batch_size=1, vae_slicing=True)
+    requests = build_requests(["a", "b", "c"], tmp_path, seed=0)
+    generate_images(pipeline, requests, batch_size=3, num_inference_steps=1, memory_plan=plan)
+    assert calls == [1, 1, 1]
+    assert pipeline.vae.use_slicing
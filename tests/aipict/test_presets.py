@@ -0,0 +1,153 @@
+import json
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.presets import LoraSpec, PresetRunner, fuse_lora, preset_loras, resolve_preset  # noqa: E402
+from aipict.results import model_revision  # noqa: E402
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def write_kohya_lora(pipeline, path: Path, seed: int) -> dict:
+    generator = torch.Generator().manual_seed(seed)
+    state = {}
+    targets = [("lora_unet_", pipeline.unet, "attn1.to_q"), ("lora_te_", pipeline.text_encoder, "self_attn.q_proj")]
+    for prefix, model, suffix in targets:
+        for name, module in model.named_modules():
+            if name.endswith(suffix):
+                key = prefix + name.replace(".", "_")
+                state[f"{key}.lora_down.weight"] = torch.randn(2, module.in_features, generator=generator)
+                state[f"{key}.lora_up.weight"] = torch.randn(module.out_features, 2, generator=generator)
+                state[f"{key}.alpha"] = torch.tensor(1.0)
+    safetensors_torch.save_file(state, str(path))
+    return state
+
+
+def snapshot(pipeline) -> dict:
+    return {
+        f"{component}.{name}": tensor.clone()
+        for component in ("unet", "text_encoder")
+        for name, tensor in getattr(pipeline, component).state_dict().items()
+    }
+
+
+def assert_same(left: dict, right: dict) -> None:
+    assert left.keys() == right.keys()
+    assert all(torch.equal(left[name], right[name]) for name in left)
+
+
+def test_resolve_preset_by_registry_id() -> None:
+    preset = resolve_preset(
+        "turnaround_batch",
+        ROOT / "config" / "phase3" / "preset_registry.json",
+        ROOT / "presets" / "comfyui",
+    )
+    assert preset["views"] == ["front", "side", "back"]
+    assert preset_loras(preset)[0] == LoraSpec("ShirayukiAoi_character_v1", 0.65)
+    with pytest.raises(KeyError):
+        resolve_preset("missing", ROOT / "config" / "phase3" / "preset_registry.json")
+
+
+def test_fuse_lora_applies_scaled_delta(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    state = write_kohya_lora(pipeline, tmp_path / "a.safetensors", seed=1)
+    name = next(name for name, _ in pipeline.unet.named_modules() if name.endswith("attn1.to_q"))
+    before = pipeline.unet.get_submodule(name).weight.clone()
+    key = "lora_unet_" + name.replace(".", "_")
+
+    assert fuse_lora(pipeline, state, weight=0.5) == len(state) // 3
+    expected = before + 0.5 * 0.5 * state[f"{key}.lora_up.weight"] @ state[f"{key}.lora_down.weight"]
+    assert torch.allclose(pipeline.unet.get_submodule(name).weight, expected, atol=1e-6)
+
+
+def test_runner_reuses_fused_weights(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    lora_dir = tmp_path / "loras"
+    lora_dir.mkdir()
+    write_kohya_lora(pipeline, lora_dir / "char.safetensors", seed=1)
+    write_kohya_lora(pipeline, lora_dir / "style.safetensors", seed=2)
+    runner = PresetRunner("tiny", lora_dir=lora_dir, cache_dir=tmp_path / "fused", pipeline=pipeline)
+    base = snapshot(pipeline)
+
+    stack_a = (LoraSpec("char", 0.7), LoraSpec("style", 0.35))
+    stack_b = (LoraSpec("char", 0.65),)
+    base_revision = model_revision(pipeline)
+    runner.apply_loras(stack_a)
+    fused_a = snapshot(pipeline)
+    assert model_revision(pipeline) != base_revision
+    runner.apply_loras(stack_b)
+    runner.apply_loras(stack_a)
+    assert runner.fused_from_scratch == 2
+    assert_same(snapshot(pipeline), fused_a)
+    runner.apply_loras(())
+    assert_same(snapshot(pipeline), base)
+    assert model_revision(pipeline) == base_revision
+
+
+def test_failed_stack_leaves_clean_weights(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    lora_dir = tmp_path / "loras"
+    lora_dir.mkdir()
+    write_kohya_lora(pipeline, lora_dir / "char.safetensors", seed=1)
+    write_kohya_lora(pipeline, lora_dir / "style.safetensors", seed=2)
+    unknown = {
+        "lora_unet_no_such_layer.lora_down.weight": torch.zeros(2, 4),
+        "lora_unet_no_such_layer.lora_up.weight": torch.zeros(4, 2),
+    }
+    safetensors_torch.save_file(unknown, str(lora_dir / "broken.safetensors"))
+    clean = build_tiny_pipeline()
+    fuse_lora(clean, safetensors_torch.load_file(str(lora_dir / "style.safetensors")), 0.5)
+
+    runner = PresetRunner("tiny", lora_dir=lora_dir, cache_dir=tmp_path / "fused", pipeline=pipeline)
+    with pytest.raises(FileNotFoundError):
+        runner.apply_loras((LoraSpec("char", 1.0), LoraSpec("missing", 1.0)))
+    with pytest.raises(ValueError):
+        runner.apply_loras((LoraSpec("char", 1.0), LoraSpec("broken", 1.0)))
+    runner.apply_loras((LoraSpec("char", 1.0),))
+    with pytest.raises(ValueError):
+        runner.apply_loras((LoraSpec("style", 1.0), LoraSpec("broken", 1.0)))
+    assert runner.active == (LoraSpec("char", 1.0),)
+
+    runner.apply_loras((LoraSpec("style", 0.5),))
+    assert_same(snapshot(pipeline), snapshot(clean))
+
+
+def test_fused_cache_evicts_least_recently_used_stacks(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    lora_dir = tmp_path / "loras"
+    lora_dir.mkdir()
+    for seed, name in enumerate(("char", "style", "outfit"), start=1):
+        write_kohya_lora(pipeline, lora_dir / f"{name}.safetensors", seed=seed)
+    runner = PresetRunner("tiny", lora_dir=lora_dir, cache_dir=tmp_path / "fused", pipeline=pipeline)
+    cache = runner.fused_cache
+    base = snapshot(pipeline)
+
+    runner.apply_loras((LoraSpec("char", 1.0),))
+    entry_bytes = sum(path.stat().st_size for path in cache.path(next(iter(cache.pinned))).iterdir())
+    # Room for the pinned base weights and two stacks.
+    cache.max_bytes = 3 * entry_bytes + entry_bytes // 2
+    runner.apply_loras((LoraSpec("style", 1.0),))
+    runner.apply_loras((LoraSpec("char", 1.0),))
+    runner.apply_loras((LoraSpec("outfit", 1.0),))
+
+    keys = {name: cache.key("tiny", runner.dtype, (LoraSpec(name, 1.0),), lora_dir) for name in ("char", "style", "outfit")}
+    assert keys["char"] in cache and keys["outfit"] in cache and keys["style"] not in cache
+    assert cache.prune(max_bytes=0) == 2
+    assert [path.name for path in cache.cache_dir.iterdir()] == list(cache.pinned)
+    runner.apply_loras(())
+    assert_same(snapshot(pipeline), base)
+
+
+def test_runner_renders_preset_views(tmp_path: Path) -> None:
+    preset = json.loads((ROOT / "presets" / "comfyui" / "turnaround_workflow.json").read_text(encoding="utf-8"))
+    preset.update(loras=[], resolution="64x64", steps=2)
+    runner = PresetRunner("tiny", cache_dir=tmp_path / "fused", pipeline=build_tiny_pipeline())
+    results = runner.run(preset, tmp_path / "out")
+    assert [variant.label for variant, _ in results] == ["front", "side", "back"]
+    assert all(variant.output_path.exists() and image.size == (64, 64) for variant, image in results)
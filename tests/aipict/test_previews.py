@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.generate import generate_image  # noqa: E402
+from aipict.previews import (  # noqa: E402
+    GenerationAborted,
+    LatentPreviewer,
+    fit_latent_rgb_factors,
+    latents_to_rgb,
+    stream_previews,
+)
+
+
+def test_latents_project_to_low_resolution_rgb() -> None:
+    latents = torch.zeros(2, 4, 8, 6)
+    latents[:, 0] = 1.0
+    images = latents_to_rgb(latents, [[1, 0, 0], [0, 1, 0], [0, 0, 1], [0, 0, 0]])
+    assert [image.size for image in images] == [(6, 8), (6, 8)]
+    assert images[0].getpixel((0, 0)) == (255, 128, 128)
+
+
+def test_previewer_delivers_every_n_steps(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    previews = []
+    previewer = LatentPreviewer(every=2, on_preview=previews.append, factors=fit_latent_rgb_factors(pipeline)[0])
+    path = generate_image(pipeline, "aoi", seed=1, num_inference_steps=5, output_path=tmp_path / "a.png", previewer=previewer)
+    assert path.exists()
+    assert [(preview.step, preview.total_steps) for preview in previews] == [(2, 5), (4, 5), (5, 5)]
+    assert previews[0].images[0].size == (32, 32)
+
+
+def test_abort_stops_denoising_and_writes_nothing(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    unet_calls = []
+    pipeline.unet.register_forward_hook(lambda *args: unet_calls.append(1))
+    previewer = LatentPreviewer(every=1, should_abort=lambda step: step == 2)
+    with pytest.raises(GenerationAborted) as aborted:
+        generate_image(pipeline, "aoi", seed=1, num_inference_steps=6, output_path=tmp_path / "a.png", previewer=previewer)
+    assert aborted.value.step == 2 and len(unet_calls) == 2
+    assert not (tmp_path / "a.png").exists()
+
+
+def test_stream_yields_previews_then_the_path(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    stream = stream_previews(
+        lambda previewer: generate_image(
+            pipeline, "aoi", seed=1, num_inference_steps=4, output_path=tmp_path / "a.png", previewer=previewer
+        ),
+        every=2,
+    )
+    items = list(stream)
+    assert [item.step for item in items] == [2, 4, 4]
+    assert items[-1].final and items[-1].path.exists()
+
+    stream = stream_previews(
+        lambda previewer: generate_image(
+            pipeline, "aoi", seed=1, num_inference_steps=8, output_path=tmp_path / "b.png", previewer=previewer
+        ),
+        every=1,
+    )
+    assert next(stream).step == 1
+    stream.close()
+    assert not (tmp_path / "b.png").exists()
@@ -0,0 +1,31 @@
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.generate import build_requests, generate_images  # noqa: E402
+from aipict.profiling import GenerationProfiler  # noqa: E402
+
+
+def test_profiler_records_every_stage(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    profiler = GenerationProfiler()
+    requests = build_requests(["char:aoi", "char:aoi, back"], tmp_path, seed=1, negative_prompt="blurry")
+    generate_images(pipeline, requests, batch_size=2, num_inference_steps=3, profiler=profiler)
+
+    stages = {stage["stage"]: stage for stage in profiler.summary()}
+    assert {"pipeline", "text_encoder", "unet", "scheduler_step", "vae_decode", "image_save"} <= set(stages)
+    assert stages["denoise_step"]["count"] == 3
+    assert stages["image_save"]["count"] == 2
+    assert "denoise_step" in profiler.format_summary()
+
+    assert not pipeline.unet._forward_hooks and not pipeline.unet._forward_pre_hooks
+    assert "step" not in vars(pipeline.scheduler)
+
+    trace = json.loads(profiler.write_chrome_trace(tmp_path / "trace.json").read_text())
+    spans = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert spans and all(event["dur"] >= 0 and "rss_mb" in event["args"] for event in spans)
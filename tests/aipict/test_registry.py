@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from aipict import registry as registry_module  # noqa: E402
+from aipict.registry import PipelineRegistry, module_nbytes  # noqa: E402
+
+
+class FakePipeline:
+    def __init__(self, seed: int, encoder_seed: int = 0) -> None:
+        torch.manual_seed(seed)
+        self.unet = torch.nn.Linear(16, 16)
+        torch.manual_seed(encoder_seed)
+        self.text_encoder = torch.nn.Linear(8, 8)
+        self.vae = torch.nn.Linear(4, 4)
+
+    @property
+    def components(self) -> dict:
+        return {"unet": self.unet, "text_encoder": self.text_encoder, "vae": self.vae}
+
+
+def key(name: str) -> tuple[str, str, str, str]:
+    return (name, "torch.float32", "cpu", "dpmpp_2m")
+
+
+def test_registry_returns_warm_pipeline() -> None:
+    registry = PipelineRegistry(max_bytes=1 << 30)
+    loads = []
+
+    def loader() -> FakePipeline:
+        loads.append(1)
+        return FakePipeline(seed=1)
+
+    first = registry.get(key("a"), loader)
+    second = registry.get(key("a"), loader)
+    assert first is second
+    assert len(loads) == 1
+    stats = registry.stats
+    assert (stats.hits, stats.misses, stats.evictions) == (1, 1, 0)
+
+
+def test_registry_shares_identical_components() -> None:
+    registry = PipelineRegistry(max_bytes=1 << 30)
+    first = registry.get(key("a"), lambda: FakePipeline(seed=1))
+    second = registry.get(key("b"), lambda: FakePipeline(seed=2))
+    assert second.text_encoder is first.text_encoder
+    # VAEs stay per pipeline: memory plans switch tiling/slicing on them
+    assert second.vae is not first.vae
+    assert second.unet is not first.unet
+    assert registry.stats.shared_components == 1
+    own = module_nbytes(first.unet) + module_nbytes(first.vae)
+    assert registry.resident_bytes == module_nbytes(first.text_encoder) + 2 * own
+
+
+def test_registry_does_not_share_across_devices(monkeypatch) -> None:
+    monkeypatch.setattr(registry_module, "module_device", lambda module: getattr(module, "fake_device", "cpu"))
+    registry = PipelineRegistry(max_bytes=1 << 30)
+
+    def on_device(device: str) -> FakePipeline:
+        pipeline = FakePipeline(seed=1)
+        pipeline.text_encoder.fake_device = device
+        return pipeline
+
+    first = registry.get(("a", "torch.float32", "cpu", "dpmpp_2m"), lambda: on_device("cpu"))
+    second = registry.get(("a", "torch.float32", "cuda", "dpmpp_2m"), lambda: on_device("cuda"))
+    assert second.text_encoder is not first.text_encoder
+    assert registry.stats.shared_components == 0
+
+
+def test_registry_does_not_share_offloaded_components() -> None:
+    registry = PipelineRegistry(max_bytes=1 << 30)
+    first = registry.get(key("a"), lambda: FakePipeline(seed=1))
+    offloaded = FakePipeline(seed=2)
+    offloaded.text_encoder._hf_hook = object()
+    second = registry.get(key("b"), lambda: offloaded)
+    assert second.text_encoder is not first.text_encoder
+    assert registry.stats.shared_components == 0
+
+
+def test_slow_load_does_not_block_other_keys() -> None:
+    registry = PipelineRegistry(max_bytes=1 << 30)
+    registry.get(key("warm"), lambda: FakePipeline(seed=1))
+    started, release = threading.Event(), threading.Event()
+    loads = []
+
+    def slow_loader() -> FakePipeline:
+        loads.append(1)
+        started.set()
+        release.wait(5)
+        return FakePipeline(seed=2)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get(key("slow"), slow_loader))) for _ in range(2)]
+    threads[0].start()
+    assert started.wait(5)
+    threads[1].start()
+    # the warm key is served while the slow load is still running
+    assert registry.get(key("warm"), lambda: pytest.fail("reloaded")) is not None
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(loads) == 1
+    assert len(results) == 2 and results[0] is results[1]
+
+
+def test_registry_evicts_least_recently_used() -> None:
+    own_bytes = module_nbytes(torch.nn.Linear(16, 16))
+    own_bytes += module_nbytes(torch.nn.Linear(4, 4))
+    shared_bytes = module_nbytes(torch.nn.Linear(8, 8))
+    registry = PipelineRegistry(max_bytes=shared_bytes + 2 * own_bytes)
+    registry.get(key("a"), lambda: FakePipeline(seed=1))
+    registry.get(key("b"), lambda: FakePipeline(seed=2))
+    registry.get(key("a"), lambda: FakePipeline(seed=1))
+    registry.get(key("c"), lambda: FakePipeline(seed=3))
+    assert key("b") not in registry
+    assert key("a") in registry and key("c") in registry
+    assert registry.stats.evictions == 1
+    assert registry.resident_bytes <= registry.max_bytes or len(registry) == 1
@@ -0,0 +1,104 @@
+import os
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+Image = pytest.importorskip("PIL.Image")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.generate import build_requests, generate_images  # noqa: E402
+from aipict.results import ResultCache, generation_params, model_revision, result_key, set_weight_variant  # noqa: E402
+from aipict.writer import AsyncImageWriter  # noqa: E402
+
+
+def test_rerun_links_cached_images_instead_of_denoising(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    pipeline = build_tiny_pipeline()
+    cache = ResultCache(tmp_path / "cache")
+    first = build_requests(["a", "b"], tmp_path / "first", seed=5)
+    generate_images(pipeline, first, batch_size=2, num_inference_steps=2, result_cache=cache)
+    assert len(cache) == 2 and cache.stats.misses == 2
+
+    calls = []
+    original = type(pipeline).__call__
+    monkeypatch.setattr(type(pipeline), "__call__", lambda self, **kw: calls.append(kw) or original(self, **kw))
+    rerun = build_requests(["a", "b", "c"], tmp_path / "rerun", seed=5)
+    rerun[2].seed = None
+    paths = generate_images(pipeline, rerun, batch_size=2, num_inference_steps=2, result_cache=cache)
+
+    assert [len(call["generator"]) for call in calls] == [1]
+    assert [path.name for path in paths] == ["0000.png", "0001.png", "0002.png"]
+    key = result_key(generation_params(pipeline, rerun[0], 2, 7.5))
+    assert os.path.samefile(tmp_path / "rerun" / "0000.png", cache.object_path(key))
+    assert (tmp_path / "rerun" / "0001.png").read_bytes() == (tmp_path / "first" / "0001.png").read_bytes()
+    assert cache.stats.hits == 2
+    assert {row["prompt"] for row in cache.query("seed = ?", (5,))} == {"a"}
+
+
+def test_cache_hits_are_returned_in_request_order(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    cache = ResultCache(tmp_path / "cache")
+    generate_images(pipeline, build_requests(["a", "b"], tmp_path / "first", seed=5), num_inference_steps=2, result_cache=cache)
+    # "x" (seed 5) is rendered, "b" (seed 6) is a hit and is produced first
+    rerun = build_requests(["x", "b"], tmp_path / "rerun", seed=5)
+    paths = generate_images(pipeline, rerun, num_inference_steps=2, result_cache=cache)
+    assert cache.stats.hits == 1
+    assert paths == [request.output_path for request in rerun]
+
+
+def test_parameters_change_the_key(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    (request,) = build_requests(["a"], tmp_path, seed=1)
+    base = generation_params(pipeline, request, 2, 7.5)
+    assert base == generation_params(pipeline, request, 2, 7.5)
+    assert base != generation_params(pipeline, request, 3, 7.5)
+    assert base != generation_params(pipeline, request, 2, 7.5, width=128, height=128)
+    pipeline.enable_vae_tiling()
+    assert base != generation_params(pipeline, request, 2, 7.5)
+    pipeline.disable_vae_tiling()
+    pipeline.enable_vae_slicing()
+    assert base != generation_params(pipeline, request, 2, 7.5)
+    pipeline.disable_vae_slicing()
+    assert base == generation_params(pipeline, request, 2, 7.5)
+    set_weight_variant(pipeline, "loras:abc")
+    assert base != generation_params(pipeline, request, 2, 7.5)
+    set_weight_variant(pipeline, None)
+    assert base == generation_params(pipeline, request, 2, 7.5)
+    request.output_path = tmp_path / "0000.jpg"
+    assert base != generation_params(pipeline, request, 2, 7.5)
+    request.seed = None
+    assert generation_params(pipeline, request, 2, 7.5) is None
+
+
+def test_hub_revision_is_the_loaded_snapshot(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    pipeline.register_to_config(_name_or_path="org/model")
+    snapshot = tmp_path / "hub" / "models--org--model" / "snapshots" / "0123abcd"
+    pipeline.unet.register_to_config(_name_or_path=str(snapshot / "unet"))
+    assert model_revision(pipeline) == "0123abcd"
+
+
+def test_lru_eviction_respects_the_size_bound(tmp_path: Path) -> None:
+    source = tmp_path / "image.png"
+    Image.new("RGB", (32, 32), "red").save(source)
+    size = source.stat().st_size
+    cache = ResultCache(tmp_path / "cache", max_bytes=2 * size)
+    for key in ("aa", "bb"):
+        cache.store(key, source, {"prompt": key})
+    assert cache.fetch("aa", tmp_path / "out.png")
+    cache.store("cc", source, {"prompt": "cc"})
+
+    assert {row["key"] for row in cache.query()} == {"aa", "cc"}
+    assert not cache.object_path("bb").exists()
+    assert cache.stats.evictions == 1 and cache.total_bytes <= 2 * size
+
+
+def test_writer_renders_are_stored_once_written(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    cache = ResultCache(tmp_path / "cache")
+    with AsyncImageWriter() as writer:
+        requests = build_requests(["a"], tmp_path, seed=3)
+        generate_images(pipeline, requests, num_inference_steps=2, writer=writer, result_cache=cache)
+        writer.flush()
+        assert len(cache) == 1
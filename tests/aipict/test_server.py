@@ -0,0 +1,155 @@
+import json
+import threading
+import urllib.request
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+from aipict.server import GenerationService, JobSpec, QueueFull, make_server  # noqa: E402
+from aipict.writer import AsyncImageWriter  # noqa: E402
+
+
+class FakePipeline:
+    device = "cpu"
+
+    def __init__(self) -> None:
+        self.batch_sizes: list[int] = []
+
+    def __call__(self, **kwargs):
+        self.batch_sizes.append(len(kwargs["generator"]))
+        return SimpleNamespace(images=[Image.new("RGB", (8, 8)) for _ in kwargs["generator"]])
+
+
+class FakeEmbeddingCache:
+    def encode_batch(self, pipeline, texts):
+        return list(texts)
+
+
+@pytest.fixture()
+def service(tmp_path: Path):
+    pipeline = FakePipeline()
+    service = GenerationService(
+        output_dir=tmp_path,
+        max_batch_size=3,
+        max_wait=0.3,
+        pipeline_loader=lambda model, scheduler: pipeline,
+        embedding_cache=FakeEmbeddingCache(),
+    )
+    service.pipeline = pipeline
+    yield service
+    service.stop()
+
+
+def wait_done(service: GenerationService, job) -> dict:
+    state = service.wait(job, version=-1, timeout=5)
+    while state["status"] not in ("done", "failed"):
+        state = service.wait(job, version=state["version"], timeout=5)
+    return state
+
+
+def test_compatible_jobs_are_coalesced(service: GenerationService) -> None:
+    jobs = [service.submit(JobSpec(prompt=f"p{i}", model="m", steps=2)) for i in range(4)]
+    other = service.submit(JobSpec(prompt="other", model="m", steps=5))
+    service.start()
+    states = [wait_done(service, job) for job in [*jobs, other]]
+
+    assert [state["status"] for state in states] == ["done"] * 5
+    assert service.pipeline.batch_sizes == [3, 1, 1]
+    assert [state["batch_size"] for state in states] == [3, 3, 3, 1, 1]
+    assert all(Path(state["output_path"]).exists() for state in states)
+
+
+def test_http_roundtrip(service: GenerationService) -> None:
+    service.start()
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        request = urllib.request.Request(
+            f"{base}/jobs",
+            data=json.dumps({"prompt": "hero", "steps": 2, "seed": 1}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 202
+            job_id = json.load(response)["job_id"]
+
+        with urllib.request.urlopen(f"{base}/jobs/{job_id}/events") as response:
+            events = [json.loads(line[6:]) for line in response.read().decode().splitlines() if line]
+        assert events[-1]["status"] == "done"
+
+        bad = urllib.request.Request(f"{base}/jobs", data=b'{"steps": 2}')
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(bad)
+        assert excinfo.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_finished_jobs_are_evicted(tmp_path: Path) -> None:
+    pipeline = FakePipeline()
+    service = GenerationService(
+        output_dir=tmp_path,
+        max_batch_size=1,
+        max_wait=0,
+        pipeline_loader=lambda model, scheduler: pipeline,
+        embedding_cache=FakeEmbeddingCache(),
+        # One writer thread, so jobs finish (and are evicted) in submission order.
+        writer=AsyncImageWriter(max_workers=1),
+        max_finished_jobs=2,
+    )
+    service.start()
+    try:
+        jobs = [service.submit(JobSpec(prompt=f"p{i}", model="m", steps=2)) for i in range(4)]
+        for job in jobs:
+            wait_done(service, job)
+        assert [service.get(job.id) is not None for job in jobs] == [False, False, True, True]
+
+        service.job_ttl = 0
+        service.submit(JobSpec(prompt="late", model="m", steps=2))
+        assert service.get(jobs[3].id) is None
+    finally:
+        service.stop()
+
+
+def test_writer_failure_fails_remaining_jobs(service: GenerationService) -> None:
+    service.writer.close()
+    jobs = [service.submit(JobSpec(prompt=f"p{i}", model="m", steps=2)) for i in range(2)]
+    service.start()
+    states = [wait_done(service, job) for job in jobs]
+    assert [state["status"] for state in states] == ["failed", "failed"]
+
+    # the worker thread survives and keeps serving (and failing) later batches
+    later = service.submit(JobSpec(prompt="later", model="m", steps=2))
+    assert wait_done(service, later)["status"] == "failed"
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"negative_prompt": ["blurry"]},
+        {"steps": 0},
+        {"guidance": "nan"},
+        {"guidance": float("inf")},
+        {"width": 100},
+        {"height": -64},
+    ],
+)
+def test_invalid_specs_are_rejected(payload: dict) -> None:
+    with pytest.raises(ValueError):
+        JobSpec.from_payload({"prompt": "p", **payload})
+
+
+def test_stop_fails_jobs_still_queued(service: GenerationService) -> None:
+    jobs = [service.submit(JobSpec(prompt=f"p{i}", model="m", steps=2)) for i in range(2)]
+    service.stop()
+    states = [wait_done(service, job) for job in jobs]
+    assert [state["status"] for state in states] == ["failed", "failed"]
+    assert "shut down" in states[0]["error"]
+    with pytest.raises(QueueFull):
+        service.submit(JobSpec(prompt="late", model="m", steps=2))
@@ -0,0 +1,61 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+HEAVY_MODULES = ("torch", "diffusers", "transformers", "safetensors", "PIL", "numpy")
+# Generous bound: a cold ``import aipict`` takes a few milliseconds, while
+# pulling torch in takes seconds.
+IMPORT_BUDGET_SECONDS = 0.5
+
+
+def run_python(code: str) -> dict:
+    env = {**os.environ, "PYTHONPATH": str(PROJECT_ROOT / "src")}
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_import_aipict_is_lightweight() -> None:
+    report = run_python(
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import aipict\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps({{'elapsed': elapsed, 'heavy': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    assert report["heavy"] == [], f"import aipict loaded {report['heavy']}"
+    assert report["elapsed"] < IMPORT_BUDGET_SECONDS, f"import aipict took {report['elapsed']:.3f}s"
+
+
+@pytest.mark.parametrize("module", ["aipict.generate", "aipict.server"])
+def test_cli_help_does_not_load_torch(module: str) -> None:
+    report = run_python(
+        "import contextlib, io, json, runpy, sys\n"
+        f"sys.argv = [{module!r}, '--help']\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        "    try:\n"
+        f"        runpy.run_module({module!r}, run_name='__main__')\n"
+        "    except SystemExit:\n"
+        "        pass\n"
+        f"print(json.dumps({{'heavy': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    assert report["heavy"] == []
+
+
+def test_lazy_attributes_resolve() -> None:
+    report = run_python(
+        "import json, sys, aipict\n"
+        "names = [aipict.generate_image.__name__, aipict.load_pipeline.__name__, aipict.PipelineRegistry.__name__]\n"
+        "print(json.dumps({'names': names, 'torch': 'torch' in sys.modules}))\n"
+    )
+    assert report == {"names": ["generate_image", "load_pipeline", "PipelineRegistry"], "torch": False}
@@ -0,0 +1,49 @@
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+np = pytest.importorskip("numpy")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.embeddings import PromptEmbeddingCache  # noqa: E402
+from aipict.generate import render_batch  # noqa: E402
+from aipict.sweep import grid_variants, make_contact_sheet, run_sweep, variants_from_preset  # noqa: E402
+
+PRESET = Path(__file__).resolve().parents[2] / "presets" / "comfyui" / "turnaround_workflow.json"
+
+
+def test_variants_from_turnaround_preset(tmp_path: Path) -> None:
+    preset = json.loads(PRESET.read_text(encoding="utf-8"))
+    variants = variants_from_preset(preset, tmp_path)
+    assert [variant.label for variant in variants] == ["front", "side", "back"]
+    assert {variant.seed for variant in variants} == {777}
+    assert {variant.guidance_scale for variant in variants} == {5.5}
+    assert variants[1].prompt.endswith(", profile view, shoulders aligned, neutral pose")
+    assert variants[0].negative_prompt == preset["negative_prompt"]
+
+
+def test_sweep_matches_plain_batch_and_encodes_each_text_once(tmp_path: Path) -> None:
+    pipeline = build_tiny_pipeline()
+    variants = grid_variants(["aoi", "aoi, back"], seeds=[3, 4], guidance_scales=[5.0], output_dir=tmp_path, negative_prompt="blurry")
+    cache = PromptEmbeddingCache()
+    results = run_sweep(pipeline, variants, num_inference_steps=2, width=64, height=64, embedding_cache=cache)
+
+    assert cache.stats.misses == 3
+    reference = render_batch(
+        pipeline,
+        [variant.as_request() for variant in variants],
+        num_inference_steps=2,
+        guidance_scale=5.0,
+        width=64,
+        height=64,
+        embedding_cache=PromptEmbeddingCache(),
+    )
+    for (variant, image), expected in zip(results, reference):
+        assert variant.output_path.exists()
+        assert np.array_equal(np.asarray(image), np.asarray(expected))
+
+    sheet = make_contact_sheet(results)
+    assert sheet.size[0] == 2 * 64 and sheet.size[1] > 2 * 64
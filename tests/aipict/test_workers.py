@@ -0,0 +1,53 @@
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from aipict.bench import build_tiny_pipeline  # noqa: E402
+from aipict.generate import build_requests, generate_images, load_pipeline  # noqa: E402
+from aipict.workers import WorkerConfig, partition_cores, run_pool  # noqa: E402
+
+
+def test_partition_cores() -> None:
+    assert partition_cores(2, [0, 1, 2, 3, 4]) == [[0, 1, 2], [3, 4]]
+    assert partition_cores(3, [0, 1]) == [[0], [1], [0]]
+
+
+def test_pool_matches_serial_run_and_reports_failures(tmp_path: Path) -> None:
+    model_dir = tmp_path / "tiny-sd"
+    build_tiny_pipeline(workdir=tmp_path).save_pretrained(model_dir)
+    prompts = ["char:aoi, front", "char:aoi, side", "char:aoi, back", "char:aoi, hero"]
+    config = WorkerConfig(model_id=str(model_dir), scheduler="euler", num_inference_steps=2, width=64, height=64)
+
+    pooled = build_requests(prompts, tmp_path / "pool", seed=11)
+    (tmp_path / "blocked").write_text("not a directory", encoding="utf-8")
+    pooled[3].output_path = tmp_path / "blocked" / "0003.png"
+    results = run_pool(pooled, config, workers=2, batch_size=2)
+
+    assert [result.index for result in results] == [0, 1, 2, 3]
+    # The chunk (2, 3) fails on saving job 3, after job 2 was written.
+    assert [result.ok for result in results] == [True, True, True, False]
+    assert results[3].error
+
+    serial = generate_images(
+        load_pipeline(str(model_dir), device="cpu", use_half_precision=False, scheduler="euler"),
+        build_requests(prompts, tmp_path / "serial", seed=11),
+        batch_size=2,
+        num_inference_steps=2,
+        width=64,
+        height=64,
+    )
+    for index in (0, 1, 2):
+        assert results[index].output_path.read_bytes() == serial[index].read_bytes()
+
+
+def test_pool_reports_worker_initialization_errors(tmp_path: Path) -> None:
+    config = WorkerConfig(model_id=str(tmp_path / "missing-model"), num_inference_steps=1)
+    requests = build_requests(["a", "b", "c"], tmp_path / "out", seed=1)
+    results = run_pool(requests, config, workers=2)
+
+    assert [result.index for result in results] == [0, 1, 2]
+    assert not any(result.ok for result in results)
+    assert all(result.error.startswith("worker initialization failed") for result in results)
@@ -0,0 +1,57 @@
+import threading
+from pathlib import Path
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from aipict.writer import AsyncImageWriter, save_image_atomic  # noqa: E402
+
+
+def test_save_image_atomic_writes_metadata(tmp_path: Path) -> None:
+    path = save_image_atomic(Image.new("RGB", (4, 4)), tmp_path / "out" / "a.png", {"prompt": "hero", "seed": 7})
+    with Image.open(path) as image:
+        assert image.text == {"prompt": "hero", "seed": "7"}
+    assert [p.name for p in path.parent.iterdir()] == ["a.png"]
+
+
+def test_writer_flush_is_a_barrier(tmp_path: Path) -> None:
+    with AsyncImageWriter(max_workers=2, max_pending=2) as writer:
+        for index in range(6):
+            writer.submit(Image.new("RGB", (4, 4)), tmp_path / f"{index}.png")
+        writer.flush()
+        assert writer.pending == 0
+        assert sorted(p.name for p in tmp_path.iterdir()) == [f"{i}.png" for i in range(6)]
+
+
+def test_writer_applies_backpressure(tmp_path: Path) -> None:
+    gate = threading.Event()
+
+    class SlowImage:
+        def save(self, path, **kwargs):
+            gate.wait()
+            Path(path).write_bytes(b"")
+
+    writer = AsyncImageWriter(max_workers=1, max_pending=1)
+    writer.submit(SlowImage(), tmp_path / "first.png")
+    blocked = threading.Thread(target=writer.submit, args=(SlowImage(), tmp_path / "second.png"))
+    blocked.start()
+    blocked.join(timeout=0.2)
+    assert blocked.is_alive()
+    gate.set()
+    blocked.join(timeout=5)
+    writer.close()
+    assert (tmp_path / "second.png").exists()
+
+
+def test_writer_reports_failures(tmp_path: Path) -> None:
+    class BrokenImage:
+        def save(self, path, **kwargs):
+            raise OSError("disk full")
+
+    writer = AsyncImageWriter()
+    writer.submit(BrokenImage(), tmp_path / "broken.png")
+    with pytest.raises(OSError, match="disk full"):
+        writer.flush()
+    writer.close()
+    assert list(tmp_path.iterdir()) == []
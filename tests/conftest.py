@@ -0,0 +1,22 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPTS_ROOT = Path(__file__).resolve().parents[1] / "scripts"
+
+
+def import_script(phase: str, name: str):
+    """Import scripts/<phase>/<name>.py as the module ``<phase>_<name>``."""
+
+    spec = importlib.util.spec_from_file_location(f"{phase}_{name}", SCRIPTS_ROOT / phase / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def load_script():
+    return import_script
@@ -0,0 +1,6 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def prompt_checker(load_script):
+    return load_script("phase3", "check_character_prompt")
@@ -0,0 +1,116 @@
+import io
+import json
+import random
+
+import pytest
+
+CHARACTERS = {
+    "char:Aoi": {
+        "prompt_prefix": "char:Aoi, cheerful heroine",
+        "attributes": {"hair": "silver hair", "eyes": "green eyes"},
+        "negatives": ["armor", "heavy makeup"],
+    },
+    "char:Ren": {
+        "prompt_prefix": "char:Ren, stoic knight",
+        "attributes": {"hair": "black hair", "gear": "silver armor"},
+        "negatives": ["smile"],
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def matcher(prompt_checker):
+    return prompt_checker.PromptMatcher(CHARACTERS)
+
+
+def test_automaton_matches_substring_search(prompt_checker) -> None:
+    rng = random.Random(0)
+    patterns = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(30)]
+    automaton = prompt_checker.AhoCorasick(patterns)
+    for _ in range(50):
+        text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 20)))
+        assert automaton.search(text) == {number for number, pattern in enumerate(patterns) if pattern in text}
+
+
+def test_report_lists_missing_and_negative_hits(matcher) -> None:
+    report = matcher.check("CHAR:Aoi, cheerful heroine, Silver Hair, armor, heavy makeup")
+    assert report == {
+        "characters": [
+            {"character_id": "char:Aoi", "status": "negative", "missing": ["eyes:green eyes"], "negatives": ["armor", "heavy makeup"]}
+        ],
+        "status": "negative",
+    }
+
+
+def test_characters_are_detected_and_checked_separately(matcher) -> None:
+    report = matcher.check("char:Aoi, cheerful heroine, silver hair, green eyes, char:Ren, black hair, silver armor")
+    by_id = {item["character_id"]: item for item in report["characters"]}
+    # Ren の attributes にある "silver armor" はタグ全体ではないので、Aoi の negatives "armor" に当たらない
+    assert by_id["char:Aoi"] == {"character_id": "char:Aoi", "status": "ok", "missing": [], "negatives": []}
+    assert by_id["char:Ren"] == {
+        "character_id": "char:Ren",
+        "status": "missing",
+        "missing": ["prompt_prefix 'char:Ren, stoic knight'"],
+        "negatives": [],
+    }
+    assert report["status"] == "missing"
+    assert matcher.check("landscape, sunset")["status"] == "unknown"
+    assert matcher.check("anything", "char:Nobody")["characters"] == [{"character_id": "char:Nobody", "status": "unknown"}]
+
+
+def test_negatives_match_whole_tags_only(matcher) -> None:
+    base = "char:Aoi, cheerful heroine, silver hair, green eyes"
+    assert matcher.check(base + ", armored train, no heavy makeup")["status"] == "ok"
+    assert matcher.check(base + ", (Armor:1.2)")["characters"][0]["negatives"] == ["armor"]
+    assert matcher.check(base + ",  heavy makeup ,[armor]")["characters"][0]["negatives"] == ["armor", "heavy makeup"]
+
+
+def test_validate_prompt_exit_codes(prompt_checker, matcher) -> None:
+    complete = "char:Aoi, cheerful heroine, silver hair, green eyes"
+    assert prompt_checker.validate_prompt("char:Aoi", complete, matcher) == 0
+    assert prompt_checker.validate_prompt("char:Aoi", complete + ", armor", matcher) == 3
+    assert prompt_checker.validate_prompt("char:Aoi", "char:Aoi", matcher) == 2
+    # 不足タグと禁止タグが両方あれば、バッチの status と同じく禁止タグを優先する
+    assert prompt_checker.validate_prompt("char:Aoi", "char:Aoi, armor", matcher) == 3
+    assert prompt_checker.validate_prompt("char:Nobody", complete, matcher) == 1
+
+
+def test_batch_reads_text_and_jsonl(prompt_checker, matcher, tmp_path) -> None:
+    text = tmp_path / "prompts.txt"
+    text.write_text("# comment\nchar:Aoi, cheerful heroine, silver hair, green eyes\n\nlandscape\n", encoding="utf-8")
+    logs = tmp_path / "log.jsonl"
+    logs.write_text(
+        json.dumps({"id": "gen-1", "prompt": "stoic knight, smile", "character_id": "char:Ren"}) + "\n",
+        encoding="utf-8",
+    )
+    output = io.StringIO()
+    counts = prompt_checker.check_batch(matcher, [str(text), str(logs)], "auto", output)
+    reports = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(report["id"], report["status"]) for report in reports] == [
+        (f"{text}:2", "ok"),
+        (f"{text}:4", "unknown"),
+        ("gen-1", "negative"),
+    ]
+    assert counts == {"prompts": 3, "ok": 1, "missing": 0, "negative": 1, "unknown": 1, "invalid": 0}
+
+
+def test_batch_reports_malformed_jsonl_lines_and_continues(prompt_checker, matcher, tmp_path) -> None:
+    logs = tmp_path / "log.jsonl"
+    lines = [
+        '{"id": "gen-1", "prompt": "stoic knight", ',
+        '["not", "an", "object"]',
+        json.dumps({"id": "gen-3", "prompt": 42}),
+        json.dumps({"id": "gen-4", "prompt": "landscape"}),
+    ]
+    logs.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    output = io.StringIO()
+    counts = prompt_checker.check_batch(matcher, [str(logs)], "auto", output)
+    reports = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(report["id"], report["status"]) for report in reports] == [
+        (f"{logs}:1", "invalid"),
+        (f"{logs}:2", "invalid"),
+        (f"{logs}:3", "invalid"),
+        ("gen-4", "unknown"),
+    ]
+    assert "prompt" in reports[2]["error"]
+    assert counts["invalid"] == 3 and counts["prompts"] == 4
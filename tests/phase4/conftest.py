@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import pytest
+
+# tag name, category, weights on the (B, G, R) channel means in [0, 1], bias
+TINY_TAGS = [
+    ("general", 9, (0.0, 0.0, 0.0), 5.0),
+    ("red_hair", 0, (0.0, 0.0, 10.0), -5.0),
+    ("blue_sky", 0, (9.0, 0.0, 0.0), -5.0),
+    ("green_theme", 0, (0.0, 8.0, 0.0), -5.0),
+    ("bright", 0, (4.0, 4.0, 4.0), -9.0),
+]
+
+
+@pytest.fixture(scope="session")
+def captions(load_script):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("PIL")
+    return load_script("phase4", "generate_captions")
+
+
+@pytest.fixture(scope="session")
+def dedup(load_script):
+    pytest.importorskip("numpy")
+    return load_script("phase4", "dedup_images")
+
+
+@pytest.fixture(scope="session")
+def tiny_embedder(tmp_path_factory) -> Path:
+    """An image-embedding ONNX model: NCHW input of 8x8, the per-channel means as the embedding."""
+
+    onnx = pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from onnx import TensorProto, helper
+
+    graph = helper.make_graph(
+        [helper.make_node("ReduceMean", ["pixel_values"], ["embeds"], axes=[2, 3], keepdims=0)],
+        "tiny_embedder",
+        [helper.make_tensor_value_info("pixel_values", TensorProto.FLOAT, ["batch", 3, 8, 8])],
+        [helper.make_tensor_value_info("embeds", TensorProto.FLOAT, ["batch", 3])],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    path = tmp_path_factory.mktemp("embedder") / "embedder.onnx"
+    onnx.save(model, path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def tiny_tagger(tmp_path_factory) -> Path:
+    """A WD14-shaped ONNX model: NHWC BGR 0-255 input of 8x8, sigmoid scores over TINY_TAGS."""
+
+    onnx = pytest.importorskip("onnx")
+    np = pytest.importorskip("numpy")
+    from onnx import TensorProto, helper, numpy_helper
+
+    weights = np.array([tag[2] for tag in TINY_TAGS], dtype=np.float32).T
+    bias = np.array([tag[3] for tag in TINY_TAGS], dtype=np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node("ReduceMean", ["input"], ["mean"], axes=[1, 2], keepdims=0),
+            helper.make_node("Div", ["mean", "scale"], ["unit"]),
+            helper.make_node("MatMul", ["unit", "weights"], ["logits"]),
+            helper.make_node("Add", ["logits", "bias"], ["shifted"]),
+            helper.make_node("Sigmoid", ["shifted"], ["output"]),
+        ],
+        "tiny_wd14",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", 8, 8, 3])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", len(TINY_TAGS)])],
+        initializer=[
+            numpy_helper.from_array(np.array(255.0, dtype=np.float32), "scale"),
+            numpy_helper.from_array(weights, "weights"),
+            numpy_helper.from_array(bias, "bias"),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    directory = tmp_path_factory.mktemp("tagger")
+    onnx.save(model, directory / "model.onnx")
+    lines = ["tag_id,name,category,count"] + [f"{i},{name},{category},1" for i, (name, category, _, _) in enumerate(TINY_TAGS)]
+    (directory / "selected_tags.csv").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return directory / "model.onnx"
@@ -0,0 +1,263 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def brute_force(encodings: dict[str, str], max_distance: int) -> dict:
+    items = [(name, int(value, 16)) for name, value in encodings.items()]
+    duplicates = {}
+    for name, value in items:
+        matches = [(other, (value ^ other_value).bit_count()) for other, other_value in items if other != name]
+        duplicates[name] = [other for other, distance in sorted(matches, key=lambda m: m[1]) if distance <= max_distance]
+    return duplicates
+
+
+def near_duplicate_encodings(count: int, max_distance: int, seed: int = 0) -> dict[str, str]:
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, 2**64, size=count, dtype=np.uint64)
+    for index in range(0, count, 3):
+        flips = rng.choice(64, size=rng.integers(0, max_distance + 2), replace=False)
+        hashes[index] = hashes[rng.integers(count)] ^ np.uint64(sum(1 << int(bit) for bit in flips))
+    return {f"img_{index:04d}.png": f"{int(value):016x}" for index, value in enumerate(hashes)}
+
+
+@pytest.mark.parametrize("max_distance", [0, 3, 6, 10, 20])
+def test_native_search_matches_brute_force(dedup, max_distance: int) -> None:
+    encodings = near_duplicate_encodings(400, max_distance)
+    assert dedup.find_duplicates(encodings, max_distance) == brute_force(encodings, max_distance)
+
+
+def test_small_candidate_blocks_give_the_same_pairs(dedup, monkeypatch) -> None:
+    encodings = near_duplicate_encodings(300, 6, seed=1)
+    expected = dedup.find_duplicates(encodings, 6)
+    monkeypatch.setattr(dedup, "CANDIDATE_BLOCK", 7)
+    assert dedup.find_duplicates(encodings, 6) == expected
+
+
+def test_search_queries_against_an_index_and_reports_scores(dedup) -> None:
+    hashes = np.array([0, 0b111, 2**64 - 1], dtype=np.uint64)
+    index = dedup.MultiIndexHash(hashes, 3)
+    queries, items, distances = index.search(np.array([0b1, 2**64 - 2], dtype=np.uint64))
+    assert sorted(zip(queries.tolist(), items.tolist(), distances.tolist())) == [(0, 0, 1), (0, 1, 2), (1, 2, 1)]
+
+    encodings = {"a.png": "0000000000000000", "b.png": "0000000000000007", "c.png": "0000000000000001"}
+    assert dedup.find_duplicates(encodings, 2, scores=True) == {
+        "a.png": [("c.png", 1)],
+        "b.png": [("c.png", 2)],
+        "c.png": [("a.png", 1), ("b.png", 2)],
+    }
+
+
+def test_popcount_fallback_matches_numpy(dedup, monkeypatch) -> None:
+    values = np.random.default_rng(0).integers(0, 2**64, size=64, dtype=np.uint64)
+    expected = [bin(int(value)).count("1") for value in values]
+    assert dedup.popcount64(values).tolist() == expected
+    monkeypatch.delattr(np, "bitwise_count", raising=False)
+    assert dedup.popcount64(values).tolist() == expected
+
+
+class TextHasher:
+    """Reads each "image" as the hex phash written into it; anything else is unreadable."""
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __call__(self, paths):
+        self.calls.append(sorted(path.name for path in paths))
+        results = []
+        for path in paths:
+            text = path.read_text(encoding="utf-8")
+            value = text if len(text) == 16 else None
+            results.append({"phash": value, "ahash": value, "dhash": None})
+        return results
+
+
+def test_hash_index_only_hashes_new_or_changed_images(dedup, tmp_path) -> None:
+    images = tmp_path / "images"
+    images.mkdir()
+    encodings = near_duplicate_encodings(60, 6, seed=2)
+    for name, value in encodings.items():
+        (images / name).write_text(value, encoding="utf-8")
+    (images / ".hidden.png").write_text("0" * 16, encoding="utf-8")
+    (images / "broken.png").write_text("not an image", encoding="utf-8")
+    hasher = TextHasher()
+    index = dedup.HashIndex(tmp_path / "reports" / "hash_index.sqlite")
+
+    added, removed = dedup.update_index(index, images, hasher)
+    assert len(added) == 61 and removed == [] and index.failed() == {"broken.png": "unreadable"}
+    assert dedup.indexed_duplicates(index, "phash", 6, added) == dedup.find_duplicates(encodings, 6)
+
+    assert dedup.update_index(index, images, hasher) == ([], [])
+    assert hasher.calls[-1] == []
+
+    rng = np.random.default_rng(3)
+    for name in ["img_0000.png", "img_0001.png", "new.png"]:
+        encodings[name] = f"{int(encodings['img_0010.png'], 16) ^ (1 << int(rng.integers(64))):016x}"
+        (images / name).write_text(encodings[name], encoding="utf-8")
+    (images / "img_0002.png").unlink()
+    del encodings["img_0002.png"]
+    added, removed = dedup.update_index(index, images, hasher)
+    assert (added, removed) == (["img_0000.png", "img_0001.png", "new.png"], ["img_0002.png"])
+    assert hasher.calls[-1] == added
+    expected = dedup.find_duplicates(dict(sorted(encodings.items())), 6)
+    assert dedup.indexed_duplicates(index, "phash", 6, added) == expected
+
+    # A different threshold cannot reuse the stored pairs.
+    assert dedup.indexed_duplicates(index, "phash", 2, []) == dedup.find_duplicates(dict(sorted(encodings.items())), 2)
+    assert dedup.indexed_duplicates(index, "ahash", 2, []) == dedup.find_duplicates(dict(sorted(encodings.items())), 2)
+    index.close()
+
+
+def test_interrupted_run_requeries_unpaired_images(dedup, tmp_path) -> None:
+    images = tmp_path / "images"
+    images.mkdir()
+    encodings = near_duplicate_encodings(40, 6, seed=5)
+    for name, value in encodings.items():
+        (images / name).write_text(value, encoding="utf-8")
+    path = tmp_path / "hash_index.sqlite"
+    index = dedup.HashIndex(path)
+    added, _ = dedup.update_index(index, images, TextHasher())
+    dedup.indexed_duplicates(index, "phash", 6, added)
+
+    encodings["late.png"] = encodings["img_0003.png"]
+    (images / "late.png").write_text(encodings["late.png"], encoding="utf-8")
+    assert dedup.update_index(index, images, TextHasher())[0] == ["late.png"]
+    # 新しいハッシュを保存した後、ペアを探す前に止まった
+    index.close()
+
+    index = dedup.HashIndex(path)
+    assert dedup.update_index(index, images, TextHasher()) == ([], [])
+    assert index.pending() == ["late.png"]
+    expected = dedup.find_duplicates(dict(sorted(encodings.items())), 6)
+    assert dedup.indexed_duplicates(index, "phash", 6, []) == expected
+    assert index.pending() == []
+    assert dedup.indexed_duplicates(index, "phash", 6, []) == expected
+    index.close()
+
+
+def make_images(directory):
+    Image = pytest.importorskip("PIL.Image")
+    rng = np.random.default_rng(4)
+    directory.mkdir()
+    for index in range(6):
+        pixels = rng.integers(0, 256, size=(12, 16, 3), dtype=np.uint8).repeat(40, axis=0).repeat(40, axis=1)
+        image = Image.fromarray(pixels)
+        image.save(directory / f"photo_{index}.jpg", quality=92)
+        image.convert("RGBA").save(directory / f"art_{index}.png")
+    (directory / "corrupt.jpg").write_bytes(b"\xff\xd8\xff\xe0 truncated")
+    return directory
+
+
+def test_native_hashes_match_imagededup_on_full_decode(dedup, tmp_path) -> None:
+    methods = pytest.importorskip("imagededup.methods")
+    images = make_images(tmp_path / "images")
+    paths = [path for path in dedup.list_images(images) if path.name != "corrupt.jpg"]
+    native = dedup.hash_images(paths, workers=1, reduced=False)
+    for method in dedup.HASH_METHODS:
+        encoder = getattr(methods, method[0].upper() + "Hash")(verbose=False)
+        assert [hashes[method] for hashes in native] == [encoder.encode_image(image_file=path) for path in paths]
+
+
+def test_reduced_parallel_hashing_reports_corrupt_files(dedup, tmp_path) -> None:
+    images = make_images(tmp_path / "images")
+    encodings, errors = dedup.encode_images(images, "phash", workers=2, chunk_size=4)
+    assert list(errors) == ["corrupt.jpg"] and errors["corrupt.jpg"]
+    assert len(encodings) == 12 and all(len(value) == 16 for value in encodings.values())
+    assert dedup.encode_images(images, "phash", workers=1)[0] == encodings
+
+    full = dedup.encode_images(images, "phash", workers=1, reduced=False)[0]
+    values = dedup.hashes_to_array(encodings.values()) ^ dedup.hashes_to_array(full.values())
+    assert dedup.popcount64(values).max() <= 4
+    duplicates = dedup.find_duplicates(encodings, 4)
+    assert all(f"art_{index}.png" in duplicates[f"photo_{index}.jpg"] for index in range(6))
+
+
+def test_blocked_similarity_search_matches_full_matrix(dedup) -> None:
+    rng = np.random.default_rng(5)
+    vectors = rng.normal(size=(70, 16)).astype(np.float32)
+    vectors[10:20] = vectors[:10] + rng.normal(scale=0.05, size=(10, 16))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    matrix = vectors.astype(np.float16)
+
+    full = matrix.astype(np.float32) @ matrix.astype(np.float32).T
+    expected = {(i, j) for i, j in zip(*np.nonzero(np.triu(full, k=1) >= 0.9))}
+    for block_size in (7, 32, 4096):
+        first, second, similarity = dedup.similar_pairs(matrix, 0.9, block_size)
+        assert set(zip(first.tolist(), second.tolist())) == expected
+        assert np.allclose(similarity, full[first, second])
+    assert {(i, i + 10) for i in range(10)} <= expected
+
+
+def test_embedding_method_reports_semantic_duplicates(dedup, tiny_embedder, tmp_path) -> None:
+    Image = pytest.importorskip("PIL.Image")
+    images = tmp_path / "images"
+    images.mkdir()
+    Image.new("RGB", (64, 48), (220, 30, 20)).save(images / "red.jpg")
+    Image.new("RGB", (32, 32), (150, 25, 10)).save(images / "red_dark.png")
+    Image.new("RGB", (32, 32), (20, 30, 220)).save(images / "blue.png")
+    (images / "broken.png").write_bytes(b"broken")
+    config = {
+        "method": "embedding",
+        "embedding": {"model": str(tiny_embedder), "input_size": 8, "mean": [0, 0, 0], "std": [1, 1, 1], "batch_size": 2},
+    }
+
+    output = tmp_path / "reports" / "duplicates.json"
+    output.parent.mkdir()
+    duplicates = dedup.embedding_duplicates(images, output, config, workers=2)
+
+    assert duplicates == {"blue.png": [], "red.jpg": ["red_dark.png"], "red_dark.png": ["red.jpg"]}
+    matrix = np.load(output.with_name("embeddings.npy"), mmap_mode="r")
+    assert matrix.dtype == np.float16 and matrix.shape == (3, 3)
+    metadata = json.loads(output.with_name("embeddings.json").read_text(encoding="utf-8"))
+    assert metadata["names"] == ["blue.png", "red.jpg", "red_dark.png"] and metadata["rows"] == 3
+    assert sorted(path.name for path in output.parent.iterdir()) == ["embeddings.json", "embeddings.npy"]
+
+
+def test_embedding_output_must_be_selected_and_two_dimensional(dedup, tmp_path) -> None:
+    onnx = pytest.importorskip("onnx")
+    Image = pytest.importorskip("PIL.Image")
+    from onnx import TensorProto, helper
+
+    # CLIP-style export: the (batch, 3, 8, 8) "hidden state" comes before the pooled embedding.
+    graph = helper.make_graph(
+        [
+            helper.make_node("Identity", ["pixel_values"], ["last_hidden_state"]),
+            helper.make_node("ReduceMean", ["pixel_values"], ["image_embeds"], axes=[2, 3], keepdims=0),
+        ],
+        "two_outputs",
+        [helper.make_tensor_value_info("pixel_values", TensorProto.FLOAT, ["batch", 3, 8, 8])],
+        [
+            helper.make_tensor_value_info("last_hidden_state", TensorProto.FLOAT, ["batch", 3, 8, 8]),
+            helper.make_tensor_value_info("image_embeds", TensorProto.FLOAT, ["batch", 3]),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, tmp_path / "clip.onnx")
+    images = tmp_path / "images"
+    images.mkdir()
+    Image.new("RGB", (16, 16), (220, 30, 20)).save(images / "red.png")
+    settings = {**dedup.EMBEDDING_DEFAULTS, "input_size": 8, "mean": [0, 0, 0], "std": [1, 1, 1]}
+    paths = [images / "red.png"]
+
+    with pytest.raises(ValueError, match="output_name"):
+        dedup.compute_embeddings(paths, tmp_path / "clip.onnx", tmp_path / "a.npy", settings)
+    with pytest.raises(ValueError, match="last_hidden_state"):
+        dedup.compute_embeddings(paths, tmp_path / "clip.onnx", tmp_path / "b.npy", {**settings, "output_name": "last_hidden_state"})
+    matrix, rows, _ = dedup.compute_embeddings(paths, tmp_path / "clip.onnx", tmp_path / "c.npy", {**settings, "output_name": "image_embeds"})
+    assert matrix.shape == (1, 3) and rows == paths
+
+
+def test_embedding_method_rejects_imagededup_engine(dedup, tmp_path, monkeypatch) -> None:
+    config_path = tmp_path / "dedup_config.json"
+    config_path.write_text(json.dumps({"method": "embedding", "image_dir": "images", "output": "reports/duplicates.json"}), encoding="utf-8")
+    argv = ["dedup_images.py", "--config", str(config_path), "--engine", "imagededup", "--image-dir", str(tmp_path), "--output", str(tmp_path / "duplicates.json")]
+    monkeypatch.setattr("sys.argv", argv)
+
+    with pytest.raises(SystemExit) as excinfo:
+        dedup.main()
+
+    assert excinfo.value.code == 2
+    assert not (tmp_path / "duplicates.json").exists()
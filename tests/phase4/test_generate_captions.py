@@ -0,0 +1,155 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_dataset(root: Path) -> Path:
+    images = root / "images"
+    (images / "nested").mkdir(parents=True)
+    Image.new("RGB", (16, 16), (255, 0, 0)).save(images / "red.png")
+    Image.new("RGB", (16, 16), (0, 0, 255)).save(images / "nested" / "blue.jpg", quality=95)
+    Image.new("RGB", (16, 16), (255, 255, 255)).save(images / "nested" / "white.webp", lossless=True)
+    (images / "notes.txt").write_text("not an image", encoding="utf-8")
+    return images
+
+
+def test_select_tags_applies_threshold_top_k_and_exclusions(captions) -> None:
+    probs = np.array([[0.9, 0.2, 0.5, 0.8], [0.99, 0.1, 0.1, 0.1]], dtype=np.float32)
+    names = ["rating", "a", "b", "c"]
+    excluded = np.array([True, False, False, False])
+    assert captions.select_tags(probs, names, 0.3, 2, excluded) == [[("c", pytest.approx(0.8)), ("b", 0.5)], []]
+    assert [tag for tag, _ in captions.select_tags(probs, names, 0.0, 0)[0]] == ["rating", "c", "b", "a"]
+
+
+def test_preprocess_pads_the_batch_and_converts_to_bgr(captions, tmp_path: Path) -> None:
+    Image.new("RGB", (40, 20), (255, 0, 0)).save(tmp_path / "red.png")
+    image = captions.load_image(tmp_path / "red.png", 8)
+    assert image.shape == (8, 8, 3) and tuple(image[0, 0]) == (255, 255, 255) and tuple(image[4, 4]) == (255, 0, 0)
+
+    batch = captions.preprocess_batch([image], batch_size=3, size=8)
+    assert batch.shape == (3, 8, 8, 3) and batch.dtype == np.float32
+    assert tuple(batch[0, 4, 4]) == (0.0, 0.0, 255.0)
+    assert (batch[1:] == 255).all()
+
+
+def test_postprocess_replaces_and_lowercases(captions) -> None:
+    tags = [("Red_Hair", 0.9), ("Blue_Sky", 0.8)]
+    assert captions.postprocess(tags, {"replace": {"_": " "}, "lowercase": True}) == "red hair, blue sky"
+
+
+def test_cli_tags_a_recursive_dataset(captions, tiny_tagger: Path, tmp_path: Path) -> None:
+    images = make_dataset(tmp_path)
+    config = json.loads((Path(captions.CONFIG_PATH)).read_text(encoding="utf-8"))
+    config["thresholds"]["top_k"] = 2
+    config_path = tmp_path / "caption_config.json"
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+
+    subprocess.run(
+        [
+            sys.executable,
+            str(Path(captions.__file__)),
+            "--config", str(config_path),
+            "--model", str(tiny_tagger),
+            "--input-dir", str(images),
+            "--output-dir", str(tmp_path / "captions"),
+            "--batch-size", "2",
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+    read = lambda name: (tmp_path / "captions" / name).read_text(encoding="utf-8")  # noqa: E731
+    assert read("red.txt") == "red_hair"
+    assert read("nested/blue.txt") == "blue_sky"
+    assert read("nested/white.txt") == "red_hair, blue_sky"
+    assert not (tmp_path / "captions" / "notes.txt").exists()
+
+
+def test_images_sharing_a_caption_are_skipped(captions, tiny_tagger: Path, tmp_path: Path) -> None:
+    images = make_dataset(tmp_path)
+    Image.new("RGB", (16, 16), (0, 0, 255)).save(images / "red.jpg", quality=95)
+    kept, collisions = captions.split_caption_collisions(captions.iter_images(images), images)
+    assert [[path.name for path in group] for group in collisions] == [["red.jpg", "red.png"]]
+    assert [path.name for path in kept] == ["blue.jpg", "white.webp"]
+
+    command = [sys.executable, str(Path(captions.__file__)), "--model", str(tiny_tagger)]
+    command += ["--input-dir", str(images), "--output-dir", str(tmp_path / "captions")]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    assert "1 組あるためスキップしました" in output and "red.jpg, red.png" in output
+    assert not (tmp_path / "captions" / "red.txt").exists()
+    manifest = json.loads((tmp_path / "captions" / captions.DEFAULT_MANIFEST_NAME).read_text(encoding="utf-8"))
+    assert sorted(manifest["images"]) == ["nested/blue.jpg", "nested/white.webp"]
+
+
+def test_pipeline_streams_batches_and_skips_unreadable_images(captions, tiny_tagger: Path, tmp_path: Path) -> None:
+    images = make_dataset(tmp_path)
+    Image.new("RGB", (64, 48), (0, 0, 255)).save(images / "large_blue.jpg", quality=95)
+    (images / "broken.png").write_bytes(b"not a png")
+    paths = captions.iter_images(images)
+    names, categories = captions.load_tags(tiny_tagger.with_name("selected_tags.csv"))
+    session = captions.create_session(tiny_tagger)
+    written = {}
+
+    counters = captions.caption_images(
+        session,
+        paths,
+        lambda path: captions.caption_path_for(path, images, tmp_path / "captions"),
+        names,
+        size=8,
+        batch_size=2,
+        threshold=0.35,
+        top_k=1,
+        settings={},
+        excluded=categories == captions.RATING_CATEGORY,
+        decode_workers=2,
+        prefetch_batches=1,
+        on_written=lambda path, caption: written.setdefault(path.name, caption),
+    )
+
+    assert written == {"large_blue.jpg": "blue_sky", "blue.jpg": "blue_sky", "red.png": "red_hair", "white.webp": "red_hair"}
+    assert (tmp_path / "captions" / "large_blue.txt").read_text(encoding="utf-8") == "blue_sky"
+    assert not (tmp_path / "captions" / "broken.txt").exists()
+    assert (counters["decode"].items, counters["inference"].items, counters["write"].items) == (5, 4, 4)
+    assert all(counter.busy > 0 for counter in counters.values())
+
+
+def test_incremental_runs_only_caption_new_or_changed_images(captions, tiny_tagger: Path, tmp_path: Path) -> None:
+    images = make_dataset(tmp_path)
+    output_dir = tmp_path / "captions"
+    config = json.loads(Path(captions.CONFIG_PATH).read_text(encoding="utf-8"))
+    config_path = tmp_path / "caption_config.json"
+
+    def run(*extra: str) -> str:
+        config_path.write_text(json.dumps(config), encoding="utf-8")
+        command = [sys.executable, str(Path(captions.__file__)), "--config", str(config_path), "--model", str(tiny_tagger)]
+        command += ["--input-dir", str(images), "--output-dir", str(output_dir), *extra]
+        return subprocess.run(command, check=True, capture_output=True, text=True).stdout
+
+    assert "0 件は変更なし、3 件を推論します" in run()
+    assert "3 件は変更なし、0 件を推論します" in run()
+
+    Image.new("RGB", (16, 16), (0, 255, 0)).save(images / "red.png")
+    os.utime(images / "nested" / "blue.jpg", ns=(0, 0))
+    assert "2 件は変更なし、1 件を推論します" in run()
+    assert (output_dir / "red.txt").read_text(encoding="utf-8") == "green_theme"
+
+    config["thresholds"]["min_score"] = 0.5
+    assert "0 件は変更なし、3 件を推論します" in run()
+    assert "3/3 件のキャプションを" in run("--full")
+
+    (images / "nested" / "white.webp").unlink()
+    (output_dir / "README.txt").write_text("hand-written notes", encoding="utf-8")
+    assert "1 件検出しました" in run()
+    assert (output_dir / "nested" / "white.txt").exists()
+    assert "1 件削除しました" in run("--prune-orphans")
+    assert not (output_dir / "nested" / "white.txt").exists()
+    assert (output_dir / "README.txt").exists()
+    manifest = json.loads((output_dir / captions.DEFAULT_MANIFEST_NAME).read_text(encoding="utf-8"))
+    assert sorted(manifest["images"]) == ["nested/blue.jpg", "red.png"]
@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def leakage(load_script):
+    pytest.importorskip("numpy")
+    pytest.importorskip("PIL")
+    return load_script("phase5", "scan_leakage")
+
+
+@pytest.fixture(scope="session")
+def ledger_validator(load_script):
+    return load_script("phase5", "validate_ledger")
+
+
+@pytest.fixture(scope="session")
+def ledger_store(load_script):
+    return load_script("phase5", "ledger_store")
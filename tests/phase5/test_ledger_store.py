@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+HEADER = "image_id,source,license,usage,commercial_ok,credit_required,notes"
+
+
+def write_csv(path, rows, header=HEADER):
+    path.write_text("\n".join([header, *rows]) + "\n", encoding="utf-8")
+    stat = path.stat()
+    # 同じ秒内の書き換えでも mtime が変わるようにする
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    return path
+
+
+def touch_images(root, names):
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"\x89PNG")
+
+
+@pytest.fixture
+def store(ledger_store, tmp_path):
+    store = ledger_store.LedgerStore(tmp_path / "ledger.sqlite")
+    yield store
+    store.close()
+
+
+def test_import_writes_only_the_diff(store, tmp_path) -> None:
+    ledger = write_csv(
+        tmp_path / "ledger.csv",
+        ["a,s,cc-by,training,true,true,x", "b,s,cc-by-nc,validation,false,true,y", "c,s,cc-by,test,true,false,z"],
+    )
+    assert store.import_csv(ledger) == {"rows": 3, "added": 3, "updated": 0, "removed": 0}
+    assert store.import_csv(ledger) is None
+
+    write_csv(ledger, ["a,s,cc-by,training,true,true,x", 'c,s,cc-by,training,true,false,"z\nz"', "d,s,commission,test,false,false,"])
+    assert store.import_csv(ledger) == {"rows": 3, "added": 1, "updated": 1, "removed": 1}
+    rows = store.select()
+    assert [(row["image_id"], row["line"], row["usage"]) for row in rows] == [
+        ("a", 2, "training"),
+        ("c", 3, "training"),
+        ("d", 5, "test"),
+    ]
+
+
+def test_extra_columns_and_case_insensitive_filters(store, tmp_path) -> None:
+    ledger = write_csv(
+        tmp_path / "ledger.csv",
+        ["a,s,CC-BY,Training,TRUE,true,,yes", "b,s,cc-by-nc,training,false,true,,no"],
+        header=HEADER + ",reviewer",
+    )
+    store.import_csv(ledger)
+    assert [row["image_id"] for row in store.select({"usage": ["training"], "commercial_ok": ["true"]})] == ["a"]
+    assert [row["image_id"] for row in store.select({"reviewer": ["no"]})] == ["b"]
+    plan = store.db.execute("EXPLAIN QUERY PLAN SELECT image_id FROM ledger WHERE license IN ('cc-by')").fetchall()
+    assert "ledger_license" in str(plan)
+    with pytest.raises(ValueError):
+        store.select({"missing": ["x"]})
+
+    write_csv(ledger, ["a,s,cc-by,training,true,true,"])
+    store.import_csv(ledger)
+    assert store.select()[0]["reviewer"] == ""
+
+
+def test_reconcile_reports_unregistered_and_missing(store, tmp_path) -> None:
+    ledger = write_csv(tmp_path / "ledger.csv", ["a,s,cc-by,training,true,true,", "b,s,cc-by,test,true,true,"])
+    images = tmp_path / "images"
+    touch_images(images, ["a.png", "nested/z.jpg", "nested/a.webp", ".hidden.png", "a.txt"])
+    store.import_csv(ledger)
+
+    report = store.reconcile(images)
+    assert report["images"] == 3
+    assert report["unregistered"] == ["nested/z.jpg"]
+    assert report["missing"] == [{"image_id": "b", "line": 3}]
+    assert report["shared_ids"] == {"a": ["a.png", "nested/a.webp"]}
+    assert [row["image_id"] for row in store.select(present=False)] == ["b"]
+
+    (images / "nested" / "z.jpg").unlink()
+    touch_images(images, ["b.png"])
+    report = store.reconcile(images)
+    assert report["unregistered"] == [] and report["missing"] == []
+    assert [(row["image_id"], row["path"]) for row in store.select({"usage": ["test"]}, present=True)] == [("b", "b.png")]
+
+
+def test_link_selection_links_images_and_captions(ledger_store, store, tmp_path) -> None:
+    ledger = write_csv(tmp_path / "ledger.csv", ["a,s,cc-by,training,true,true,", "b,s,cc-by,test,true,true,"])
+    images = tmp_path / "images"
+    touch_images(images, ["a.png", "b.png"])
+    captions = tmp_path / "captions"
+    captions.mkdir()
+    (captions / "a.txt").write_text("1girl", encoding="utf-8")
+    (images / "a.txt").write_text("stale sidecar", encoding="utf-8")
+    store.import_csv(ledger)
+    store.reconcile(images)
+
+    selected = tmp_path / "selected"
+    rows = store.select(ledger_store.parse_where(["usage=training"]), present=True)
+    assert ledger_store.caption_dir_for(images) == captions
+    assert ledger_store.link_selection(rows, images, selected, captions) == 1
+    assert sorted(path.name for path in selected.iterdir()) == ["a.png", "a.txt"]
+    assert (selected / "a.txt").read_text(encoding="utf-8") == "1girl"
+
+
+def test_link_selection_mirrors_subdirectories_and_rejects_shared_captions(ledger_store, tmp_path) -> None:
+    images = tmp_path / "images"
+    touch_images(images, ["a/x.png", "b/x.png"])
+    captions = tmp_path / "captions"
+    (captions / "b").mkdir(parents=True)
+    (captions / "b" / "x.txt").write_text("1boy", encoding="utf-8")
+
+    selected = tmp_path / "selected"
+    rows = [{"path": "a/x.png"}, {"path": "b/x.png"}]
+    assert ledger_store.link_selection(rows, images, selected, captions) == 2
+    assert sorted(path.relative_to(selected).as_posix() for path in selected.rglob("*") if path.is_symlink()) == [
+        "a/x.png",
+        "b/x.png",
+        "b/x.txt",
+    ]
+    assert (selected / "b" / "x.txt").read_text(encoding="utf-8") == "1boy"
+
+    clashing = [{"path": "a/x.png"}, {"path": "a/x.jpg"}]
+    with pytest.raises(ValueError, match="a/x.jpg, a/x.png"):
+        ledger_store.link_selection(clashing, images, selected, captions)
+    assert (selected / "b" / "x.png").is_symlink()
@@ -0,0 +1,61 @@
+import csv
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+
+def pattern(seed: int, shade: int = 0):
+    pixels = np.random.default_rng(seed).integers(0, 200, size=(8, 8, 3), dtype=np.uint8)
+    return Image.fromarray(pixels + shade).resize((128, 128), Image.NEAREST)
+
+
+def write_ledger(path: Path, rows: list[tuple[str, str]]) -> None:
+    with path.open("w", encoding="utf-8", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["image_id", "source", "license", "usage", "commercial_ok", "credit_required", "notes"])
+        writer.writerows([(image_id, "src", "cc-by", usage, "true", "true", "") for image_id, usage in rows])
+
+
+def test_reports_cross_split_and_generated_clusters(leakage, tmp_path: Path) -> None:
+    train = tmp_path / "datasets" / "char_a" / "images"
+    other = tmp_path / "datasets" / "char_b" / "images"
+    renders = tmp_path / "outputs" / "2024-01-01"
+    for directory in (train, other, renders):
+        directory.mkdir(parents=True)
+    pattern(1).save(train / "a_001.png")
+    pattern(1, shade=3).save(other / "b_001.jpg", quality=95)  # validation copy of a training image
+    pattern(2).save(train / "a_002.png")
+    pattern(2).save(renders / "render_7.png")  # render fed back next to its training source
+    pattern(3).save(train / "a_003.png")
+    pattern(3).save(train / "a_003_dup.png")  # duplicate within one split is not leakage
+    pattern(4).save(train / "a_004.png")
+    pattern(4).save(other / "stray.png")  # unregistered copy is not a split
+    (tmp_path / "datasets" / "char_a" / "notes.txt").write_text("ignored", encoding="utf-8")
+    ledger = tmp_path / "ledger.csv"
+    write_ledger(
+        ledger,
+        [("a_001", "training"), ("b_001", "validation"), ("a_002", "training"), ("a_003", "training"),
+         ("a_003_dup", "training"), ("a_004", "training")],
+    )
+
+    report = leakage.scan_leakage(tmp_path, ledger, tmp_path / "index.sqlite", max_distance=6)
+
+    clusters = {tuple(c["splits"]): [m["path"] for m in c["members"]] for c in report["clusters"]}
+    assert clusters == {
+        ("generated", "training"): ["datasets/char_a/images/a_002.png", "outputs/2024-01-01/render_7.png"],
+        ("training", "validation"): ["datasets/char_a/images/a_001.png", "datasets/char_b/images/b_001.jpg"],
+    }
+    assert report["summary"]["images"] == 8 and report["summary"]["leaking_clusters"] == 2
+    assert report["summary"]["images_per_split"]["unregistered"] == 1
+
+    # The index is reused: a second scan hashes nothing and finds the same leaks.
+    again = leakage.scan_leakage(tmp_path, ledger, tmp_path / "index.sqlite", max_distance=6)
+    assert again["summary"]["hashed"] == 0 and again["clusters"] == report["clusters"]
+
+
+def test_clusters_are_connected_components(leakage) -> None:
+    first, second = np.array([0, 1, 5, 7]), np.array([1, 2, 6, 5])
+    assert leakage.clusters_from_pairs(8, first, second) == [[0, 1, 2], [5, 6, 7]]
@@ -0,0 +1,98 @@
+import io
+import json
+
+RULES = {
+    "required_columns": ["image_id", "license", "usage"],
+    "validators": {"license": ["cc-by", "commission"], "usage": ["training", "validation"]},
+    "severity": {"missing_required": "critical", "invalid_value": "high"},
+}
+
+
+def write_ledger(path, rows, header="image_id,license,usage,notes"):
+    path.write_text("\n".join([header, *rows]) + "\n", encoding="utf-8")
+    return path
+
+
+def collect(ledger_validator, path, rules=RULES, **options):
+    violations = []
+    summary = ledger_validator.run_validation(path, rules, violations.append, **options)
+    return summary, violations
+
+
+def test_violations_carry_severity_and_physical_line(ledger_validator, tmp_path) -> None:
+    ledger = write_ledger(
+        tmp_path / "ledger.csv",
+        ['a,CC-BY,training,ok', 'b,mit,training,"two\nlines"', 'c,commission,,x', "", "d,cc-by,holdout,"],
+    )
+    summary, violations = collect(ledger_validator, ledger)
+    assert [(v["rule"], v["severity"], v["line"], v["column"]) for v in violations] == [
+        ("invalid_value", "high", 3, "license"),
+        ("missing_required", "critical", 5, "usage"),
+        ("invalid_value", "high", 7, "usage"),
+    ]
+    assert summary["rows"] == 4
+    assert summary["by_rule"] == {"invalid_value": 2, "missing_required": 1}
+    assert list(summary["by_severity"]) == ["critical", "high"]
+
+
+def test_missing_header_column_is_reported_once(ledger_validator, tmp_path) -> None:
+    ledger = write_ledger(tmp_path / "ledger.csv", ["a,cc-by", "b,cc-by"], header="image_id,license")
+    summary, violations = collect(ledger_validator, ledger)
+    assert [(v["line"], v["column"]) for v in violations] == [(1, "usage")]
+    assert summary["rows"] == 2
+
+
+def test_parallel_chunks_match_sequential(ledger_validator, tmp_path) -> None:
+    rows = [f"img{i},{'bad' if i % 7 == 0 else 'cc-by'},{'' if i % 5 == 0 else 'training'},n" for i in range(200)]
+    ledger = write_ledger(tmp_path / "ledger.csv", rows)
+    sequential = collect(ledger_validator, ledger)
+    parallel = collect(ledger_validator, ledger, workers=2, chunk_rows=16)
+    assert parallel == sequential
+    assert sequential[0]["rows"] == 200
+
+
+def test_jsonl_streams_all_violations_and_summary(ledger_validator, tmp_path) -> None:
+    ledger = write_ledger(tmp_path / "ledger.csv", [f"img{i},bad,training," for i in range(5)])
+    output = io.StringIO()
+    code = ledger_validator.validate_ledger(ledger, RULES, "jsonl", output, max_violations=2)
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert code == 1
+    assert [record["type"] for record in records] == ["violation"] * 5 + ["summary"]
+    assert records[-1]["violations"] == 5
+    assert records[-1]["truncated"] == 0
+
+
+def test_sarif_is_capped_and_fail_on_threshold(ledger_validator, tmp_path) -> None:
+    ledger = write_ledger(tmp_path / "ledger.csv", [f"img{i},bad,training," for i in range(5)])
+    output = io.StringIO()
+    code = ledger_validator.validate_ledger(ledger, RULES, "sarif", output, max_violations=3, fail_on="critical")
+    sarif = json.loads(output.getvalue())
+    run = sarif["runs"][0]
+    assert code == 0
+    assert sarif["version"] == "2.1.0"
+    assert len(run["results"]) == 3
+    assert run["results"][0]["level"] == "error"
+    assert run["results"][0]["locations"][0]["physicalLocation"]["region"]["startLine"] == 2
+    assert run["properties"]["summary"]["truncated"] == 2
+
+
+def test_validate_row_keeps_message_format(ledger_validator) -> None:
+    row = {"image_id": "a", "license": "mit", "usage": ""}
+    assert ledger_validator.validate_row(row, RULES, 4) == [
+        "invalid value 'mit' for column 'license' at line 4",
+        "missing required column 'usage' at line 4",
+    ]
+
+
+def test_images_are_reconciled_through_store(ledger_validator, tmp_path) -> None:
+    ledger = write_ledger(tmp_path / "ledger.csv", ["a,cc-by,training,", "b,cc-by,training,"])
+    images = tmp_path / "images"
+    images.mkdir()
+    for name in ("a.png", "z.png"):
+        (images / name).write_bytes(b"")
+    summary, violations = collect(ledger_validator, ledger, images=images, store_path=tmp_path / "ledger.sqlite")
+    assert [(v["rule"], v["line"], v["value"]) for v in violations] == [
+        ("missing_image", 3, "b"),
+        ("unregistered_image", 1, "z.png"),
+    ]
+    assert summary["by_rule"] == {"missing_image": 1, "unregistered_image": 1}